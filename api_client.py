@@ -1,26 +1,234 @@
-from typing import Dict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+import asyncio
+import time
+import aiohttp
 from astrbot.api.all import logger
-from .cache import name_cache, message_cache
+from .cache import message_cache, forward_cache
+from .member_directory import member_directory
+from .metrics import metrics
+
+class SingleFlight:
+    """
+    并发调用合并：相同键的并发调用共享同一个进行中的请求
+    
+    第一个调用者发起请求，后续调用者等待同一个结果，请求完成后立即移除
+    """
+    
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        # 实际发起的调用次数
+        self.calls = 0
+        # 通过共享结果节省的调用次数
+        self.shared = 0
+    
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """执行调用，若已有相同键的调用在进行中则等待其结果"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key, None) if self._inflight.get(key) is t else None)
+            self.calls += 1
+        else:
+            self.shared += 1
+        # 单个调用者被取消时不影响其他等待同一结果的调用者
+        return await asyncio.shield(task)
+
+
+class MemberInfoBatcher:
+    """
+    群成员信息批量查询
+    
+    同一群在短时间窗口内的大量成员查询合并为一次get_group_member_list调用。
+    大群的成员列表远大于几次单独查询的返回，因此只有待查询的成员数达到
+    max(MIN_BATCH_SIZE, 已知群人数 * BATCH_RATIO)时才批量获取，否则并发调用get_group_member_info。
+    群成员名称的批量数据主要来自成员名录的预热，这里只处理名录中缺失的成员
+    """
+    
+    # 合并窗口(秒)
+    WINDOW = 0.005
+    # 批量获取所需的最少待查询成员数
+    MIN_BATCH_SIZE = 10
+    # 批量获取所需的待查询成员数占已知群人数的比例
+    BATCH_RATIO = 0.2
+    
+    def __init__(self):
+        # (客户端, 群号) -> {user_id: Future}
+        self._pending: Dict[tuple, Dict[str, asyncio.Future]] = {}
+        self._clients: Dict[tuple, Any] = {}
+        # 发起的批量调用次数
+        self.batches = 0
+        # 通过批量调用节省的调用次数
+        self.saved = 0
+    
+    async def get(self, client, group_id: int, user_id: str) -> Dict:
+        """获取群成员信息，返回成员信息字典，失败时返回空字典"""
+        key = (id(client), str(group_id))
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = {}
+            self._clients[key] = client
+            asyncio.get_running_loop().call_later(
+                self.WINDOW, lambda: asyncio.ensure_future(self._flush(key, group_id))
+            )
+        
+        user_id = str(user_id)
+        future = pending.get(user_id)
+        if future is None:
+            future = pending[user_id] = asyncio.get_running_loop().create_future()
+        return await asyncio.shield(future)
+    
+    async def _flush(self, key: tuple, group_id: int) -> None:
+        """窗口结束后发起实际的查询"""
+        pending = self._pending.pop(key, {})
+        client = self._clients.pop(key, None)
+        if not pending:
+            return
+        
+        members: Dict[str, Dict] = {}
+        try:
+            threshold = max(self.MIN_BATCH_SIZE, member_directory.known_size(group_id) * self.BATCH_RATIO)
+            if len(pending) < threshold:
+                responses = await asyncio.gather(
+                    *(APIClient.call_action(client, "get_group_member_info", group_id=group_id, user_id=user_id)
+                      for user_id in pending),
+                    return_exceptions=True
+                )
+                for user_id, response in zip(pending, responses):
+                    if isinstance(response, dict):
+                        members[user_id] = response
+                    elif isinstance(response, Exception):
+                        logger.error(f"获取群成员信息失败: {response}")
+            else:
+                response = await APIClient.call_action(client, "get_group_member_list", group_id=group_id)
+                self.batches += 1
+                self.saved += len(pending) - 1
+                if isinstance(response, list):
+                    for member in response:
+                        if isinstance(member, dict) and 'user_id' in member:
+                            members[str(member['user_id'])] = member
+                    # 顺便更新整个群的成员名录
+                    member_directory.observe_members(group_id, response)
+                logger.debug(f"群 {group_id} 的 {len(pending)} 个成员查询合并为一次批量调用")
+        except Exception as e:
+            logger.error(f"获取群成员信息失败: {e}")
+        
+        for user_id, future in pending.items():
+            if not future.done():
+                future.set_result(members.get(user_id, {}))
+
+
+class BotIdentityCache:
+    """
+    机器人登录信息缓存
+    
+    按客户端缓存get_login_info的结果，读取时从不等待网络请求：
+    缓存缺失或过期时在后台刷新，期间返回旧值或None；客户端重连时缓存失效
+    """
+    
+    # 登录信息的有效期(秒)
+    TTL = 24 * 3600
+    
+    def __init__(self):
+        # id(客户端) -> (登录信息, 获取时间)
+        self._identities: Dict[int, tuple] = {}
+        self._refresh_tasks: Dict[int, asyncio.Task] = {}
+        self._hooked = set()
+    
+    def get(self, client) -> Optional[Dict]:
+        """获取缓存的登录信息，必要时在后台刷新"""
+        key = id(client)
+        self._hook_reconnect(client)
+        entry = self._identities.get(key)
+        if entry is None or time.time() - entry[1] >= self.TTL:
+            self._schedule_refresh(client)
+        return entry[0] if entry else None
+    
+    def invalidate(self, client) -> None:
+        """使客户端的登录信息失效"""
+        self._identities.pop(id(client), None)
+    
+    async def refresh(self, client) -> Optional[Dict]:
+        """立即重新获取登录信息"""
+        response = await APIClient.get_login_info(client)
+        if isinstance(response, dict) and response.get('user_id'):
+            self._identities[id(client)] = (response, time.time())
+            logger.debug(f"已缓存机器人登录信息: {response.get('nickname')}({response.get('user_id')})")
+            return response
+        return None
+    
+    def _schedule_refresh(self, client) -> None:
+        key = id(client)
+        task = self._refresh_tasks.get(key)
+        if task is not None and not task.done():
+            return
+        self._refresh_tasks[key] = asyncio.ensure_future(self.refresh(client))
+    
+    def _hook_reconnect(self, client) -> None:
+        """注册连接建立回调，重连后重新获取登录信息"""
+        key = id(client)
+        if key in self._hooked:
+            return
+        self._hooked.add(key)
+        register = getattr(client, 'on_websocket_connection', None)
+        if not callable(register):
+            return
+        
+        async def _on_connect(_event):
+            logger.debug("检测到客户端重新连接，刷新机器人登录信息")
+            self.invalidate(client)
+            self._schedule_refresh(client)
+        
+        try:
+            register(_on_connect)
+        except Exception as e:
+            logger.debug(f"注册连接回调失败: {e}")
+
 
 class APIClient:
     """API调用的封装"""
     
+    # 各接口的实际调用次数
+    call_counts: Dict[str, int] = {}
+    _single_flight = SingleFlight()
+    _member_batcher = MemberInfoBatcher()
+    identity_cache = BotIdentityCache()
+    # 同时进行的合并转发获取请求数上限
+    _forward_semaphore = asyncio.Semaphore(4)
+    
+    @classmethod
+    async def call_action(cls, client, action: str, **params):
+        """调用OneBot接口并记录调用次数"""
+        cls.call_counts[action] = cls.call_counts.get(action, 0) + 1
+        with metrics.timer(f"api:{action}"):
+            return await client.api.call_action(action, **params)
+    
+    @classmethod
+    def get_stats(cls) -> Dict:
+        """获取API调用统计"""
+        return {
+            'calls': dict(cls.call_counts),
+            'single_flight_calls': cls._single_flight.calls,
+            'single_flight_saved': cls._single_flight.shared,
+            'member_batches': cls._member_batcher.batches,
+            'member_batch_saved': cls._member_batcher.saved,
+        }
+    
     @classmethod
     async def get_group_member_info(cls, client, group_id: int, user_id: str) -> str:
         """通过API获取群成员信息"""
         try:
-            response = await client.api.call_action(
-                "get_group_member_info",
-                group_id=group_id,
-                user_id=user_id
+            response = await cls._single_flight.do(
+                ('get_group_member_info', id(client), str(group_id), str(user_id)),
+                lambda: cls._member_batcher.get(client, group_id, user_id)
             )
             
             if isinstance(response, dict):
                 # 优先使用群名片,没有则使用昵称
                 name = response.get('card') or response.get('nickname')
                 if name:
-                    # 同时缓存用户信息
-                    name_cache.put(user_id, name)
+                    # 同时更新群成员名录
+                    member_directory.observe(group_id, user_id, name)
                     return name
                 return ''
             return ''
@@ -28,14 +236,41 @@ class APIClient:
             logger.error(f"获取群成员信息失败: {e}")
             return ''
     
+    @classmethod
+    async def get_group_member_list(cls, client, group_id: int) -> List[Dict]:
+        """通过API获取群成员列表"""
+        try:
+            response = await cls._single_flight.do(
+                ('get_group_member_list', id(client), str(group_id)),
+                lambda: cls.call_action(client, "get_group_member_list", group_id=group_id)
+            )
+            return response if isinstance(response, list) else []
+        except Exception as e:
+            logger.error(f"获取群 {group_id} 成员列表失败: {e}")
+            return []
+    
     @classmethod
     async def get_message_by_id(cls, client, message_id: str) -> Dict:
-        """通过API获取消息"""
+        """通过API获取消息，相同消息的并发请求只发起一次"""
+        cached = message_cache.get(str(message_id))
+        if cached is not None:
+            return cached
+        if message_cache.is_negative(str(message_id)):
+            return {}
+        return await cls._single_flight.do(
+            ('get_msg', id(client), str(message_id)),
+            lambda: cls._fetch_message_by_id(client, message_id)
+        )
+    
+    @classmethod
+    async def _fetch_message_by_id(cls, client, message_id: str) -> Dict:
+        """通过API获取消息(带重试)"""
         max_retries = 3
         for attempt in range(max_retries):
             try:
                 logger.debug(f"尝试通过API获取消息({attempt+1}/{max_retries}): {message_id}")
-                response = await client.api.call_action(
+                response = await cls.call_action(
+                    client,
                     "get_msg",
                     message_id=int(message_id)
                 )
@@ -48,19 +283,76 @@ class APIClient:
                 logger.warning(f"服务器连接断开，正在重试({attempt+1}/{max_retries}): {e}")
                 if attempt == max_retries - 1:
                     logger.error(f"获取消息最终失败: {message_id}")
-                    message_cache.put(str(message_id), {}, expire=60)  # 空缓存1分钟
+                    message_cache.put_negative(str(message_id), expire=60)  # 空缓存1分钟
                     return {}
                 await asyncio.sleep(2 ** attempt)
             except Exception as e:
                 logger.error(f"获取消息失败, ID: {message_id}, 错误类型: {type(e).__name__}, 详情: {e}")
-                message_cache.put(str(message_id), {}, expire=60)
+                message_cache.put_negative(str(message_id), expire=60)
                 return {}
         
+    @classmethod
+    async def get_forward_message(cls, client, forward_id: str) -> Dict:
+        """
+        通过API获取合并转发消息的内容，按转发ID缓存
+
+        转发ID全局唯一，同一合并转发被转发到多个群时只获取一次
+
+        Returns:
+            Dict: {'content': [子消息, ...]}，失败时返回空字典
+        """
+        forward_id = str(forward_id)
+        cached = forward_cache.get(forward_id)
+        if cached is not None:
+            return cached
+        if forward_cache.is_negative(forward_id):
+            return {}
+        return await cls._single_flight.do(
+            ('get_forward_msg', forward_id),
+            lambda: cls._fetch_forward_message(client, forward_id)
+        )
+    
+    @classmethod
+    async def _fetch_forward_message(cls, client, forward_id: str) -> Dict:
+        """通过API获取合并转发消息，限制并发数"""
+        try:
+            async with cls._forward_semaphore:
+                response = await cls.call_action(client, "get_forward_msg", id=forward_id)
+        except Exception as e:
+            logger.error(f"获取合并转发消息失败, ID: {forward_id}, 错误: {e}")
+            forward_cache.put_negative(forward_id, expire=60)
+            return {}
+        
+        # 不同的OneBot实现返回的字段名不同: messages/message，子消息内容在message或content中
+        messages = []
+        if isinstance(response, dict):
+            messages = response.get('messages') or response.get('message') or []
+        elif isinstance(response, list):
+            messages = response
+        content = []
+        for msg in messages:
+            if not isinstance(msg, dict):
+                continue
+            segments = msg.get('message')
+            if not isinstance(segments, list):
+                segments = msg.get('content') if isinstance(msg.get('content'), list) else []
+            content.append({
+                'sender': msg.get('sender', {}),
+                'time': msg.get('time', 0),
+                'message': segments,
+            })
+        
+        result = {'content': content}
+        forward_cache.put(forward_id, result)
+        logger.debug(f"获取合并转发消息成功, ID: {forward_id}, 共 {len(content)} 条子消息")
+        return result
+    
     @classmethod
     async def get_group_message_history(cls, client, group_id, count=20):
         """获取群消息历史"""
         try:
-            response = await client.api.call_action(
+            response = await cls.call_action(
+                client,
                 "get_group_msg_history",
                 group_id=group_id,
                 count=count
@@ -71,10 +363,15 @@ class APIClient:
             logger.error(f"获取群 {group_id} 消息历史失败: {str(e)}")
             return None 
     @classmethod
+    def get_cached_login_info(cls, client) -> Optional[Dict]:
+        """获取缓存的登录号信息，不等待网络请求，缓存缺失时返回None"""
+        return cls.identity_cache.get(client)
+    
+    @classmethod
     async def get_login_info(cls, client) -> list:
         """获取登录号信息"""
         try:
-            response = await client.api.call_action("get_login_info")
+            response = await cls.call_action(client, "get_login_info")
             return response           
         except Exception as e:
             logger.error(f"获取登录号信息失败: {str(e)}")
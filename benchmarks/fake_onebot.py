@@ -0,0 +1,52 @@
+"""
+离线的OneBot客户端替身，按固定种子生成接口返回数据，用于性能测试
+"""
+from typing import Dict
+import asyncio
+
+from synthetic import MessageGenerator
+
+
+class FakeOneBotAPI:
+    """模拟OneBot接口调用，记录各接口的调用次数"""
+
+    def __init__(self, generator: MessageGenerator, latency: float = 0.0):
+        """
+        Args:
+            generator: 合成消息生成器
+            latency: 每次接口调用模拟的网络延迟(秒)
+        """
+        self.generator = generator
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+
+    async def call_action(self, action: str, **params):
+        self.calls[action] = self.calls.get(action, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if action == 'get_msg':
+            return self.generator.raw_message(int(params['message_id']))
+        if action == 'get_group_member_info':
+            user_id = str(params['user_id'])
+            return {'user_id': user_id, 'nickname': f"用户{user_id}", 'card': f"群名片{user_id}"}
+        if action == 'get_group_member_list':
+            return [{'user_id': str(uid), 'nickname': f"用户{uid}", 'card': f"群名片{uid}"}
+                    for uid in self.generator.user_ids]
+        if action == 'get_forward_msg':
+            # "depth:N"形式的转发ID返回N层只带转发ID的嵌套合并转发
+            forward_id = str(params.get('id', ''))
+            depth = int(forward_id.split(':', 1)[1]) if forward_id.startswith('depth:') else 1
+            return {'messages': self.generator.forward_content(width=10, depth=depth, by_id=True)}
+        if action == 'get_login_info':
+            return {'user_id': '10000', 'nickname': '机器人'}
+        if action == 'get_group_msg_history':
+            return {'messages': [self.generator.raw_message() for _ in range(params.get('count', 20))]}
+        raise RuntimeError(f"不支持的接口: {action}")
+
+
+class FakeOneBotClient:
+    """与aiocqhttp客户端相同的调用方式: client.api.call_action(action, **params)"""
+
+    def __init__(self, generator: MessageGenerator, latency: float = 0.0):
+        self.api = FakeOneBotAPI(generator, latency)
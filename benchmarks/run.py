@@ -0,0 +1,319 @@
+"""
+SpectreCore 性能测试
+
+离线运行，使用合成消息和OneBot客户端替身，覆盖消息入库和提示词渲染的热点路径，
+结果以JSON输出，可用 --compare 与其他提交的结果比较
+
+用法:
+    python benchmarks/run.py [--output bench.json] [--compare baseline.json] [--filter 名称] [--quick]
+"""
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+import argparse
+import asyncio
+import importlib
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT = BENCH_DIR.parent
+sys.path.insert(0, str(BENCH_DIR))
+# 插件目录作为包导入，使插件内的相对导入可用
+sys.path.insert(0, str(ROOT.parent))
+
+from synthetic import MessageGenerator, SEGMENT_MIXES
+from fake_onebot import FakeOneBotClient
+
+SEED = 42
+GROUP_ID = 123456
+
+
+def plugin_module(name: str):
+    """导入插件的子模块"""
+    return importlib.import_module(f"{ROOT.name}.{name}")
+
+
+async def measure(fn: Callable[[], Awaitable], repeat: int, number: int,
+                  setup: Optional[Callable[[], Awaitable]] = None) -> Dict:
+    """
+    执行repeat轮，每轮调用fn number次，返回每次调用耗时(微秒)的统计
+
+    setup在每轮开始前执行，不计入耗时
+    """
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            await setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            await fn()
+        samples.append((time.perf_counter() - start) / number * 1e6)
+    samples.sort()
+    return {
+        'repeat': repeat,
+        'number': number,
+        'median_us': round(statistics.median(samples), 3),
+        'mean_us': round(statistics.fmean(samples), 3),
+        'min_us': round(samples[0], 3),
+        'max_us': round(samples[-1], 3),
+    }
+
+
+def clear_caches() -> None:
+    """清空插件的全局缓存，使每轮测试从相同状态开始"""
+    cache = plugin_module('cache')
+    for name in ('message_cache', 'quote_cache', 'forward_cache'):
+        getattr(cache, name).clear()
+    plugin_module('member_directory').member_directory.clear()
+
+
+async def bench_formatter(repeat: int) -> Dict[str, Dict]:
+    """MessageFormatter.process_group_message 在不同消息段组合下的耗时(每条消息)"""
+    formatter = plugin_module('message_formatter').MessageFormatter
+    results = {}
+    for mix in SEGMENT_MIXES:
+        generator = MessageGenerator(SEED)
+        client = FakeOneBotClient(generator)
+        batch = [generator.raw_message(mix=mix, segments=6) for _ in range(200)]
+
+        async def run():
+            for message in batch:
+                await formatter.process_group_message(message, batch, client, GROUP_ID)
+
+        async def setup():
+            clear_caches()
+
+        stats = await measure(run, repeat, 1, setup)
+        results[f"formatter/{mix}"] = per_item(stats, len(batch))
+    return results
+
+
+async def bench_forward(repeat: int) -> Dict[str, Dict]:
+    """ForwardProcessor 处理深层和大量子消息的合并转发"""
+    forward_processor = plugin_module('processors.forward_processor').ForwardProcessor
+    generator = MessageGenerator(SEED)
+    shapes = {
+        'deep': (3, 12),
+        'wide': (1000, 1),
+        'wide_nested': (40, 3),
+    }
+    results = {}
+    for name, (width, depth) in shapes.items():
+        data = {'content': generator.forward_content(width, depth)}
+
+        async def run():
+            await forward_processor.process_forward_message(data, {'nickname': '测试', 'user_id': 1}, 0)
+
+        results[f"forward/{name}"] = await measure(run, repeat, 5)
+
+    # 只带转发ID的3层嵌套合并转发，每次调用前清空缓存，包含3次get_forward_msg调用
+    client = FakeOneBotClient(generator)
+
+    async def run_by_id():
+        clear_caches()
+        data = {'id': 'depth:3'}
+        await forward_processor.process_forward_message(data, {'nickname': '测试', 'user_id': 1}, 0, client)
+
+    results["forward/by_id"] = await measure(run_by_id, repeat, 5)
+    return results
+
+
+async def bench_chat_history(repeat: int) -> Dict[str, Dict]:
+    """format_chat_history 在不同历史长度下的耗时，分为首次渲染和增量渲染"""
+    chat_formatter = plugin_module('utils.chat_formatter')
+    results = {}
+    for size in (100, 500, 2000):
+        for with_images in (False, True):
+            generator = MessageGenerator(SEED)
+            messages = [generator.stored_message(with_images) for _ in range(size)]
+            config = {'image_count': 4 if with_images else 0, 'read_air': True}
+            label = f"chat_history/{size}/{'images' if with_images else 'text'}"
+
+            async def run():
+                await chat_formatter.format_chat_history(messages, config, GROUP_ID)
+
+            async def cold():
+                chat_formatter._renderers.clear()
+
+            results[f"{label}/cold"] = await measure(run, repeat, 1, cold)
+            await cold()
+            await run()
+            results[f"{label}/warm"] = await measure(run, repeat, 5)
+    return results
+
+
+async def bench_should_reply(repeat: int) -> Dict[str, Dict]:
+    """should_reply 在大量关键词下的耗时(每条消息)，以及决策引擎的编译耗时"""
+    reply_decision = plugin_module('utils.reply_decision')
+    results = {}
+    for count in (10, 1000, 10000):
+        generator = MessageGenerator(SEED)
+        config = {'model_frequency': {'keywords': generator.keywords(count), 'method': '概率回复',
+                                      'probability': {'probability': 0.1}}}
+        contents = [generator._text(5, 40) for _ in range(500)]
+
+        async def compile_engine():
+            reply_decision.ReplyDecisionEngine(config)
+
+        results[f"should_reply/{count}/compile"] = await measure(compile_engine, repeat, 1)
+
+        async def run():
+            for content in contents:
+                reply_decision.should_reply(content, config, GROUP_ID)
+
+        await run()
+        results[f"should_reply/{count}"] = per_item(await measure(run, repeat, 1), len(contents))
+    return results
+
+
+async def bench_save_messages(repeat: int) -> Dict[str, Dict]:
+    """MessageProcessor.save_messages 在不同存储后端和历史大小下的耗时(首次载入 + 20条新消息 + 写入)"""
+    message_processor = plugin_module('message_processor').MessageProcessor
+    history_store = plugin_module('history_store').HistoryStore
+    storage = plugin_module('storage')
+    results = {}
+    for backend in ('jsonl', 'sqlite'):
+        config = {'storage_backend': backend}
+        for lines in (100, 1000, 10000):
+            generator = MessageGenerator(SEED)
+            client = FakeOneBotClient(generator)
+            existing = [generator.stored_message(True) for _ in range(lines)]
+            template_dir = Path(tempfile.mkdtemp(prefix='spectrecore_bench_'))
+            template = storage.create_storage(config, str(template_dir))
+            await template.open(GROUP_ID).append(existing)
+            await template.close()
+            work_dir = Path(tempfile.mkdtemp(prefix='spectrecore_bench_'))
+            state = {}
+
+            async def setup():
+                clear_caches()
+                shutil.rmtree(work_dir, ignore_errors=True)
+                shutil.copytree(template_dir, work_dir)
+                state['store'] = history_store(str(work_dir), max_history=100, flush_delay=3600,
+                                               storage=storage.create_storage(config, str(work_dir)))
+                state['batch'] = [generator.raw_message() for _ in range(20)]
+
+            async def run():
+                store = state['store']
+                await message_processor.save_messages(GROUP_ID, state['batch'], store, client)
+                await store.close()
+
+            # 默认后端沿用原来的名称，便于与之前的结果比较
+            label = f"save_messages/{lines}" if backend == 'jsonl' else f"save_messages/{backend}/{lines}"
+            try:
+                results[label] = await measure(run, repeat, 1, setup)
+            finally:
+                shutil.rmtree(template_dir, ignore_errors=True)
+                shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+async def bench_codec(repeat: int) -> Dict[str, Dict]:
+    """各消息存储格式编码和解码1000条已存储消息的耗时(每条消息)及编码后的大小"""
+    codec_module = plugin_module('storage.codec')
+    generator = MessageGenerator(SEED)
+    records = [generator.stored_message(True) for _ in range(1000)]
+    codecs = {'json': codec_module.JsonCodec()}
+    if codec_module.MSGPACK_AVAILABLE:
+        codecs['msgpack'] = codec_module.MsgpackCodec()
+    results = {}
+    for name, codec in codecs.items():
+        data = codec.encode_stream(records)
+
+        async def encode():
+            codec.encode_stream(records)
+
+        async def decode():
+            list(codec.decode_stream(data))
+
+        for label, fn in (('encode', encode), ('decode', decode)):
+            stats = per_item(await measure(fn, repeat, 1), len(records))
+            stats['bytes'] = len(data)
+            results[f"codec/{name}/{label}"] = stats
+    return results
+
+
+def per_item(stats: Dict, items: int) -> Dict:
+    """将每轮耗时换算为每项耗时"""
+    converted = dict(stats)
+    for key in ('median_us', 'mean_us', 'min_us', 'max_us'):
+        converted[key] = round(stats[key] / items, 3)
+    converted['items'] = items
+    return converted
+
+
+SUITES = {
+    'formatter': bench_formatter,
+    'forward': bench_forward,
+    'chat_history': bench_chat_history,
+    'should_reply': bench_should_reply,
+    'save_messages': bench_save_messages,
+    'codec': bench_codec,
+}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return 'unknown'
+
+
+def compare(current: Dict, baseline: Dict) -> List[str]:
+    """与基准结果比较中位数耗时"""
+    lines = [f"{'名称':<40} {'基准(us)':>12} {'当前(us)':>12} {'变化':>8}"]
+    for name, stats in current['results'].items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        ratio = stats['median_us'] / base['median_us'] if base['median_us'] else float('inf')
+        lines.append(f"{name:<40} {base['median_us']:>12.1f} {stats['median_us']:>12.1f} {ratio:>7.2f}x")
+    return lines
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description='SpectreCore 性能测试')
+    parser.add_argument('--output', help='结果JSON的输出文件，默认输出到标准输出')
+    parser.add_argument('--compare', help='用于比较的基准结果JSON文件')
+    parser.add_argument('--filter', default='', help='只运行名称包含该字符串的测试组')
+    parser.add_argument('--quick', action='store_true', help='减少重复次数，快速检查')
+    args = parser.parse_args()
+
+    repeat = 3 if args.quick else 10
+    results = {}
+    for name, suite in SUITES.items():
+        if args.filter in name:
+            print(f"运行 {name} ...", file=sys.stderr)
+            results.update(await suite(repeat))
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'seed': SEED,
+            'repeat': repeat,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': int(time.time()),
+        },
+        'results': results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(output, encoding='utf-8')
+    else:
+        print(output)
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding='utf-8'))
+        print('\n'.join(compare(report, baseline)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,115 @@
+"""
+合成消息生成器，相同的种子总是生成相同的消息，便于在不同提交之间比较结果
+"""
+from typing import Dict, List, Optional
+import random
+import time
+
+# 消息段组合: 名称 -> (消息段类型, 权重)列表
+SEGMENT_MIXES = {
+    'text': [('text', 1)],
+    'chat': [('text', 8), ('face', 2), ('image', 1), ('at', 1)],
+    'media': [('text', 2), ('image', 4), ('face', 2), ('dice', 1), ('rps', 1)],
+    'social': [('text', 4), ('at', 3), ('reply', 2), ('face', 1)],
+}
+
+WORDS = ["今天", "天气", "不错", "哈哈哈", "吃饭", "了吗", "这个", "表情包", "笑死", "真的假的",
+         "hello", "world", "bug", "上线", "周末", "打游戏", "有人", "在吗", "图片", "转发"]
+
+
+class MessageGenerator:
+    """按固定种子生成OneBot格式的原始消息和插件格式的已存储消息"""
+
+    def __init__(self, seed: int = 42, users: int = 50, base_time: int = 1700000000):
+        self.rng = random.Random(seed)
+        self.user_ids = [10000 + i for i in range(users)]
+        self.base_time = base_time
+        self._next_id = 1
+
+    def _text(self, min_words: int = 1, max_words: int = 12) -> str:
+        return ''.join(self.rng.choice(WORDS) for _ in range(self.rng.randint(min_words, max_words)))
+
+    def _segment(self, seg_type: str, message_id: int) -> Dict:
+        if seg_type == 'text':
+            return {'type': 'text', 'data': {'text': self._text()}}
+        if seg_type == 'face':
+            return {'type': 'face', 'data': {'id': '14', 'raw': {'faceText': '[微笑]'}}}
+        if seg_type == 'image':
+            n = self.rng.randrange(1 << 30)
+            return {'type': 'image', 'data': {'url': f"https://example.invalid/img/{n}.jpg",
+                                              'file': f"{n}.jpg", 'file_size': str(self.rng.randint(10_000, 2_000_000))}}
+        if seg_type == 'at':
+            return {'type': 'at', 'data': {'qq': str(self.rng.choice(self.user_ids))}}
+        if seg_type == 'reply':
+            # 引用最近的一条消息
+            return {'type': 'reply', 'data': {'id': str(max(1, message_id - self.rng.randint(1, 20)))}}
+        if seg_type == 'dice':
+            return {'type': 'dice', 'data': {'result': str(self.rng.randint(1, 6))}}
+        if seg_type == 'rps':
+            return {'type': 'rps', 'data': {'result': str(self.rng.randint(1, 3))}}
+        raise ValueError(seg_type)
+
+    def raw_message(self, message_id: Optional[int] = None, mix: str = 'chat', segments: int = 3) -> Dict:
+        """生成一条OneBot格式的群消息"""
+        if message_id is None:
+            message_id = self._next_id
+            self._next_id += 1
+        kinds, weights = zip(*SEGMENT_MIXES[mix])
+        user_id = self.rng.choice(self.user_ids)
+        return {
+            'message_id': message_id,
+            'time': self.base_time + message_id,
+            'sender': {'user_id': user_id, 'nickname': f"用户{user_id}", 'card': ''},
+            'message': [self._segment(kind, message_id)
+                        for kind in self.rng.choices(kinds, weights, k=self.rng.randint(1, segments))],
+        }
+
+    def forward_content(self, width: int, depth: int, by_id: bool = False) -> List[Dict]:
+        """
+        生成合并转发的子消息，每层width条，最后一条嵌套下一层
+
+        by_id为True时嵌套的下一层只带转发ID("depth:层数")，内容需要通过get_forward_msg获取
+        """
+        content = []
+        for i in range(width):
+            user_id = self.rng.choice(self.user_ids)
+            message = [{'type': 'text', 'data': {'text': self._text()}}]
+            if depth > 1 and i == width - 1:
+                if by_id:
+                    nested = {'id': f"depth:{depth - 1}"}
+                else:
+                    nested = {'content': self.forward_content(width, depth - 1)}
+                message.append({'type': 'forward', 'data': nested})
+            content.append({'sender': {'user_id': user_id, 'nickname': f"用户{user_id}"},
+                            'time': self.base_time + i, 'message': message})
+        return content
+
+    def forward_message(self, width: int, depth: int) -> Dict:
+        """生成一条合并转发消息"""
+        message = self.raw_message(mix='text', segments=1)
+        message['message'] = [{'type': 'forward', 'data': {'content': self.forward_content(width, depth)}}]
+        return message
+
+    def stored_message(self, with_images: bool = False) -> Dict:
+        """生成一条插件格式的已存储消息"""
+        message_id = self._next_id
+        self._next_id += 1
+        user_id = self.rng.choice(self.user_ids)
+        resources = []
+        content = self._text()
+        if with_images and self.rng.random() < 0.3:
+            for _ in range(self.rng.randint(1, 2)):
+                n = self.rng.randrange(1 << 30)
+                resources.append({'type': 'image', 'url': f"https://example.invalid/img/{n}.jpg", 'summary': ''})
+                content = '[图片]' + content
+        return {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.base_time + message_id)),
+            'sender': f"用户{user_id}(id:{user_id})",
+            'content': content,
+            'resources': resources,
+            'message_id': message_id,
+        }
+
+    def keywords(self, count: int) -> List[str]:
+        """生成关键词列表"""
+        return [f"关键词{i}{self.rng.choice(WORDS)}" for i in range(count)]
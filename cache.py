@@ -1,29 +1,176 @@
 from collections import OrderedDict
-from typing import Any
-class LRUCache:
-    def __init__(self, capacity: int = 500):
+from typing import Any, Dict, Hashable, Optional
+import sys
+import time
+
+
+def estimate_size(value: Any, _depth: int = 0) -> int:
+    """粗略估算对象占用的字节数"""
+    if isinstance(value, str):
+        return 49 + len(value)
+    if isinstance(value, (bytes, bytearray)):
+        return 33 + len(value)
+    if _depth > 8:
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            estimate_size(k, _depth + 1) + estimate_size(v, _depth + 1) for k, v in value.items()
+        )
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(estimate_size(v, _depth + 1) for v in value)
+    return sys.getsizeof(value)
+
+
+class TTLCache:
+    """
+    带过期时间的LRU缓存
+    
+    主要功能:
+    1. 每个条目可单独设置过期时间，读取时惰性过期，并定期批量清理
+    2. 支持缓存"查询结果为空"，避免反复请求不存在的数据
+    3. 同时按条目数量和估算字节数限制容量，超出时淘汰最久未使用的条目
+    4. 统计命中、未命中、淘汰和过期次数
+    """
+    
+    # 空结果的占位值
+    _NEGATIVE = object()
+    
+    def __init__(self, capacity: int = 500, max_bytes: int = 0,
+                 default_ttl: Optional[float] = None, purge_interval: float = 60):
+        """
+        Args:
+            capacity: 最大条目数
+            max_bytes: 最大估算字节数，0表示不限制
+            default_ttl: 默认过期秒数，None表示不过期
+            purge_interval: 定期清理过期条目的间隔秒数
+        """
         self.capacity = capacity
-        self._cache = OrderedDict()
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.purge_interval = purge_interval
+        # key -> (value, 过期时间戳, 估算字节数)
+        self._cache: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._last_purge = time.monotonic()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
 
-    def get(self, key: str) -> Any:
-        if key not in self._cache:
+    def _lookup(self, key: Hashable):
+        """查找未过期的条目，过期条目在此处惰性删除"""
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
             return None
         self._cache.move_to_end(key)
-        return self._cache[key]
+        return entry
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """获取缓存值，不存在、已过期或为空结果时返回default"""
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry[0] is self._NEGATIVE:
+            self.negative_hits += 1
+            return default
+        self.hits += 1
+        return entry[0]
+
+    def is_negative(self, key: Hashable) -> bool:
+        """是否缓存了该键的空结果"""
+        entry = self._lookup(key)
+        return entry is not None and entry[0] is self._NEGATIVE
+
+    def put(self, key: Hashable, value: Any, expire: Optional[float] = None) -> None:
+        """
+        写入缓存
+        
+        Args:
+            key: 键
+            value: 值
+            expire: 过期秒数，None时使用默认过期时间
+        """
+        ttl = self.default_ttl if expire is None else expire
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        size = 64 if value is self._NEGATIVE else estimate_size(value)
 
-    def put(self, key: str, value: Any) -> None:
         if key in self._cache:
-            self._cache.move_to_end(key)
-        self._cache[key] = value
-        if len(self._cache) > self.capacity:
-            self._cache.popitem(last=False)
+            self._remove(key)
+        self._cache[key] = (value, expires_at, size)
+        self._bytes += size
+        self._maybe_purge()
+        self._enforce_limits()
+
+    def put_negative(self, key: Hashable, expire: Optional[float] = None) -> None:
+        """缓存空结果，在过期前不再重复查询"""
+        self.put(key, self._NEGATIVE, expire)
+
+    def delete(self, key: Hashable) -> None:
+        """删除条目"""
+        if key in self._cache:
+            self._remove(key)
+
+    def purge_expired(self) -> int:
+        """清理所有已过期的条目，返回清理数量"""
+        now = time.monotonic()
+        self._last_purge = now
+        expired = [k for k, entry in self._cache.items() if entry[1] is not None and entry[1] <= now]
+        for key in expired:
+            self._remove(key)
+        self.expirations += len(expired)
+        return len(expired)
+
+    def clear(self) -> None:
+        """清空缓存"""
+        self._cache.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """获取缓存统计信息"""
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            'entries': len(self._cache),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_rate': (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+        }
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self._cache.pop(key)
+        self._bytes -= entry[2]
+
+    def _maybe_purge(self) -> None:
+        if time.monotonic() - self._last_purge >= self.purge_interval:
+            self.purge_expired()
+
+    def _enforce_limits(self) -> None:
+        while self._cache and (
+            len(self._cache) > self.capacity
+            or (self.max_bytes and self._bytes > self.max_bytes)
+        ):
+            key = next(iter(self._cache))
+            self._remove(key)
+            self.evictions += 1
 
-    def __contains__(self, key: str) -> bool:
-        return key in self._cache
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._lookup(key)
+        return entry is not None and entry[0] is not self._NEGATIVE
 
     def __len__(self) -> int:
         return len(self._cache)
 
 # 全局缓存实例
-name_cache = LRUCache(200)  # 用户名缓存
-message_cache = LRUCache(100)  # 消息缓存
\ No newline at end of file
+name_cache = TTLCache(2000, default_ttl=3600)  # 用户名缓存
+message_cache = TTLCache(2000, max_bytes=8 * 1024 * 1024, default_ttl=300)  # 消息缓存
+quote_cache = TTLCache(2000, max_bytes=2 * 1024 * 1024, default_ttl=3600)  # 引用链渲染结果缓存
+forward_cache = TTLCache(500, max_bytes=8 * 1024 * 1024, default_ttl=1800)  # 合并转发内容缓存(按转发ID)
\ No newline at end of file
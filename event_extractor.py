@@ -0,0 +1,117 @@
+from typing import Dict, List, Optional
+import time
+from astrbot.api.all import logger
+from astrbot.api.message_components import Plain, Image, At, Reply, Face
+
+
+class EventExtractor:
+    """
+    事件消息提取器：直接从事件中构建OneBot格式的消息数据
+
+    主要功能:
+    1. 从收到消息事件的原始数据中提取消息，无需再调用消息历史API
+    2. 将机器人发送的消息链转换为OneBot消息段
+    """
+
+    @classmethod
+    def extract_incoming_message(cls, event) -> Optional[Dict]:
+        """
+        从收到的群消息事件中提取OneBot格式的消息数据
+
+        Returns:
+            Optional[Dict]: 消息数据，原始数据不完整时返回None
+        """
+        raw = getattr(event.message_obj, 'raw_message', None)
+        if not isinstance(raw, dict):
+            return None
+
+        message = raw.get('message')
+        sender = raw.get('sender')
+        # 字符串格式(CQ码)的消息无法直接使用
+        if not isinstance(message, list) or not isinstance(sender, dict) or 'user_id' not in sender:
+            return None
+
+        return {
+            'message_id': raw.get('message_id'),
+            'time': raw.get('time') or int(time.time()),
+            'sender': {
+                'user_id': sender['user_id'],
+                'nickname': sender.get('nickname', ''),
+                'card': sender.get('card', ''),
+            },
+            'message': message,
+        }
+
+    @classmethod
+    def extract_sent_message(cls, event, sender: Dict) -> Optional[Dict]:
+        """
+        从机器人发送的消息链中构建OneBot格式的消息数据
+
+        Args:
+            event: 消息事件
+            sender: 机器人的发送者信息，包含user_id和nickname
+
+        Returns:
+            Optional[Dict]: 消息数据，没有可保存的内容时返回None
+        """
+        result = event.get_result()
+        chain = getattr(result, 'chain', None) if result else None
+        if not chain:
+            return None
+
+        segments = cls.chain_to_segments(chain)
+        if not segments:
+            return None
+
+        return {
+            # 发送接口不返回消息ID，无法用于去重
+            'message_id': None,
+            'time': int(time.time()),
+            'sender': sender,
+            'message': segments,
+        }
+
+    @classmethod
+    def mentions_bot(cls, event) -> bool:
+        """消息是否直接@了机器人"""
+        self_id = str(event.get_self_id())
+        for comp in getattr(event.message_obj, 'message', None) or []:
+            if isinstance(comp, At) and str(comp.qq) == self_id:
+                return True
+        return False
+
+    @staticmethod
+    def _image_url(comp) -> str:
+        """获取图片组件的http(s)地址，没有时返回空字符串"""
+        for value in (comp.url, comp.file):
+            if isinstance(value, str) and value.startswith(('http://', 'https://')):
+                return value
+        return ''
+
+    @classmethod
+    def chain_to_segments(cls, chain: List) -> List[Dict]:
+        """将AstrBot消息链转换为OneBot消息段"""
+        segments = []
+        for comp in chain:
+            try:
+                if isinstance(comp, Plain):
+                    if comp.text:
+                        segments.append({'type': 'text', 'data': {'text': comp.text}})
+                elif isinstance(comp, Image):
+                    url = cls._image_url(comp)
+                    if url:
+                        segments.append({'type': 'image', 'data': {'url': url, 'file': ''}})
+                    else:
+                        # base64或本地文件的图片无法提供给大模型，且会使记录过大，只保留文本占位
+                        segments.append({'type': 'text', 'data': {'text': '[图片]'}})
+                elif isinstance(comp, At):
+                    segments.append({'type': 'at', 'data': {'qq': str(comp.qq)}})
+                elif isinstance(comp, Reply):
+                    segments.append({'type': 'reply', 'data': {'id': str(comp.id)}})
+                elif isinstance(comp, Face):
+                    segments.append({'type': 'face', 'data': {'id': str(comp.id)}})
+                else:
+                    segments.append(comp.toDict())
+            except Exception as e:
+                logger.debug(f"转换消息链组件失败: {str(e)}")
+        return segments
@@ -0,0 +1,383 @@
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional
+import asyncio
+from astrbot.api.all import logger
+
+from .storage import GroupLog, JsonlStorage, MessageStorage
+from .metrics import metrics
+from .utils.image_hash import pick_images
+
+
+class GroupHistory:
+    """
+    单个群的常驻消息历史
+
+    以有界双端队列保存最近的消息，是消息入库、回复判断和提示词渲染的唯一数据来源；
+    同时维护消息ID、发送者名称和图片资源索引，解析引用、@和选择图片时无需遍历整个历史
+    """
+
+    # 建立索引的资源类型(QQ表情和贴纸以文字形式呈现，不输入给大模型)
+    INDEXED_KINDS = ('image',)
+
+    def __init__(self, group_id, max_history: int = 100,
+                 lookup: Optional[Callable[[str], Awaitable[Optional[Dict]]]] = None):
+        """
+        Args:
+            group_id: 群号
+            max_history: 保留的消息数量
+            lookup: 按消息ID查找已移出内存的较早消息，通常查询存储后端
+        """
+        self.group_id = group_id
+        self.lookup = lookup
+        self.messages = deque(maxlen=max(1, int(max_history)))
+        # 消息ID(字符串) -> 消息记录
+        self.records: Dict[str, Dict] = {}
+        # 用户ID -> 最近一次发言时的名称，不随消息淘汰
+        self.names: Dict[str, str] = {}
+        # 图片资源索引(从早到晚): {'seq': 消息序号, 'res_idx': 资源下标, 'url': 图片地址, 'kind': 资源类型,
+        # 'resource': 资源本身，后台计算的感知哈希写入其'phash'字段}
+        self.images = deque()
+        # messages[0]的消息序号，消息序号在加入时单调递增分配
+        self._first_seq = 0
+
+    def add(self, message: Dict) -> bool:
+        """
+        添加一条消息，按消息ID去重
+
+        Returns:
+            bool: 是否实际添加
+        """
+        message_id = message.get('message_id')
+        if message_id is not None and str(message_id) in self.records:
+            logger.debug(f"消息已存在(ID:{message_id})，跳过")
+            return False
+
+        seq = self._first_seq + len(self.messages)
+        # 队列已满时，最旧的消息会被挤出，同步移除其ID和图片索引
+        if len(self.messages) == self.messages.maxlen:
+            evicted_id = self.messages[0].get('message_id')
+            if evicted_id is not None:
+                self.records.pop(str(evicted_id), None)
+            self._first_seq += 1
+            while self.images and self.images[0]['seq'] < self._first_seq:
+                self.images.popleft()
+
+        self.messages.append(message)
+        if message_id is not None:
+            self.records[str(message_id)] = message
+        self._observe_sender(message.get('sender'))
+        for res_idx, resource in enumerate(message.get('resources') or []):
+            if resource.get('type') in self.INDEXED_KINDS and resource.get('url'):
+                self.images.append({'seq': seq, 'res_idx': res_idx, 'url': resource['url'],
+                                    'kind': resource['type'], 'resource': resource})
+        return True
+
+    def _observe_sender(self, sender) -> None:
+        """从"昵称(id:QQ号)"格式的发送者中记录用户名称"""
+        if not isinstance(sender, str) or not sender.endswith(')'):
+            return
+        name, sep, user_id = sender[:-1].rpartition('(id:')
+        if sep and name and user_id:
+            self.names[user_id] = name
+
+    def get(self, message_id) -> Optional[Dict]:
+        """按消息ID查找历史中的消息记录"""
+        if message_id is None:
+            return None
+        return self.records.get(str(message_id))
+
+    def get_name(self, user_id) -> str:
+        """按用户ID查找历史中记录的用户名称，未找到返回空字符串"""
+        return self.names.get(str(user_id), '')
+
+    def extend(self, messages: List[Dict]) -> None:
+        """批量添加消息(用于从文件加载)"""
+        for message in messages:
+            self.add(message)
+
+    def latest(self) -> Optional[Dict]:
+        """获取最新一条消息"""
+        return self.messages[-1] if self.messages else None
+
+    def snapshot(self) -> List[Dict]:
+        """获取当前消息列表的快照"""
+        return list(self.messages)
+
+    def select_images(self, count: Optional[int] = None, start: int = 0,
+                      max_distance: Optional[int] = None) -> List[Dict]:
+        """
+        从图片索引中选择最新的图片，只需访问被选中的条目
+
+        Args:
+            count: 最多选择的不同图片数量，None表示全部
+            start: 只选择位于消息快照第start条及之后的图片
+            max_distance: 感知哈希判定为重复的最大汉明距离，None表示不去重
+
+        Returns:
+            List[Dict]: 选中的图片(从早到晚)，'index'为所在消息在快照中的位置，
+            'number'为图片编号，重复的图片共用编号
+        """
+        min_seq = self._first_seq + start
+
+        def candidates():
+            for ref in reversed(self.images):
+                if ref['seq'] < min_seq:
+                    return
+                yield {'index': ref['seq'] - self._first_seq, 'res_idx': ref['res_idx'], 'url': ref['url'],
+                       'kind': ref['kind'], 'phash': ref['resource'].get('phash')}
+
+        return pick_images(candidates(), count, max_distance)
+
+    def clear(self) -> None:
+        """清空消息历史"""
+        self.messages.clear()
+        self.records.clear()
+        self.names.clear()
+        self.images.clear()
+        self._first_seq = 0
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+
+class HistoryStore:
+    """
+    群消息历史存储：常驻内存 + 延迟写回
+
+    主要功能:
+    1. 按群号维护常驻内存的消息历史，首次访问时从日志末尾加载
+    2. 新消息先进入待写缓冲，延迟定时器触发后以追加方式写入日志
+    3. 存储需要压缩时(如日志超过历史上限一定倍数)，在后台压缩
+    4. 同一群的消息入库和文件写入分别串行执行，避免并发丢失消息
+    5. 插件卸载时将所有未写入的变更刷新到磁盘
+    6. 日志的实际存储由可替换的存储后端负责，默认每个群一个JSON Lines文件
+    """
+
+    # 变更后延迟写入文件的秒数
+    FLUSH_DELAY = 5.0
+
+    def __init__(self, base_path: str, max_history: int = 100, flush_delay: float = None,
+                 on_message_added: Optional[Callable[[Dict, Callable[[], None]], None]] = None,
+                 storage: Optional[MessageStorage] = None):
+        """
+        Args:
+            base_path: 日志文件目录
+            max_history: 每个群保留的消息数量
+            flush_delay: 延迟写入的秒数
+            on_message_added: 消息进入内存历史(新入库或从日志载入)后的回调，如在后台计算图片哈希；
+                参数为(消息, 通知函数)，回调修改了消息记录后调用通知函数，使修改被写回日志
+            storage: 存储后端，为None时使用base_path下的JSON Lines文件
+        """
+        self.base_path = base_path
+        self.storage = storage if storage is not None else JsonlStorage(base_path)
+        self.on_message_added = on_message_added
+        self.max_history = max_history
+        self.flush_delay = self.FLUSH_DELAY if flush_delay is None else flush_delay
+        self._histories: Dict[str, GroupHistory] = {}
+        self._logs: Dict[str, GroupLog] = {}
+        self._pending: Dict[str, List[Dict]] = {}
+        self._load_locks: Dict[str, asyncio.Lock] = {}
+        self._ingest_locks: Dict[str, asyncio.Lock] = {}
+        self._write_locks: Dict[str, asyncio.Lock] = {}
+        self._flush_tasks: Dict[str, asyncio.Task] = {}
+        # 群号 -> 已写入存储后被修改过的记录，下次写入时更新
+        self._modified: Dict[str, List[Dict]] = {}
+        self._compact_tasks: Dict[str, asyncio.Task] = {}
+
+    def _get_log(self, key: str) -> GroupLog:
+        log = self._logs.get(key)
+        if log is None:
+            log = self._logs[key] = self.storage.open(key)
+        return log
+
+    def ingest_lock(self, group_id) -> asyncio.Lock:
+        """获取群消息入库锁，保证同一群的消息按顺序处理"""
+        return self._ingest_locks.setdefault(str(group_id), asyncio.Lock())
+
+    def _write_lock(self, key: str) -> asyncio.Lock:
+        return self._write_locks.setdefault(key, asyncio.Lock())
+
+    async def get(self, group_id) -> GroupHistory:
+        """获取群消息历史，不存在时从日志加载"""
+        key = str(group_id)
+        history = self._histories.get(key)
+        if history is not None:
+            return history
+
+        lock = self._load_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            history = self._histories.get(key)
+            if history is None:
+                history = GroupHistory(group_id, self.max_history,
+                                       lookup=lambda message_id: self.find_message(key, message_id))
+                log = self._get_log(key)
+                async with self._write_lock(key):
+                    with metrics.timer('file_read'):
+                        history.extend(await log.read_tail(self.max_history))
+                self._histories[key] = history
+                logger.debug(f"群 {group_id} 的消息历史已载入内存，共 {len(history)} 条")
+                for message in history.snapshot():
+                    self._notify_added(history, message)
+                if log.needs_compaction(self.max_history):
+                    self._schedule_compaction(key)
+        return history
+
+    async def find_message(self, group_id, message_id) -> Optional[Dict]:
+        """按消息ID查找消息，内存中没有时查询待写缓冲和存储后端中较早的消息"""
+        key = str(group_id)
+        history = self._histories.get(key)
+        if history is not None:
+            record = history.get(message_id)
+            if record is not None:
+                return record
+        message_id = str(message_id)
+        for record in self._pending.get(key, ()):
+            if str(record.get('message_id')) == message_id:
+                return record
+        return await self._get_log(key).get_message(message_id)
+
+    def add(self, history: GroupHistory, message: Dict) -> bool:
+        """
+        添加一条消息到群消息历史，并在延迟后追加到日志
+
+        Returns:
+            bool: 是否实际添加
+        """
+        if not history.add(message):
+            return False
+        key = str(history.group_id)
+        self._pending.setdefault(key, []).append(message)
+        self._notify_added(history, message)
+        self._schedule_flush(key)
+        return True
+
+    def _notify_added(self, history: GroupHistory, message: Dict) -> None:
+        if self.on_message_added is None:
+            return
+        try:
+            self.on_message_added(message, lambda: self._record_updated(history, message))
+        except Exception as e:
+            logger.error(f"处理新入库消息的回调出错: {str(e)}")
+
+    def _record_updated(self, history: GroupHistory, message: Dict) -> None:
+        """消息记录被修改后调用，已写入存储的记录在延迟后更新"""
+        key = str(history.group_id)
+        if self._histories.get(key) is not history:
+            # 历史已被重置
+            return
+        if any(pending is message for pending in self._pending.get(key, ())):
+            # 尚未写入的记录写入时自然包含修改
+            return
+        if not any(record is message for record in history.messages):
+            # 已移出内存历史，随下次压缩丢弃
+            return
+        modified = self._modified.setdefault(key, [])
+        if not any(record is message for record in modified):
+            modified.append(message)
+        self._schedule_flush(key)
+
+    def _schedule_flush(self, key: str) -> None:
+        task = self._flush_tasks.get(key)
+        if task is not None and not task.done():
+            return
+        self._flush_tasks[key] = asyncio.create_task(self._delayed_flush(key))
+
+    async def _delayed_flush(self, key: str) -> None:
+        try:
+            await asyncio.sleep(self.flush_delay)
+        except asyncio.CancelledError:
+            return
+        self._flush_tasks.pop(key, None)
+        await self.flush(key)
+
+    async def flush(self, group_id) -> bool:
+        """立即将待写入的消息追加到存储，并更新已写入后被修改的记录"""
+        key = str(group_id)
+        async with self._write_lock(key):
+            pending = self._pending.pop(key, None)
+            modified = self._modified.pop(key, None)
+            log = self._get_log(key)
+            if pending:
+                with metrics.timer('file_append'):
+                    appended = await log.append(pending)
+                if not appended:
+                    # 写入失败时放回缓冲，等待下次写入
+                    self._pending.setdefault(key, [])[:0] = pending
+                    if modified:
+                        self._modified.setdefault(key, [])[:0] = modified
+                    return False
+            if modified:
+                with metrics.timer('file_update'):
+                    updated = await log.update(modified)
+                if not updated:
+                    self._modified.setdefault(key, [])[:0] = modified
+                    return False
+
+        if log.needs_compaction(self.max_history):
+            self._schedule_compaction(key)
+        return True
+
+    def _schedule_compaction(self, key: str) -> None:
+        task = self._compact_tasks.get(key)
+        if task is not None and not task.done():
+            return
+        self._compact_tasks[key] = asyncio.create_task(self.compact(key))
+
+    async def compact(self, group_id) -> bool:
+        """压缩存储，如将日志原子地重写为内存中最新的消息历史"""
+        key = str(group_id)
+        history = self._histories.get(key)
+        if history is None:
+            return True
+        async with self._write_lock(key):
+            # 待写入的消息在压缩时一并写入，清空缓冲避免重复追加
+            records = history.snapshot()
+            pending = self._pending.pop(key, None)
+            with metrics.timer('file_compact'):
+                compacted = await self._get_log(key).compact(records, pending or ())
+            if not compacted:
+                if pending:
+                    self._pending.setdefault(key, [])[:0] = pending
+                return False
+            return True
+
+    async def flush_all(self) -> None:
+        """将所有群的待写入消息写入日志"""
+        for key in list(self._flush_tasks):
+            task = self._flush_tasks.pop(key)
+            task.cancel()
+        for key in set(self._pending) | set(self._modified):
+            await self.flush(key)
+        for task in list(self._compact_tasks.values()):
+            if not task.done():
+                await task
+
+    async def close(self) -> None:
+        """插件卸载时调用，写入所有未保存的变更"""
+        await self.flush_all()
+        await self.storage.close()
+        logger.debug("消息历史已全部写入磁盘")
+
+    async def reset(self, group_id) -> bool:
+        """
+        清空群消息历史并删除日志文件
+
+        Returns:
+            bool: 是否存在可清除的记录
+        """
+        key = str(group_id)
+        for tasks in (self._flush_tasks, self._compact_tasks):
+            task = tasks.pop(key, None)
+            if task is not None:
+                task.cancel()
+
+        async with self._write_lock(key):
+            existed = False
+            self._pending.pop(key, None)
+            self._modified.pop(key, None)
+            history = self._histories.pop(key, None)
+            if history is not None and len(history):
+                existed = True
+            if await self._get_log(key).delete():
+                existed = True
+        return existed
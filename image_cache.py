@@ -0,0 +1,343 @@
+from collections import OrderedDict
+from io import BytesIO
+from typing import Callable, Dict, List, Optional, Tuple
+import asyncio
+import hashlib
+import os
+import tempfile
+import aiofiles
+import aiohttp
+from astrbot.api.all import logger
+
+from .api_client import SingleFlight
+from .cache import TTLCache
+from .utils.token_counter import estimate_image_tokens
+from .utils.image_hash import dhash
+
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+
+class ImageCache:
+    """
+    图片本地缓存
+
+    主要功能:
+    1. 每张图片只下载一次，同一URL的并发请求共享同一次下载
+    2. 使用Pillow缩小尺寸并重新编码为JPEG(未安装Pillow时保存原图)
+    3. 以内容哈希命名保存到磁盘，内容相同的图片只保存一份
+    4. 缓存总大小超过上限时，按最近使用时间淘汰最旧的文件
+    5. 交给大模型的是本地压缩后的文件路径，而不是原始的QQ图片URL
+    6. 消息入库时在后台计算图片的感知哈希，用于识别重复发送的图片
+    7. 统计节省的流量和估算的图片token
+    """
+
+    # 下载超时时间(秒)
+    FETCH_TIMEOUT = 15
+    # 单张图片的最大下载大小
+    MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024
+    # 缓存文件扩展名
+    SUFFIX = '.jpg'
+    # 同时计算感知哈希的图片数量
+    HASH_CONCURRENCY = 4
+
+    def __init__(self, cache_dir: str, enabled: bool = False, max_bytes: int = 64 * 1024 * 1024,
+                 max_side: int = 1024, quality: int = 85, dedup: bool = False):
+        """
+        Args:
+            cache_dir: 缓存目录
+            enabled: 是否启用
+            max_bytes: 缓存总大小上限(字节)
+            max_side: 缩放后图片最长边的像素数
+            quality: JPEG编码质量(1-95)
+            dedup: 是否在消息入库时计算图片的感知哈希
+        """
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.dedup = dedup
+        self._hash_semaphore = asyncio.Semaphore(self.HASH_CONCURRENCY)
+        self._hash_tasks = set()
+        self.max_bytes = max(0, int(max_bytes))
+        self.max_side = max(64, int(max_side))
+        self.quality = min(95, max(1, int(quality)))
+        # 文件名 -> (文件大小, 原图大小, 节省的图片token)，按最近使用排序
+        self._index: OrderedDict = OrderedDict()
+        self._total_bytes = 0
+        self._loaded = False
+        # URL -> 文件名，QQ图片URL会过期，只短时间保留
+        self._urls = TTLCache(2000, default_ttl=3600)
+        self._single_flight = SingleFlight()
+        self._session: Optional[aiohttp.ClientSession] = None
+        # 统计
+        self.fetched = 0
+        self.hits = 0
+        self.failures = 0
+        self.bytes_fetched = 0
+        self.bytes_saved = 0
+        self.tokens_saved = 0
+        self.hashed = 0
+
+    @classmethod
+    def from_config(cls, config: Dict, cache_dir: str) -> "ImageCache":
+        """从插件配置创建图片缓存"""
+        image_config = config.get('image_cache', {}) or {}
+        enabled = image_config.get('enable', False)
+        if enabled and not PIL_AVAILABLE:
+            logger.warning("未安装Pillow，图片缓存将保存原图，不进行缩放")
+        # 只有输入图片给大模型时才需要去重
+        dedup = (config.get('image_dedup', {}) or {}).get('enable', False) and config.get('image_count', 0) > 0
+        if dedup and not PIL_AVAILABLE:
+            logger.warning("未安装Pillow，图片去重只能识别内容完全相同的图片")
+        return cls(
+            cache_dir,
+            enabled=enabled,
+            max_bytes=int(image_config.get('max_size_mb', 64)) * 1024 * 1024,
+            max_side=image_config.get('max_side', 1024),
+            quality=image_config.get('quality', 85),
+            dedup=dedup,
+        )
+
+    async def resolve(self, urls: List[str]) -> List[str]:
+        """
+        将图片URL替换为本地压缩后的文件路径
+
+        Returns:
+            List[str]: 与输入一一对应的图片地址，处理失败的图片保留原URL
+        """
+        if not self.enabled or not urls:
+            return urls
+        return list(await asyncio.gather(*(self.get(url) for url in urls)))
+
+    async def get(self, url: str) -> str:
+        """获取单张图片的本地文件路径，失败时返回原URL"""
+        if not url.startswith(('http://', 'https://')):
+            return url
+        name = self._urls.get(url)
+        if name is not None and name in self._index:
+            self._touch(name)
+            self.hits += 1
+            return self._path(name)
+        try:
+            name = await self._single_flight.do(url, lambda: self._fetch_and_store(url))
+            return self._path(name)
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"缓存图片失败，使用原URL: {str(e)}")
+            return url
+
+    def schedule_fingerprints(self, message: Dict, on_updated: Optional[Callable[[], None]] = None) -> None:
+        """
+        在后台为消息中还没有感知哈希的图片计算哈希，结果写入资源的'phash'字段
+
+        Args:
+            message: 新入库或从日志载入的消息记录
+            on_updated: 写入哈希后调用，用于将修改后的记录写回日志
+        """
+        if not self.dedup:
+            return
+        resources = [resource for resource in message.get('resources') or []
+                     if resource.get('type') == 'image' and resource.get('url') and not resource.get('phash')]
+        if not resources:
+            return
+        task = asyncio.create_task(self._fill_fingerprints(resources, on_updated))
+        self._hash_tasks.add(task)
+        task.add_done_callback(self._hash_tasks.discard)
+
+    async def _fill_fingerprints(self, resources: List[Dict], on_updated: Optional[Callable[[], None]]) -> None:
+        hashes = await asyncio.gather(*(self.fingerprint(resource['url']) for resource in resources))
+        updated = False
+        for resource, phash in zip(resources, hashes):
+            if phash:
+                resource['phash'] = phash
+                updated = True
+        if updated and on_updated is not None:
+            on_updated()
+
+    async def fingerprint(self, url: str) -> Optional[str]:
+        """计算图片的感知哈希，同一URL只计算一次，失败时返回None"""
+        try:
+            return await self._single_flight.do(('phash', url), lambda: self._compute_fingerprint(url))
+        except Exception as e:
+            logger.debug(f"计算图片感知哈希失败: {str(e)}")
+            return None
+
+    async def _compute_fingerprint(self, url: str) -> str:
+        async with self._hash_semaphore:
+            data = None
+            if self.enabled:
+                # 复用缓存的压缩图片，避免重复下载
+                path = await self.get(url)
+                if path != url:
+                    try:
+                        async with aiofiles.open(path, 'rb') as f:
+                            data = await f.read()
+                    except OSError as e:
+                        # 文件可能刚被淘汰
+                        logger.debug(f"读取缓存图片失败: {str(e)}")
+            if data is None:
+                # 缓存失败时直接下载，否则重复的图片会被当作新图片
+                data = await self._fetch(url)
+            phash = await asyncio.get_running_loop().run_in_executor(None, dhash, data)
+        self.hashed += 1
+        return phash
+
+    def _path(self, name: str) -> str:
+        return os.path.abspath(os.path.join(self.cache_dir, name))
+
+    def _touch(self, name: str) -> None:
+        """标记最近使用，并记录到文件修改时间以便重启后恢复淘汰顺序"""
+        self._index.move_to_end(name)
+        size, original_size, tokens = self._index[name]
+        self.bytes_saved += max(0, original_size - size)
+        self.tokens_saved += tokens
+        try:
+            os.utime(self._path(name))
+        except OSError:
+            pass
+
+    def _load_index(self) -> None:
+        """首次使用时扫描缓存目录，按修改时间恢复淘汰顺序"""
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(self.SUFFIX):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            # 重启前的原图大小未知，不计入节省统计
+            self._index[name] = (size, size, 0)
+            self._total_bytes += size
+        logger.debug(f"图片缓存已载入 {len(self._index)} 个文件，共 {self._total_bytes} 字节")
+
+    async def _fetch_and_store(self, url: str) -> str:
+        """下载图片，缩放后以内容哈希命名保存，返回文件名"""
+        self._load_index()
+        data = await self._fetch(url)
+        name = hashlib.sha256(data).hexdigest() + self.SUFFIX
+        if name in self._index:
+            # 不同URL指向相同内容
+            self._touch(name)
+        else:
+            # 内容相同的不同URL同时下载完成时，只保存一次
+            await self._single_flight.do(('store', name), lambda: self._store(name, data))
+        self._urls.put(url, name)
+        return name
+
+    async def _store(self, name: str, data: bytes) -> None:
+        """缩放图片并写入缓存文件，更新索引"""
+        compact, tokens = await asyncio.get_running_loop().run_in_executor(None, self._downscale, data)
+        # 每次写入使用独立的临时文件，写入中断不会留下不完整的缓存文件
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            async with aiofiles.open(tmp_path, 'wb') as f:
+                await f.write(compact)
+            os.replace(tmp_path, self._path(name))
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        if name in self._index:
+            # 等待期间已由其他下载保存，文件内容相同，只需避免重复计入大小
+            self._touch(name)
+            return
+        self._index[name] = (len(compact), len(data), tokens)
+        self._total_bytes += len(compact)
+        self.bytes_saved += max(0, len(data) - len(compact))
+        self.tokens_saved += tokens
+        logger.debug(f"图片已缓存: {len(data)} -> {len(compact)} 字节")
+        self._evict()
+
+    async def _fetch(self, url: str) -> bytes:
+        """下载图片原始数据"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.FETCH_TIMEOUT))
+        async with self._session.get(url) as response:
+            if response.status != 200:
+                raise RuntimeError(f"下载图片失败，HTTP状态码: {response.status}")
+            if (response.content_length or 0) > self.MAX_DOWNLOAD_BYTES:
+                raise RuntimeError(f"图片过大: {response.content_length} 字节")
+            # read(n)只返回已到达的数据，需要读到结束为止
+            buffer = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                buffer.extend(chunk)
+                if len(buffer) > self.MAX_DOWNLOAD_BYTES:
+                    raise RuntimeError("图片过大")
+        data = bytes(buffer)
+        self.fetched += 1
+        self.bytes_fetched += len(data)
+        return data
+
+    def _downscale(self, data: bytes) -> Tuple[bytes, int]:
+        """
+        缩小图片并重新编码为JPEG(在线程池中执行)
+
+        Returns:
+            Tuple[bytes, int]: 压缩后的数据，以及估算节省的图片token
+        """
+        if not PIL_AVAILABLE:
+            return data, 0
+        with Image.open(BytesIO(data)) as img:
+            # 动图只保留第一帧
+            img.seek(0)
+            width, height = img.size
+            if img.mode in ('RGBA', 'LA', 'P'):
+                img = img.convert('RGBA')
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=img.split()[-1])
+                img = background
+            elif img.mode != 'RGB':
+                img = img.convert('RGB')
+            img.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+            output = BytesIO()
+            img.save(output, format='JPEG', quality=self.quality, optimize=True)
+            new_width, new_height = img.size
+
+        compact = output.getvalue()
+        tokens = estimate_image_tokens(width, height) - estimate_image_tokens(new_width, new_height)
+        # 未缩放且重新编码后没有变小时保存原图
+        if tokens == 0 and len(compact) >= len(data):
+            return data, 0
+        return compact, tokens
+
+    def _evict(self) -> None:
+        """缓存总大小超过上限时淘汰最久未使用的文件"""
+        if not self.max_bytes:
+            return
+        while self._total_bytes > self.max_bytes and len(self._index) > 1:
+            name, (size, _, _) = self._index.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._path(name))
+            except OSError as e:
+                logger.error(f"删除图片缓存文件失败: {str(e)}")
+
+    async def close(self) -> None:
+        """取消未完成的哈希计算并关闭下载会话"""
+        for task in list(self._hash_tasks):
+            task.cancel()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def stats(self) -> Dict:
+        """获取图片缓存统计"""
+        return {
+            'files': len(self._index),
+            'bytes': self._total_bytes,
+            'fetched': self.fetched,
+            'hits': self.hits,
+            'failures': self.failures,
+            'bytes_fetched': self.bytes_fetched,
+            'bytes_saved': self.bytes_saved,
+            'image_tokens_saved': self.tokens_saved,
+            'hashed': self.hashed,
+        }
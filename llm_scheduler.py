@@ -0,0 +1,184 @@
+from collections import deque
+from typing import Dict, List, Optional
+import asyncio
+import heapq
+import itertools
+import time
+from astrbot.api.all import logger
+
+
+class LLMScheduler:
+    """
+    全局大模型调用调度器
+
+    主要功能:
+    1. 限制整个插件同时进行的大模型调用数量
+    2. 按每分钟请求数(RPM)和每分钟token数(TPM)限制调用速率
+    3. 在各群之间按权重公平分配调用名额(加权公平排队)
+    4. 直接@机器人或命中关键词的请求走优先通道，先于概率触发的请求
+    5. 统计排队长度和等待时间
+    """
+
+    # 优先级，数值越小越优先
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+
+    # 速率统计窗口(秒)
+    RATE_WINDOW = 60.0
+
+    def __init__(self, max_concurrency: int = 0, rpm: int = 0, tpm: int = 0,
+                 group_weights: Optional[Dict[str, float]] = None):
+        """
+        Args:
+            max_concurrency: 最大并发调用数，0表示不限制
+            rpm: 每分钟最大请求数，0表示不限制
+            tpm: 每分钟最大token数，0表示不限制
+            group_weights: 群号到权重的映射，未配置的群权重为1
+        """
+        self.max_concurrency = max(0, int(max_concurrency or 0))
+        self.rpm = max(0, int(rpm or 0))
+        self.tpm = max(0, int(tpm or 0))
+        self.group_weights = {str(k): float(v) for k, v in (group_weights or {}).items() if float(v) > 0}
+
+        # 等待队列: (优先级, 虚拟完成时间, 序号, 等待项)
+        self._queue: List[tuple] = []
+        self._seq = itertools.count()
+        # 每个群上一次请求的虚拟完成时间
+        self._group_finish: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._running = 0
+        # 速率窗口内已发出的请求: (时间, token数)
+        self._window: deque = deque()
+        self._window_tokens = 0
+        self._retry_handle: Optional[asyncio.TimerHandle] = None
+
+        # 统计
+        self.granted = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @classmethod
+    def from_config(cls, config: Dict) -> "LLMScheduler":
+        """从插件配置创建调度器"""
+        scheduler_config = config.get('llm_scheduler', {}) or {}
+        group_weights = {}
+        for item in scheduler_config.get('group_weights', []) or []:
+            try:
+                group_id, weight = str(item).split(':', 1)
+                group_weights[group_id.strip()] = float(weight)
+            except ValueError:
+                logger.warning(f"无效的群权重配置 '{item}'，格式应为 群号:权重")
+        return cls(
+            max_concurrency=scheduler_config.get('max_concurrency', 0),
+            rpm=scheduler_config.get('rpm', 0),
+            tpm=scheduler_config.get('tpm', 0),
+            group_weights=group_weights,
+        )
+
+    async def acquire(self, group_id, priority: int = PRIORITY_NORMAL, tokens: int = 0) -> float:
+        """
+        等待获取调用名额，调用结束后必须调用release释放
+
+        Returns:
+            float: 等待的秒数
+        """
+        key = str(group_id)
+        weight = self.group_weights.get(key, 1.0)
+        # 加权公平排队: 每个请求的虚拟完成时间 = max(全局虚拟时间, 本群上次完成时间) + 1/权重
+        start = max(self._virtual_time, self._group_finish.get(key, 0.0))
+        finish = start + 1.0 / weight
+        self._group_finish[key] = finish
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = {'future': future, 'tokens': max(0, int(tokens)), 'start': start,
+                  'enqueued_at': time.monotonic()}
+        heapq.heappush(self._queue, (priority, finish, next(self._seq), waiter))
+        self._dispatch()
+
+        try:
+            wait = await future
+        except asyncio.CancelledError:
+            # 已分配名额但调用方被取消时，归还名额
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        if wait > 0.01:
+            logger.debug(f"群 {group_id} 等待大模型调用名额 {wait:.2f} 秒")
+        return wait
+
+    def release(self) -> None:
+        """释放调用名额"""
+        self._running = max(0, self._running - 1)
+        self._dispatch()
+
+    def _expire_window(self, now: float) -> None:
+        while self._window and now - self._window[0][0] >= self.RATE_WINDOW:
+            _, tokens = self._window.popleft()
+            self._window_tokens -= tokens
+
+    def _rate_limited(self, tokens: int, now: float) -> bool:
+        """检查速率预算是否允许再发出一个请求"""
+        self._expire_window(now)
+        if self.rpm and len(self._window) >= self.rpm:
+            return True
+        # 窗口为空时总是放行，避免单个超大请求永远无法发出
+        if self.tpm and self._window and self._window_tokens + tokens > self.tpm:
+            return True
+        return False
+
+    def _dispatch(self) -> None:
+        """按优先级和虚拟完成时间依次分配空闲名额"""
+        now = time.monotonic()
+        while self._queue:
+            if self.max_concurrency and self._running >= self.max_concurrency:
+                return
+            priority, finish, _, waiter = self._queue[0]
+            future = waiter['future']
+            if future.done():
+                # 等待中被取消的请求直接丢弃
+                heapq.heappop(self._queue)
+                continue
+            if self._rate_limited(waiter['tokens'], now):
+                self._schedule_retry(now)
+                return
+
+            heapq.heappop(self._queue)
+            self._running += 1
+            self._virtual_time = max(self._virtual_time, waiter['start'])
+            self._window.append((now, waiter['tokens']))
+            self._window_tokens += waiter['tokens']
+
+            wait = now - waiter['enqueued_at']
+            self.granted += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            future.set_result(wait)
+
+    def _schedule_retry(self, now: float) -> None:
+        """速率受限时，在最早的请求移出窗口后重新尝试分配"""
+        if self._retry_handle is not None or not self._window:
+            return
+        delay = max(0.0, self.RATE_WINDOW - (now - self._window[0][0])) + 0.01
+
+        def _retry():
+            self._retry_handle = None
+            self._dispatch()
+
+        self._retry_handle = asyncio.get_running_loop().call_later(delay, _retry)
+
+    def queue_depth(self) -> int:
+        """当前排队等待的请求数"""
+        return sum(1 for item in self._queue if not item[3]['future'].done())
+
+    def stats(self) -> Dict:
+        """获取调度统计"""
+        self._expire_window(time.monotonic())
+        return {
+            'running': self._running,
+            'queue_depth': self.queue_depth(),
+            'granted': self.granted,
+            'avg_wait': self.total_wait / self.granted if self.granted else 0.0,
+            'max_wait': self.max_wait,
+            'window_requests': len(self._window),
+            'window_tokens': self._window_tokens,
+        }
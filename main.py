@@ -5,13 +5,25 @@ import asyncio
 from astrbot.api.all import *
 from astrbot.core.platform.sources.aiocqhttp.aiocqhttp_message_event import AiocqhttpMessageEvent
 from .message_processor import MessageProcessor
-from .utils.chat_formatter import format_chat_history
-from .utils.reply_decision import should_reply
-from .utils.persona_handler import get_persona_info
+from .history_store import HistoryStore
+from .storage import create_storage
+from .event_extractor import EventExtractor
+from .llm_scheduler import LLMScheduler
+from .reply_coalescer import ReplyCoalescer
+from .preemption import PreemptionController
+from .image_cache import ImageCache
+from .processors.forward_processor import ForwardProcessor
+from .utils.chat_formatter import format_group_history
+from .utils.reply_decision import ReplyDecisionEngine
+from .utils.persona_handler import PersonaPromptCache
 from .utils.text_filter import process_model_text
+from .utils.token_counter import estimate_tokens
 from astrbot.api.provider import LLMResponse
 from astrbot.api.event import filter, AstrMessageEvent
 from .api_client import APIClient
+from .member_directory import member_directory
+from .metrics import metrics, MetricsExporter
+from .cache import message_cache, quote_cache, forward_cache
 
 @register(
     "spectrecore",
@@ -30,9 +42,51 @@ class SpectreCore(Star):
         self.config = config
         self.base_path = os.path.join("data", "group_messages")
         os.makedirs(self.base_path, exist_ok=True)
+        # 图片本地缓存，输入给大模型的是缩放后的本地文件
+        self.image_cache = ImageCache.from_config(self.config, os.path.join("data", "spectrecore_image_cache"))
+        # 常驻内存的群消息历史，延迟写回存储后端(默认JSON Lines文件，可选SQLite)；消息入库或载入后在后台计算图片哈希用于去重
+        self.history_store = HistoryStore(self.base_path, self.config.get('group_msg_history', 100),
+                                          on_message_added=self.image_cache.schedule_fingerprints,
+                                          storage=create_storage(self.config, self.base_path))
         logger.info(f"SpectreCore插件初始化完成，消息存储路径: {self.base_path}")
+        # 根据配置预编译的回复决策引擎
+        self.reply_engine = ReplyDecisionEngine(self.config)
+        # 预编译的人格提示词缓存
+        self.persona_cache = PersonaPromptCache()
+        # 全局大模型调用调度器，限制所有群的总并发和速率
+        self.llm_scheduler = LLMScheduler.from_config(self.config)
+        # 回复触发合并器，合并模式下不再丢弃调用进行中到达的触发
+        self.coalescer = ReplyCoalescer.from_config(self.config)
+        # 过期调用抢占控制器
+        self.preemptor = PreemptionController.from_config(self.config)
+        # 合并转发消息的处理上限
+        ForwardProcessor.configure(self.config)
         # 为每个群组创建锁字典，防止并发调用大模型
         self.group_locks = {}
+        # 各群大模型请求发出的时间，用于统计大模型的响应耗时
+        self.llm_started = {}
+        # 汇总各组件的统计，通过/sc stats查看，并可定期写入Prometheus textfile
+        self.register_metric_sources()
+        self.metrics_exporter = MetricsExporter.from_config(metrics, self.config)
+        self.metrics_exporter.ensure_started()
+
+    async def terminate(self):
+        """插件卸载时将未保存的消息历史写入磁盘"""
+        # 先停止后台的图片哈希计算，再写入所有未保存的消息历史
+        await self.image_cache.close()
+        await self.history_store.close()
+        await self.metrics_exporter.close()
+
+    def register_metric_sources(self):
+        """注册各组件已有的统计"""
+        metrics.register_source('api', APIClient.get_stats)
+        metrics.register_source('message_cache', message_cache.stats)
+        metrics.register_source('quote_cache', quote_cache.stats)
+        metrics.register_source('forward_cache', forward_cache.stats)
+        metrics.register_source('image_cache', self.image_cache.stats)
+        metrics.register_source('llm_scheduler', self.llm_scheduler.stats)
+        metrics.register_source('preemption', self.preemptor.stats)
+        metrics.register_source('coalescer', lambda: {'coalesced': self.coalescer.coalesced})
 
     def get_group_lock(self, group_id):
         """获取群组锁，如果不存在则创建"""
@@ -40,60 +94,39 @@ class SpectreCore(Star):
             self.group_locks[group_id] = asyncio.Lock()
         return self.group_locks[group_id]
 
-    async def collect_image_urls(self, messages, latest_message_index, img_count):
-        """收集图片URL"""
-        if img_count <= 0:
-            return []
-            
-        image_urls = []
-        latest_message = messages[latest_message_index]
+    async def prepare_model_prompt(self):
+        """准备模型系统提示词和上下文(人格部分已预编译缓存)"""
+        persona_name = self.config.get('persona', '')
+        return await self.persona_cache.get(persona_name, self.context)
         
-        # 从最新消息中收集图片
-        for seg in latest_message.get('message', []):
-            if seg.get('type') == 'image':
-                url = seg.get('data', {}).get('url')
-                if url:
-                    image_urls.append(url)
+    def get_bot_identity(self, event):
+        """获取机器人的QQ号和昵称，只读取缓存，不等待网络请求
         
-        # 如果需要更多图片，从其他消息中收集
-        if len(image_urls) < img_count:
-            for msg in messages[:latest_message_index]:
-                if len(image_urls) >= img_count:
-                    break
-                for seg in msg.get('message', []):
-                    if seg.get('type') == 'image':
-                        url = seg.get('data', {}).get('url')
-                        if url and url not in image_urls:
-                            image_urls.append(url)
-                            if len(image_urls) >= img_count:
-                                break
-        
-        return image_urls[:img_count]
+        Returns:
+            tuple: (QQ号, 昵称)
+        """
+        self_id = str(event.get_self_id())
+        login_info = APIClient.get_cached_login_info(event.bot)
+        if login_info and str(login_info.get('user_id')) != self_id:
+            # 登录账号已变化，丢弃旧的登录信息
+            APIClient.identity_cache.invalidate(event.bot)
+            login_info = None
+        nickname = (login_info or {}).get('nickname') \
+            or member_directory.get_name(event.get_group_id(), self_id) or self_id
+        return self_id, nickname
 
-    async def prepare_model_prompt(self, persona_info):
-        """准备模型系统提示词和上下文"""
-        system_prompt = f"当前时间:{time.strftime('%Y-%m-%d %H:%M:%S')}"
-        contexts = []
-        
-        if persona_info:
-            # 添加人格提示词
-            if persona_info.get('prompt'):
-                system_prompt += f"\n\n{persona_info.get('prompt')}"
-            
-            # 添加对话风格模仿提示
-            mood_imitation = persona_info.get('_mood_imitation_dialogs_processed')
-            if mood_imitation:
-                system_prompt += f"\n\n请模仿以下对话风格进行回复：\n{mood_imitation}"
-            
-            # 添加预设对话上下文
-            begin_dialogs = persona_info.get('_begin_dialogs_processed', [])
-            if begin_dialogs:
-                contexts.extend(begin_dialogs)
-        
-        return system_prompt, contexts
+    def get_bot_sender(self, event):
+        """获取机器人自身的发送者信息，用于保存机器人发送的消息"""
+        self_id, nickname = self.get_bot_identity(event)
+        return {'user_id': self_id, 'nickname': nickname}
+
+    async def process_and_save_group_message(self, event, sent: bool = False):
+        """处理并保存群消息
         
-    async def process_and_save_group_message(self, event):
-        """处理并保存群消息"""
+        Args:
+            event: 消息事件
+            sent: 是否为机器人发送的消息
+        """
         try:
             # 检查事件类型
             if not isinstance(event, AiocqhttpMessageEvent):
@@ -102,6 +135,8 @@ class SpectreCore(Star):
                 
             client = event.bot
             group_id = event.get_group_id()
+            if not group_id:
+                return None
             
             # 检查是否为启用回复功能的群聊
             enabled_groups = self.config.get('enabled_groups', [])
@@ -109,19 +144,38 @@ class SpectreCore(Star):
                 logger.debug(f"群 {group_id} 未启用回复功能，跳过保存消息")
                 return None
                 
-            # 获取群消息历史
-            response = await APIClient.get_group_message_history(client, group_id, 2)
-            if not response or 'messages' not in response or not response['messages']:
-                return None
+            # 首次见到该群时批量预热成员名录，并在后台获取机器人登录信息
+            member_directory.ensure_warm(client, group_id)
+            APIClient.get_cached_login_info(client)
+            
+            # 直接从事件中构建消息数据，无需调用消息历史API
+            if sent:
+                message_data = EventExtractor.extract_sent_message(event, self.get_bot_sender(event))
+                if not message_data:
+                    logger.debug(f"群 {group_id} 发送的消息没有可保存的内容")
+                    return None
+            else:
+                message_data = EventExtractor.extract_incoming_message(event)
                 
-            messages = response['messages']
+            if message_data:
+                messages = [message_data]
+            else:
+                # 事件原始数据不可用时，回退到通过消息历史API补全
+                logger.debug(f"群 {group_id} 的事件数据不完整，通过消息历史API获取")
+                metrics.incr('history_api_fallback')
+                with metrics.timer('history_fetch'):
+                    response = await APIClient.get_group_message_history(client, group_id, 2)
+                if not response or 'messages' not in response or not response['messages']:
+                    return None
+                messages = response['messages']
 
             logger.debug(f"群 {group_id} 的消息历史: {messages}")
             
             # 处理并保存消息
-            save_result = await MessageProcessor.save_messages(
-                group_id, messages, self.base_path, client, self.config.get('group_msg_history', 100)
-            )
+            with metrics.timer('save_messages'):
+                save_result = await MessageProcessor.save_messages(
+                    group_id, messages, self.history_store, client
+                )
             
             if not save_result:
                 logger.warning(f"群 {group_id} 的消息保存失败")
@@ -132,35 +186,43 @@ class SpectreCore(Star):
             logger.error(f"处理群消息时出错: {str(e)}")
             return None
     
-    async def get_local_message_history(self, group_id):
-        """获取本地保存的消息历史"""
-        try:
-            file_path = os.path.join(self.base_path, f"{group_id}.json")
-            if not os.path.exists(file_path):
-                logger.debug(f"群 {group_id} 的历史消息文件不存在")
-                return None
-                
-            import aiofiles
-            import json
-            
-            async with aiofiles.open(file_path, 'r', encoding='utf-8') as f:
-                content = await f.read()
-                data = json.loads(content)
-                if 'messages' in data and data['messages']:
-                    logger.debug(f"成功读取群 {group_id} 的本地历史消息，共 {len(data['messages'])} 条")
-                    return data['messages']
-                else:
-                    logger.debug(f"群 {group_id} 的本地历史消息为空")
-                    return None
-        except Exception as e:
-            logger.error(f"读取本地历史消息出错: {str(e)}")
-            return None
+    async def build_llm_request(self, event, history):
+        """基于当前的群消息历史构建大模型请求参数"""
+        botqq, botname = self.get_bot_identity(event)
+        group_id = event.get_group_id()
+        # 图片编号和发送的图片URL来自同一份图片索引选择结果
+        with metrics.timer('format'):
+            chat_history, image_urls = await format_group_history(history, self.config, group_id)
+        with metrics.timer('image_resolve'):
+            image_urls = await self.image_cache.resolve(image_urls)
+        prompt = f"你在一个qq群聊中，你是qq号为{botqq}，昵称为{botname}的一名用户，以下是经过格式化后的聊天记录（所有消息均被格式化成文本，如图片被转换为[图片]，表情被转换为[动画表情]）:\n{chat_history}\n\n你输出的内容将作为群聊中的消息发送。" + \
+            "你只应该发送文字消息，不要发送[图片]、[qq表情]、[@某人(id:xxx)]等你在聊天记录中看到的特殊内容。"
+        
+        # 准备系统提示词和上下文
+        with metrics.timer('persona'):
+            system_prompt, contexts = await self.prepare_model_prompt()
+        logger.debug(f"提示词: {prompt}")
+        
+        # 调用大模型
+        if self.config.get('use_func_tool', False):
+            func_tools_mgr = self.context.get_llm_tool_manager()
+        else:
+            func_tools_mgr = None
+        
+        return {
+            'prompt': prompt,
+            'contexts': contexts,
+            'image_urls': image_urls,
+            'func_tool_manager': func_tools_mgr,
+            'system_prompt': system_prompt,
+        }
     
     @event_message_type(EventMessageType.GROUP_MESSAGE)
     async def on_group_message(self, event: AstrMessageEvent):
         """处理群消息事件"""
         try:
             group_id = event.get_group_id()
+            self.metrics_exporter.ensure_started()
 
             enabled_groups = self.config.get('enabled_groups', [])
             if enabled_groups and str(group_id) not in [str(g) for g in enabled_groups]:
@@ -168,17 +230,17 @@ class SpectreCore(Star):
                 return
             
             # 获取并保存最新的群消息，但不使用它来决定是否回复
-            await self.process_and_save_group_message(event)
+            with metrics.timer('ingest'):
+                await self.process_and_save_group_message(event)
             
-            # 从本地获取历史消息
-            local_messages = await self.get_local_message_history(group_id)
-            if not local_messages:
+            # 从常驻内存的历史中获取最新消息，决定是否回复
+            with metrics.timer('history_load'):
+                history = await self.history_store.get(group_id)
+            latest_message = history.latest()
+            if not latest_message:
                 logger.debug(f"群 {group_id} 没有本地历史消息，无法处理")
                 return
             
-            # 获取最新消息内容，决定是否回复
-            latest_message = local_messages[-1]  # 使用本地历史中的最新消息
-            
             # 分析最新消息是否需要回复
             content = latest_message.get('content', '')
             if not content:
@@ -186,80 +248,78 @@ class SpectreCore(Star):
                 return
                 
             # 判断是否需要回复
-            if not should_reply(content, self.config, group_id):
+            with metrics.timer('decide'):
+                need_reply, reason = self.reply_engine.decide(content, group_id)
+            if reason.startswith('command:'):
+                # 命令消息既不回复，也不抢占进行中的调用
                 return
+            # 调用进行中聊天已经推进时，取消过期的调用并由本条消息重新发起
+            if self.preemptor.on_message(group_id, EventExtractor.mentions_bot(event)):
+                need_reply, reason = True, "preempt"
+            if not need_reply:
+                return
+            logger.debug(f"群 {group_id} 触发回复，原因: {reason}")
+            # 关键词触发只按类别计数，避免每个关键词产生一个指标
+            metrics.incr(f"trigger:{reason.split(':', 1)[0]}")
                 
             # 获取群组锁，确保同一群组的大模型调用是串行的
             group_lock = self.get_group_lock(group_id)
             
-            # 尝试获取锁，如果锁被占用，表示已经有一个请求在处理中
-            if not group_lock.locked():
-                async with group_lock:
-                    logger.debug(f"群 {group_id} 获取锁成功，开始处理大模型调用")
-                    # 准备调用大模型
-                    login_info = await APIClient.get_login_info(event.bot)
-                    botname = login_info.get('nickname')
-                    botqq = login_info.get('user_id')
-                    chat_history = await format_chat_history(group_id, self.base_path, self.config)
-                    prompt = f"你在一个qq群聊中，你是qq号为{botqq}，昵称为{botname}的一名用户，以下是经过格式化后的聊天记录（所有消息均被格式化成文本，如图片被转换为[图片]，表情被转换为[动画表情]）:\n{chat_history}\n\n你输出的内容将作为群聊中的消息发送。" + \
-                        "你只应该发送文字消息，不要发送[图片]、[qq表情]、[@某人(id:xxx)]等你在聊天记录中看到的特殊内容。"
-                    
-                    # 收集图片URL（从本地历史消息中获取）
-                    img_count = self.config.get('image_count', 0)
-                    image_urls = []
-                    
-                    if img_count > 0:
-                        # 从最新消息中收集图片URL
-                        latest_message_data = latest_message.get('raw_message', {})
-                        if isinstance(latest_message_data, dict) and 'message' in latest_message_data:
-                            for seg in latest_message_data.get('message', []):
-                                if seg.get('type') == 'image':
-                                    url = seg.get('data', {}).get('url')
-                                    if url:
-                                        image_urls.append(url)
-                                        if len(image_urls) >= img_count:
-                                            break
-                        
-                        # 如果需要更多图片，从其他消息中收集
-                        if len(image_urls) < img_count:
-                            for msg in reversed(local_messages[:-1]):  # 除了最新消息外的消息，从新到旧
-                                if len(image_urls) >= img_count:
-                                    break
-                                msg_data = msg.get('raw_message', {})
-                                if isinstance(msg_data, dict) and 'message' in msg_data:
-                                    for seg in msg_data.get('message', []):
-                                        if seg.get('type') == 'image':
-                                            url = seg.get('data', {}).get('url')
-                                            if url and url not in image_urls:
-                                                image_urls.append(url)
-                                                if len(image_urls) >= img_count:
-                                                    break
-                    
-                    # 获取人格信息
-                    persona_name = self.config.get('persona', '')
-                    persona_info = await get_persona_info(persona_name, self.context)
-                    
-                    # 准备系统提示词和上下文
-                    system_prompt, contexts = await self.prepare_model_prompt(persona_info)
-                    logger.debug(f"提示词: {prompt}")
-                    
-                    # 调用大模型
-                    if self.config.get('use_func_tool', False):
-                        func_tools_mgr = self.context.get_llm_tool_manager()
-                    else:
-                        func_tools_mgr = None
-                    yield event.request_llm(
-                        prompt=prompt,
-                        contexts=contexts,
-                        image_urls=image_urls,
-                        func_tool_manager=func_tools_mgr,
-                        system_prompt=system_prompt
-                    )
-                    logger.debug(f"群 {group_id} 大模型调用完成，释放锁")
-            else:
+            if self.coalescer.enabled:
+                # 合并模式：调用进行中或静默窗口内的多次触发只保留最新的一次，在当前调用结束后补充回复
+                token = self.coalescer.register(group_id)
+                with metrics.timer('coalesce_wait'):
+                    quiet = await self.coalescer.wait_quiet(group_id, token)
+                if not quiet:
+                    metrics.incr('drop:coalesced')
+                    return
+            elif group_lock.locked():
+                # 锁被占用，表示已经有一个请求在处理中
                 logger.debug(f"群 {group_id} 已有一个大模型调用在进行中，跳过此次请求")
+                metrics.incr('drop:busy')
+                return
+            
+            # 锁和调度名额在调用被抢占时会提前释放，因此手动获取并通过调用记录幂等释放
+            with metrics.timer('lock_wait'):
+                await group_lock.acquire()
+            generation = None
+            started = None
+            try:
+                if self.coalescer.enabled and not self.coalescer.is_latest(group_id, token):
+                    metrics.incr('drop:coalesced')
+                    return
+                logger.debug(f"群 {group_id} 获取锁成功，开始处理大模型调用")
+                # 基于最新的聊天记录准备调用大模型
+                request_kwargs = await self.build_llm_request(event, history)
+                
+                # 直接@机器人、命中关键词或抢占后重新发起的请求走优先通道
+                if reason.startswith('keyword:') or reason == "preempt" or EventExtractor.mentions_bot(event):
+                    priority = LLMScheduler.PRIORITY_HIGH
+                else:
+                    priority = LLMScheduler.PRIORITY_NORMAL
+                tokens = estimate_tokens(request_kwargs['prompt']) + estimate_tokens(request_kwargs['system_prompt'])
+                with metrics.timer('scheduler_wait'):
+                    await self.llm_scheduler.acquire(group_id, priority, tokens)
+                generation = self.preemptor.begin(
+                    group_id, tokens, [self.llm_scheduler.release, group_lock.release]
+                )
+                metrics.incr('llm_request')
+                started = self.llm_started[group_id] = time.perf_counter()
+                # 包含大模型调用和发送回复的耗时
+                with metrics.timer('llm_total'):
+                    yield event.request_llm(**request_kwargs)
+                logger.debug(f"群 {group_id} 大模型调用完成，释放锁")
+            finally:
+                # 被抢占的调用结束时，该群的记录可能已属于重新发起的调用
+                if started is not None and self.llm_started.get(group_id) is started:
+                    del self.llm_started[group_id]
+                if generation is not None:
+                    self.preemptor.finish(generation)
+                else:
+                    group_lock.release()
          
         except Exception as e:
+            metrics.incr('error')
             error_details = traceback.format_exc()
             logger.error(f"处理群消息时出错: {str(e)}\n{error_details}")
 
@@ -267,15 +327,24 @@ class SpectreCore(Star):
     async def after_message_sent(self, event: AstrMessageEvent):
         """发送消息给消息平台适配器后"""
         # 获取并保存机器人发送的消息
-        await self.process_and_save_group_message(event)
+        with metrics.timer('after_sent'):
+            await self.process_and_save_group_message(event, sent=True)
 
     @filter.on_llm_response()
     async def on_llm_resp(self, event: AstrMessageEvent, resp: LLMResponse): 
         """处理大模型回复"""
         try:
+           group_id = event.get_group_id()
+           # 大模型已返回结果，此后的新消息不再抢占本次调用
+           self.preemptor.mark_responded(group_id)
+           started = self.llm_started.pop(group_id, None)
+           if started is not None:
+                metrics.observe('llm_provider', time.perf_counter() - started)
            if (self.config.get('filter_thinking', False) or self.config.get('read_air', False)) and resp.role == "assistant":
                 resp.completion_text = process_model_text(resp.completion_text, self.config)
                 if resp.completion_text == "":
+                    # 读空气判断不需要回复(NO_RESPONSE)
+                    metrics.incr('no_response')
                     event.stop_event()
         except Exception as e:
             error_details = traceback.format_exc()
@@ -293,9 +362,19 @@ class SpectreCore(Star):
             "1.用spectrecore或sc作为指令前缀 如/sc help\n"
             "2.使用reset重置聊天记录 如/sc reset\n"
             "你也可以在私聊中重置群聊天记录 如/sc reset 群号\n"
+            "3.使用stats查看各处理阶段耗时和缓存命中等运行统计 如/sc stats\n"
             "更多信息请查看https://github.com/23q3/astrbot_plugin_SpectreCore"
         )
     
+    @spectrecore.command("stats")
+    async def stats(self, event: AstrMessageEvent):
+        """查看运行统计"""
+        try:
+            yield event.plain_result(metrics.summary())
+        except Exception as e:
+            logger.error(f"获取运行统计时出错: {str(e)}")
+            yield event.plain_result(f"获取运行统计失败: {str(e)}")
+
     @spectrecore.command("reset")
     async def reset(self, event: AstrMessageEvent, group_id: int = None):
         """重置聊天记录
@@ -322,11 +401,8 @@ class SpectreCore(Star):
                 yield event.plain_result("请提供有效的群号")
                 return
                 
-            # 执行重置操作
-            file_path = os.path.join(self.base_path, f"{group_id}.json")
-            
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            # 执行重置操作(同时清除内存中的历史和文件)
+            if await self.history_store.reset(group_id):
                 logger.info(f"已重置群 {group_id} 的聊天记录")
                 yield event.plain_result(f"已重置群 {group_id} 的聊天记录")
             else:
@@ -0,0 +1,110 @@
+from typing import Dict, List, Optional
+import asyncio
+import time
+from astrbot.api.all import logger
+
+
+class MemberDirectory:
+    """
+    按群维护的成员名录
+
+    主要功能:
+    1. 首次见到某个群时，通过一次get_group_member_list批量预热该群的成员名称
+    2. 名录过期后在后台重新拉取，并增量合并到现有名录
+    3. 每条入库消息的发送者信息都会顺便更新名录，无需额外请求
+    4. 群名片按群隔离，同一用户在不同群中的名称互不影响
+    """
+
+    # 名录刷新间隔(秒)
+    REFRESH_TTL = 3600
+
+    def __init__(self):
+        # group_id -> {user_id: 名称}
+        self._members: Dict[str, Dict[str, str]] = {}
+        # group_id -> 上次批量拉取的时间
+        self._refreshed_at: Dict[str, float] = {}
+        self._warm_tasks: Dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    def _display_name(member: Dict) -> str:
+        """优先使用群名片，没有则使用昵称"""
+        return member.get('card') or member.get('nickname') or ''
+
+    def get_name(self, group_id, user_id) -> Optional[str]:
+        """查找群成员名称，不发起网络请求"""
+        if group_id is None:
+            return None
+        members = self._members.get(str(group_id))
+        if not members:
+            return None
+        return members.get(str(user_id))
+
+    def known_size(self, group_id) -> int:
+        """名录中已知的群成员数，即群人数的下限"""
+        if group_id is None:
+            return 0
+        return len(self._members.get(str(group_id)) or ())
+
+    def observe(self, group_id, user_id, name: str) -> None:
+        """记录群成员名称"""
+        if group_id is None or not name:
+            return
+        self._members.setdefault(str(group_id), {})[str(user_id)] = name
+
+    def observe_sender(self, group_id, sender: Dict) -> None:
+        """从消息发送者信息中更新名录"""
+        if isinstance(sender, dict) and 'user_id' in sender:
+            self.observe(group_id, sender['user_id'], self._display_name(sender))
+
+    def observe_members(self, group_id, members: List[Dict]) -> None:
+        """批量合并成员列表到名录"""
+        group_members = self._members.setdefault(str(group_id), {})
+        for member in members:
+            if isinstance(member, dict) and 'user_id' in member:
+                name = self._display_name(member)
+                if name:
+                    group_members[str(member['user_id'])] = name
+
+    def ensure_warm(self, client, group_id) -> None:
+        """群名录未加载或已过期时，在后台批量拉取成员列表"""
+        if client is None or group_id is None:
+            return
+        key = str(group_id)
+        refreshed_at = self._refreshed_at.get(key)
+        if refreshed_at is not None and time.time() - refreshed_at < self.REFRESH_TTL:
+            return
+        task = self._warm_tasks.get(key)
+        if task is not None and not task.done():
+            return
+        self._warm_tasks[key] = asyncio.create_task(self.warm(client, group_id))
+
+    async def warm(self, client, group_id) -> int:
+        """
+        批量拉取群成员列表并合并到名录
+
+        Returns:
+            int: 拉取到的成员数量
+        """
+        from .api_client import APIClient  # 避免循环导入
+
+        key = str(group_id)
+        # 无论成功与否都记录时间，避免失败时反复请求
+        self._refreshed_at[key] = time.time()
+        members = await APIClient.get_group_member_list(client, group_id)
+        if members:
+            self.observe_members(group_id, members)
+            logger.debug(f"群 {group_id} 的成员名录已更新，共 {len(members)} 人")
+        return len(members)
+
+    def clear(self, group_id=None) -> None:
+        """清除指定群或所有群的名录"""
+        if group_id is None:
+            self._members.clear()
+            self._refreshed_at.clear()
+        else:
+            self._members.pop(str(group_id), None)
+            self._refreshed_at.pop(str(group_id), None)
+
+
+# 全局成员名录实例
+member_directory = MemberDirectory()
@@ -1,11 +1,10 @@
 from typing import Dict, List, Optional
 import time
-import asyncio
 import json
 from astrbot.api.all import logger
 from .processors.segment_processor import SegmentProcessor
 from .processors.image_processor import ImageProcessor
-from .cache import name_cache
+from .member_directory import member_directory
 
 class MessageFormatter:
     """
@@ -20,7 +19,7 @@ class MessageFormatter:
     
     @classmethod
     async def process_group_message(cls, message_data: Dict, messages: List[Dict] = None, 
-                                   client = None, group_id: Optional[int] = None) -> Dict:
+                                   client = None, group_id: Optional[int] = None, history = None) -> Dict:
         """
         处理群消息，返回格式化后的消息字典
         
@@ -29,6 +28,7 @@ class MessageFormatter:
             messages: 消息列表上下文
             client: 消息客户端
             group_id: 群ID
+            history: 群消息历史(GroupHistory)，用于按索引解析引用和@
             
         Returns:
             Dict: 格式化后的消息字典
@@ -39,20 +39,21 @@ class MessageFormatter:
         message_time = message_data['time']
         message_id = message_data.get('message_id')
         
-        # 缓存用户信息，方便后续使用
-        name_cache.put(str(sender['user_id']), sender['nickname'])
+        # 更新群成员名录，方便后续解析@
+        member_directory.observe_sender(group_id, sender)
         
         # 首先检查是否为特殊消息类型(如合并转发)
-        special_message = await cls._check_special_message_types(message, sender, message_time, message_id)
+        special_message = await cls._check_special_message_types(message, sender, message_time, message_id, client)
         if special_message:
             return special_message
 
         # 处理普通消息
-        return await cls._process_normal_message(message_data, messages, client, group_id)
+        return await cls._process_normal_message(message_data, messages, client, group_id, history)
         
     @classmethod
     async def _check_special_message_types(cls, message: List[Dict], sender: Dict, 
-                                         message_time: int, message_id: Optional[int] = None) -> Optional[Dict]:
+                                         message_time: int, message_id: Optional[int] = None,
+                                         client = None) -> Optional[Dict]:
         """
         检查是否为特殊类型的消息，如合并转发消息
         
@@ -61,6 +62,7 @@ class MessageFormatter:
             sender: 发送者信息
             message_time: 消息时间戳
             message_id: 消息ID
+            client: 消息客户端，用于获取只有转发ID的合并转发内容
             
         Returns:
             Optional[Dict]: 处理后的特殊消息，如果不是特殊消息则返回None
@@ -74,7 +76,8 @@ class MessageFormatter:
                 processed_msg = await ForwardProcessor.process_forward_message(
                     seg['data'], 
                     sender_info=sender,
-                    msg_time=message_time
+                    msg_time=message_time,
+                    client=client
                 )
                 
                 # 确保添加消息ID以便去重
@@ -146,7 +149,7 @@ class MessageFormatter:
         
     @classmethod
     async def _process_normal_message(cls, message_data: Dict, messages: List[Dict] = None, 
-                                     client = None, group_id: Optional[int] = None) -> Dict:
+                                     client = None, group_id: Optional[int] = None, history = None) -> Dict:
         """
         处理普通消息(非特殊类型)
         
@@ -155,6 +158,7 @@ class MessageFormatter:
             messages: 消息列表上下文
             client: 消息客户端
             group_id: 群ID
+            history: 群消息历史
             
         Returns:
             Dict: 格式化后的普通消息
@@ -162,18 +166,21 @@ class MessageFormatter:
         message = message_data['message']
         sender = message_data['sender']
         
-        # 并发处理所有消息段落
-        tasks = [SegmentProcessor.process_message_segment(seg, messages, client, group_id) for seg in message]
-        processed_segments = await asyncio.gather(*tasks)
+        # 同步渲染不需要网络请求的消息段，只并发处理引用、@等需要异步处理的消息段
+        quotes = []
+        content = await SegmentProcessor.process_segments(message, messages, client, group_id, history, quotes)
         
         # 构建结构化的消息结果
         result = {
             'time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(message_data['time'])),
             'sender': f"{sender['nickname']}(id:{sender['user_id']})",
-            'content': ''.join(processed_segments),
+            'content': content,
             'resources': [],
             'message_id': message_data.get('message_id', None)
         }
+        if quotes:
+            # 引用在content中的位置，再次被引用时按引用深度重新展开
+            result['quotes'] = quotes
 
         # 收集图片等资源信息
         for seg in message:
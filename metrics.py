@@ -0,0 +1,251 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+import asyncio
+import os
+import time
+from astrbot.api.all import logger
+
+
+class Histogram:
+    """
+    固定分桶的耗时直方图
+
+    只记录每个桶的计数、总和与最大值，记录一次的开销是一次二分查找
+    """
+
+    # 分桶上界(秒)，覆盖从本地处理到大模型调用的耗时范围
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        # 最后一个桶对应+Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        """按分桶线性插值估算分位数"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+
+class Metrics:
+    """
+    插件运行指标
+
+    主要功能:
+    1. 按阶段记录耗时直方图，如入库、格式化、等待锁、等待调度、大模型调用
+    2. 按名称记录事件计数，如触发原因、丢弃的触发、空回复
+    3. 汇总各组件已有的统计(缓存命中率、API调用次数、调度队列等)
+    4. 生成/sc stats的文本摘要和Prometheus文本格式
+    """
+
+    PREFIX = "spectrecore"
+
+    def __init__(self):
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, int] = {}
+        # 名称 -> 返回统计字典的函数
+        self._sources: Dict[str, Callable[[], Dict]] = {}
+        self.started_at = time.time()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """记录一个阶段的耗时"""
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """记录with块内的耗时，可以包含await"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def incr(self, name: str, value: int = 1) -> None:
+        """增加事件计数"""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def register_source(self, name: str, source: Callable[[], Dict]) -> None:
+        """注册组件统计来源，同名来源会被覆盖"""
+        self._sources[name] = source
+
+    def collect_sources(self) -> Dict[str, Dict]:
+        """获取所有组件的统计，单个来源出错不影响其他来源"""
+        collected = {}
+        for name, source in self._sources.items():
+            try:
+                collected[name] = source()
+            except Exception as e:
+                logger.error(f"获取{name}统计时出错: {str(e)}")
+        return collected
+
+    @staticmethod
+    def _flatten(stats: Dict, prefix: str = '') -> List[Tuple[str, float]]:
+        """将嵌套的统计字典展开为(键, 数值)列表，忽略非数值"""
+        items = []
+        for key, value in stats.items():
+            name = f"{prefix}{key}"
+            if isinstance(value, dict):
+                items.extend(Metrics._flatten(value, f"{name}_"))
+            elif isinstance(value, (int, float)):
+                items.append((name, float(value)))
+        return items
+
+    def summary(self) -> str:
+        """生成用于/sc stats的文本摘要"""
+        lines = [f"SpectreCore运行统计(已运行{int(time.time() - self.started_at)}秒)"]
+        if self.histograms:
+            lines.append("阶段耗时(次数 平均/p50/p95/最大，毫秒):")
+            for stage, h in sorted(self.histograms.items()):
+                lines.append(
+                    f"  {stage}: {h.count} {h.sum / h.count * 1000:.1f}/{h.quantile(0.5) * 1000:.1f}/"
+                    f"{h.quantile(0.95) * 1000:.1f}/{h.max * 1000:.1f}"
+                )
+        if self.counters:
+            lines.append("事件计数:")
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"  {name}: {value}")
+        for source, stats in self.collect_sources().items():
+            values = self._flatten(stats)
+            if not values:
+                continue
+            lines.append(f"{source}:")
+            for key, value in values:
+                text = f"{value:.3f}" if not value.is_integer() else str(int(value))
+                lines.append(f"  {key}: {text}")
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _label(value: str) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render_prometheus(self) -> str:
+        """生成Prometheus文本格式，供node_exporter的textfile采集器读取"""
+        p = self.PREFIX
+        lines = [
+            f"# HELP {p}_stage_seconds 各处理阶段的耗时",
+            f"# TYPE {p}_stage_seconds histogram",
+        ]
+        for stage, h in sorted(self.histograms.items()):
+            label = self._label(stage)
+            cumulative = 0
+            for bound, count in zip(h.buckets, h.counts):
+                cumulative += count
+                lines.append(f'{p}_stage_seconds_bucket{{stage="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'{p}_stage_seconds_bucket{{stage="{label}",le="+Inf"}} {h.count}')
+            lines.append(f'{p}_stage_seconds_sum{{stage="{label}"}} {h.sum}')
+            lines.append(f'{p}_stage_seconds_count{{stage="{label}"}} {h.count}')
+
+        lines.append(f"# HELP {p}_events_total 事件计数")
+        lines.append(f"# TYPE {p}_events_total counter")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'{p}_events_total{{event="{self._label(name)}"}} {value}')
+
+        lines.append(f"# HELP {p}_component 各组件的统计值")
+        lines.append(f"# TYPE {p}_component gauge")
+        for source, stats in self.collect_sources().items():
+            for key, value in self._flatten(stats):
+                lines.append(f'{p}_component{{component="{self._label(source)}",key="{self._label(key)}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path: str, text: Optional[str] = None) -> bool:
+        """
+        先写临时文件再原子替换，避免node_exporter读到写了一半的文件
+
+        Args:
+            path: 输出文件路径
+            text: 已生成的指标文本，为None时当场生成
+        """
+        if text is None:
+            text = self.render_prometheus()
+        tmp_path = f"{path}.tmp"
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+            return True
+        except Exception as e:
+            logger.error(f"写入指标文件时出错: {str(e)}")
+            return False
+
+
+class MetricsExporter:
+    """定期将指标写入Prometheus textfile"""
+
+    def __init__(self, metrics: Metrics, path: str = '', interval: float = 60.0):
+        """
+        Args:
+            metrics: 指标实例
+            path: 输出文件路径，为空表示不导出
+            interval: 写入间隔(秒)
+        """
+        self.metrics = metrics
+        self.path = path or ''
+        self.interval = max(1.0, float(interval or 60.0))
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_config(cls, metrics: Metrics, config: dict) -> 'MetricsExporter':
+        """根据插件配置创建导出器"""
+        settings = config.get('metrics', {}) or {}
+        return cls(metrics, settings.get('textfile_path', ''), settings.get('interval', 60))
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def ensure_started(self) -> None:
+        """在事件循环中首次调用时启动定期写入任务"""
+        if not self.enabled or self._task is not None:
+            return
+        try:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        except RuntimeError:
+            # 没有运行中的事件循环，等待下次调用
+            return
+        logger.info(f"SpectreCore指标将每{self.interval:g}秒写入 {self.path}")
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            # 在事件循环中生成文本，避免与统计的更新并发；文件写入放到线程中，避免磁盘缓慢时阻塞事件循环
+            text = self.metrics.render_prometheus()
+            await loop.run_in_executor(None, self.metrics.write_textfile, self.path, text)
+
+    async def close(self) -> None:
+        """停止定期写入，并写入最后一次指标"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        self._task = None
+        self.metrics.write_textfile(self.path)
+
+
+# 全局指标实例，各模块直接记录耗时和计数
+metrics = Metrics()
@@ -0,0 +1,134 @@
+from typing import Callable, Dict, List, Optional
+import asyncio
+import time
+from astrbot.api.all import logger
+
+
+class Generation:
+    """
+    一次进行中的大模型调用
+
+    持有调用所在的任务和需要释放的资源(群组锁、调度名额)，释放操作是幂等的，
+    被抢占时可以立即归还资源，处理函数结束时再次释放也不会出错
+    """
+
+    def __init__(self, group_id, task: Optional[asyncio.Task], tokens: int,
+                 releasers: List[Callable[[], None]]):
+        self.group_id = group_id
+        self.task = task
+        # 提示词(含系统提示词)的估算token数
+        self.tokens = tokens
+        self.started_at = time.monotonic()
+        # 调用开始后新到达的消息数
+        self.new_messages = 0
+        # 大模型是否已经返回结果，返回后不再抢占
+        self.responded = False
+        self.released = False
+        self._releasers = releasers
+
+    def release(self) -> None:
+        """释放调用持有的资源，可重复调用"""
+        if self.released:
+            return
+        self.released = True
+        for releaser in self._releasers:
+            try:
+                releaser()
+            except Exception as e:
+                logger.error(f"释放大模型调用资源时出错: {str(e)}")
+
+
+class PreemptionController:
+    """
+    过期调用抢占控制器
+
+    大模型调用进行中时，如果新到达的消息超过设定数量，或有人直接@机器人，
+    就取消正在进行的调用(停止继续生成token)，由触发抢占的消息基于最新的聊天记录重新发起调用
+    """
+
+    # 默认的抢占所需新消息数，与配置界面的默认值一致
+    DEFAULT_MAX_NEW_MESSAGES = 10
+
+    def __init__(self, enabled: bool = False, max_new_messages: int = DEFAULT_MAX_NEW_MESSAGES,
+                 on_mention: bool = True):
+        """
+        Args:
+            enabled: 是否启用抢占
+            max_new_messages: 调用进行中新消息超过该数量时抢占，0表示不按消息数抢占
+            on_mention: 有人直接@机器人时是否抢占
+        """
+        self.enabled = enabled
+        self.max_new_messages = max(0, int(max_new_messages or 0))
+        self.on_mention = on_mention
+        self._generations: Dict[str, Generation] = {}
+        # 统计
+        self.cancelled = 0
+        # 被取消调用的提示词token估算，这部分已经消耗，重新发起时会再次消耗
+        self.cancelled_prompt_tokens = 0
+
+    @classmethod
+    def from_config(cls, config: Dict) -> "PreemptionController":
+        """从插件配置创建抢占控制器"""
+        preemption_config = config.get('preemption', {}) or {}
+        return cls(
+            enabled=preemption_config.get('enable', False),
+            max_new_messages=preemption_config.get('max_new_messages', cls.DEFAULT_MAX_NEW_MESSAGES),
+            on_mention=preemption_config.get('on_mention', True),
+        )
+
+    def begin(self, group_id, tokens: int, releasers: List[Callable[[], None]]) -> Generation:
+        """登记一次即将发起的大模型调用，调用所在的任务即当前任务"""
+        generation = Generation(group_id, asyncio.current_task(), tokens, releasers)
+        self._generations[str(group_id)] = generation
+        return generation
+
+    def finish(self, generation: Generation) -> None:
+        """调用结束，释放资源并取消登记"""
+        generation.release()
+        key = str(generation.group_id)
+        if self._generations.get(key) is generation:
+            del self._generations[key]
+
+    def mark_responded(self, group_id) -> None:
+        """大模型已返回结果，此后不再抢占(结果即将发送)"""
+        generation = self._generations.get(str(group_id))
+        if generation is not None:
+            generation.responded = True
+
+    def on_message(self, group_id, mentioned: bool = False) -> bool:
+        """
+        记录调用进行中到达的新消息，满足条件时抢占
+
+        Returns:
+            bool: 是否发生了抢占，抢占后应基于最新的聊天记录重新发起调用
+        """
+        if not self.enabled:
+            return False
+        key = str(group_id)
+        generation = self._generations.get(key)
+        if generation is None or generation.released or generation.responded:
+            return False
+
+        generation.new_messages += 1
+        too_many = self.max_new_messages and generation.new_messages > self.max_new_messages
+        if not too_many and not (self.on_mention and mentioned):
+            return False
+
+        # 取消调用所在的任务，正在进行的请求随之中断，并立即归还锁和调度名额
+        if generation.task is not None and not generation.task.done():
+            generation.task.cancel()
+        del self._generations[key]
+        generation.release()
+        self.cancelled += 1
+        self.cancelled_prompt_tokens += generation.tokens
+        reason = "有人@机器人" if mentioned else f"新增 {generation.new_messages} 条消息"
+        logger.info(f"群 {group_id} 的大模型调用已过期({reason})，已取消并将重新发起")
+        return True
+
+    def stats(self) -> Dict:
+        """获取抢占统计"""
+        return {
+            'in_flight': len(self._generations),
+            'cancelled': self.cancelled,
+            'cancelled_prompt_tokens': self.cancelled_prompt_tokens,
+        }
@@ -1,6 +1,5 @@
 from typing import Dict, List
-from astrbot.api.all import logger
-from ..cache import name_cache
+from ..member_directory import member_directory
 from ..api_client import APIClient
 
 class AtProcessor:
@@ -12,27 +11,29 @@ class AtProcessor:
         for msg in messages:
             sender = msg.get('sender', {})
             if str(sender.get('user_id')) == user_id:
-                return sender.get('nickname', '')
+                return sender.get('card') or sender.get('nickname', '')
         return ''
     
     @classmethod
-    async def process_at_segment(cls, segment: Dict, messages: List[Dict], client, group_id: int) -> str:
+    async def process_at_segment(cls, segment: Dict, messages: List[Dict], client, group_id: int, history=None) -> str:
         """处理@类型消息段"""
         qq = segment['data']['qq']
         if qq == 'all':
             return "[@全体成员]"
         
         # 多级查找用户名
-        # 1. 检查缓存
-        username = name_cache.get(qq)
+        # 1. 检查群成员名录
+        username = member_directory.get_name(group_id, qq)
         if username:
             return f"[@{username}(id:{qq})]"
-        # 2. 检查历史消息
-        if messages:
+        # 2. 检查历史消息(群消息历史的名称索引，以及本批次的原始消息)
+        if history is not None:
+            username = history.get_name(qq)
+        if not username and messages:
             username = cls.find_username_in_messages(qq, messages)
-            if username:
-                name_cache.put(qq, username)
-                return f"[@{username}(id:{qq})]"
+        if username:
+            member_directory.observe(group_id, qq, username)
+            return f"[@{username}(id:{qq})]"
         # 3. 尝试API获取
         if client and group_id:
             username = await APIClient.get_group_member_info(client, group_id, qq)
@@ -1,61 +1,190 @@
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
+import asyncio
 import time as time_module
 from astrbot.api.all import logger
+from ..api_client import APIClient
 
 class ForwardProcessor:
-    """处理合并转发类消息"""
-    
+    """
+    处理合并转发类消息
+
+    使用显式栈单次遍历合并转发(包括嵌套的合并转发)，同时生成结构化的消息记录和文本展示，
+    并限制嵌套层数、子消息总数和总字符数，避免超大的合并转发阻塞消息入库。
+    只带有转发ID、不含内容的合并转发先通过异步预处理获取内容，渲染本身是同步的
+    """
+
+    # 最多展开的嵌套层数(最外层为1)
+    MAX_DEPTH = 3
+    # 最多处理的子消息总数(包括嵌套的子消息)
+    MAX_MESSAGES = 200
+    # 子消息内容的总字符数上限
+    MAX_CHARS = 20000
+
     @classmethod
-    async def process_forward_message(cls, forward_data: Dict, sender_info: Dict = None, msg_time: int = None) -> Dict:
+    def configure(cls, config: Dict) -> None:
+        """根据插件配置设置合并转发的处理上限"""
+        limits = config.get('forward_limits', {}) or {}
+        cls.MAX_DEPTH = max(1, int(limits.get('max_depth', cls.MAX_DEPTH)))
+        cls.MAX_MESSAGES = max(1, int(limits.get('max_messages', cls.MAX_MESSAGES)))
+        cls.MAX_CHARS = max(1, int(limits.get('max_chars', cls.MAX_CHARS)))
+
+    @classmethod
+    async def process_forward_message(cls, forward_data: Dict, sender_info: Dict = None, msg_time: int = None,
+                                      client = None) -> Dict:
         """处理合并转发消息,保持嵌套结构
-        
+
         Args:
             forward_data: 合并转发消息数据
             sender_info: 发送者信息，如果为None则尝试从forward_data中获取
             msg_time: 消息时间戳，如果为None则使用当前时间
+            client: 消息客户端，用于获取只有转发ID的合并转发内容
+        """
+        await cls.resolve_forward(forward_data, client)
+        record, _ = cls.render_forward(forward_data, sender_info, msg_time)
+        return record
+
+    @classmethod
+    async def resolve_forward(cls, forward_data: Dict, client = None) -> None:
+        """
+        获取只有转发ID的合并转发(包括嵌套的)的内容，直接填入forward_data
+
+        按层并发获取，层数和子消息数受与渲染相同的上限约束
+        """
+        if client is None:
+            return
+        level = [forward_data]
+        message_count = 0
+        for _ in range(cls.MAX_DEPTH):
+            missing = [data for data in level if 'content' not in data and data.get('id')]
+            if missing:
+                results = await asyncio.gather(
+                    *(APIClient.get_forward_message(client, data['id']) for data in missing),
+                    return_exceptions=True
+                )
+                for data, result in zip(missing, results):
+                    # 获取失败的合并转发按空内容渲染，不影响同一层的其他合并转发
+                    if isinstance(result, dict):
+                        data['content'] = result.get('content') or []
+                    else:
+                        if isinstance(result, BaseException):
+                            logger.error(f"获取合并转发消息内容失败, ID: {data['id']}, 错误: {str(result)}")
+                        data['content'] = []
+
+            # 收集下一层嵌套的合并转发
+            next_level = []
+            for data in level:
+                for msg in data.get('content') or []:
+                    message_count += 1
+                    if message_count > cls.MAX_MESSAGES:
+                        return
+                    for seg in msg.get('message', []):
+                        if seg.get('type') == 'forward' and isinstance(seg.get('data'), dict):
+                            next_level.append(seg['data'])
+            if not next_level:
+                return
+            level = next_level
+
+    @classmethod
+    def render_forward(cls, forward_data: Dict, sender_info: Dict = None, msg_time: int = None) -> Tuple[Dict, str]:
+        """
+        单次遍历合并转发消息，同时生成结构化记录和文本展示
+
+        Args:
+            forward_data: 合并转发消息数据
+            sender_info: 发送者信息，如果为None则尝试从forward_data中获取
+            msg_time: 消息时间戳，如果为None则使用当前时间
+
+        Returns:
+            Tuple[Dict, str]: 结构化的消息记录，以及文本展示
         """
         # 设置默认的发送者和时间
         sender_info = cls._get_sender_info(forward_data, sender_info)
         msg_time = msg_time or int(time_module.time())
-        
+
         # 格式化发送者和时间信息
         sender_text = f"{sender_info.get('nickname', '未知用户')}(id:{sender_info.get('user_id', '未知')})"
         time_text = time_module.strftime('%Y-%m-%d %H:%M:%S', time_module.localtime(msg_time))
-        
-        # 处理合并转发中的子消息
-        forward_messages = []
-        if 'content' in forward_data:
-            for msg in forward_data['content']:
-                processed_msg = await cls._process_sub_message(msg)
-                forward_messages.append(processed_msg)
-
-        logger.debug(f"处理合并转发消息，发送者: {sender_text}, 包含 {len(forward_messages)} 条子消息")
-        
-        return {
+
+        record = {
             'time': time_text,
             'sender': sender_text,
             'content': '[合并转发消息]',
             'resources': [],
-            'forward_messages': forward_messages
+            'forward_messages': []
         }
-    
+
+        # 栈中每一项为(待处理的子消息迭代器, 处理结果存放的列表, 嵌套层数)
+        stack = [(iter(forward_data.get('content') or []), record['forward_messages'], 1)]
+        message_count = 0
+        char_count = 0
+        truncated = False
+        while stack:
+            pending, target, depth = stack[-1]
+            msg = next(pending, None)
+            if msg is None:
+                stack.pop()
+                continue
+            if message_count >= cls.MAX_MESSAGES or char_count >= cls.MAX_CHARS:
+                truncated = True
+                break
+
+            processed_msg, nested = cls._process_sub_message(msg)
+            # 超出字符上限的部分截断
+            remaining = cls.MAX_CHARS - char_count
+            if len(processed_msg['content']) > remaining:
+                processed_msg['content'] = processed_msg['content'][:remaining] + '...'
+                truncated = True
+            message_count += 1
+            char_count += len(processed_msg['content'])
+            target.append(processed_msg)
+
+            # 嵌套的合并转发压栈，处理完其子消息后再继续处理当前层
+            if nested is not None and depth < cls.MAX_DEPTH:
+                processed_msg['forward_messages'] = []
+                stack.append((iter(nested.get('content') or []), processed_msg['forward_messages'], depth + 1))
+
+        if truncated:
+            record['forward_messages'].append({
+                'time': time_text,
+                'sender': sender_text,
+                'content': '[合并转发消息过长，其余内容已省略]',
+                'resources': []
+            })
+            logger.debug(f"合并转发消息超出处理上限，已处理 {message_count} 条子消息，{char_count} 个字符")
+
+        logger.debug(f"处理合并转发消息，发送者: {sender_text}, 包含 {len(record['forward_messages'])} 条子消息")
+        return record, cls._format_text(record['forward_messages'])
+
+    @classmethod
+    def _format_text(cls, forward_messages: List[Dict]) -> str:
+        """格式化合并转发消息的文本展示"""
+        formatted_msgs = [f"{msg.get('sender', '')}: {msg.get('content', '')}" for msg in forward_messages]
+        if formatted_msgs:
+            return "[合并转发消息]\n" + '\n'.join(formatted_msgs)
+        return "[空的合并转发消息]"
+
     @classmethod
     def _get_sender_info(cls, forward_data: Dict, sender_info: Dict = None) -> Dict:
         """获取发送者信息"""
         if sender_info is not None:
             return sender_info
-            
+
         if 'sender' in forward_data:
             return forward_data.get('sender', {})
-            
+
         return {'nickname': '未知用户', 'user_id': '未知'}
-    
+
     @classmethod
-    async def _process_sub_message(cls, msg: Dict) -> Dict:
-        """处理合并转发消息中的子消息"""
+    def _process_sub_message(cls, msg: Dict) -> Tuple[Dict, Optional[Dict]]:
+        """
+        处理合并转发消息中的子消息
+
+        Returns:
+            Tuple[Dict, Optional[Dict]]: 处理后的子消息，以及其中嵌套的合并转发数据(没有则为None)
+        """
         sender = msg.get('sender', {})
         processed_msg = {
-            'time': time_module.strftime('%Y-%m-%d %H:%M:%S', 
+            'time': time_module.strftime('%Y-%m-%d %H:%M:%S',
                               time_module.localtime(msg.get('time', 0))),
             'sender': f"{sender.get('nickname', '未知用户')}(id:{sender.get('user_id', '未知')})",
             'content': '',
@@ -63,58 +192,36 @@ class ForwardProcessor:
         }
 
         # 处理消息内容
+        nested = None
         content_segments = []
         for seg in msg.get('message', []):
-            segment_text = await cls._process_message_segment(seg, sender, msg.get('time', 0), processed_msg)
-            content_segments.append(segment_text)
+            if seg['type'] == 'forward':
+                nested = seg['data']
+            content_segments.append(cls._process_message_segment(seg))
 
         processed_msg['content'] = ''.join(content_segments)
-        return processed_msg
-    
+        return processed_msg, nested
+
     @classmethod
-    async def _process_message_segment(cls, seg: Dict, sender: Dict, msg_time: int, processed_msg: Dict) -> str:
+    def _process_message_segment(cls, seg: Dict) -> str:
         """处理消息段"""
         if seg['type'] == 'forward':
-            # 递归处理嵌套的合并转发
-            nested_forward = await cls.process_forward_message(
-                seg['data'],
-                sender,
-                msg_time
-            )
-            processed_msg['forward_messages'] = nested_forward['forward_messages']
+            # 嵌套的合并转发由调用方压栈处理
             return '[合并转发消息]'
-            
+
         elif seg['type'] == 'text':
             return seg['data']['text']
-            
+
         elif seg['type'] == 'image':
             return '[图片]'
-            
+
         elif seg['type'] == 'face':
             face_text = seg['data'].get('raw', {}).get('faceText', '表情')
             return f"[QQ表情:{face_text}]"
-            
+
         elif seg['type'] == 'at':
             qq = seg['data']['qq']
             return "[@全体成员]" if qq == 'all' else f"[@{qq}]"
-        
+
         # 默认未知类型
         return f"[未知类型:{seg['type']}]"
-    
-    @classmethod
-    async def format_forward_message(cls, forward_data: Dict) -> str:
-        """将合并转发消息格式化为文本展示"""
-        content = await cls.process_forward_message(forward_data)
-        if not content or 'forward_messages' not in content:
-            return "[空的合并转发消息]"
-            
-        # 格式化展示合并转发消息
-        formatted_msgs = []
-        for msg in content.get('forward_messages', []):
-            sender = msg.get('sender', '')
-            msg_content = msg.get('content', '')
-            formatted_msgs.append(f"{sender}: {msg_content}")
-                
-        if formatted_msgs:
-            return "[合并转发消息]\n" + '\n'.join(formatted_msgs)
-        return "[空的合并转发消息]" 
\ No newline at end of file
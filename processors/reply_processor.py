@@ -1,110 +1,176 @@
-from typing import Dict, List, Tuple
-import asyncio
+from typing import Dict, List, Optional, Set, Tuple
 from astrbot.api.all import logger
-from ..cache import name_cache, message_cache
+from ..cache import message_cache, quote_cache
 from ..api_client import APIClient
 
+# (文本, 是否完整展开, 文本中引用的嵌套层数)
+Rendered = Tuple[Optional[str], bool, int]
+
 class ReplyProcessor:
     """处理回复引用类消息"""
     
+    # 引用链最多展开的层数
+    MAX_QUOTE_DEPTH = 5
+
     @classmethod
-    def format_quoted_message(cls, msg_data: Dict) -> Tuple[str, str]:
-        """格式化引用消息,返回(发送者信息, 消息内容)"""
-        from .segment_processor import SegmentProcessor  # 避免循环导入
-        
-        if not msg_data:
-            return "未知用户", "未知消息"
-            
-        sender = msg_data.get('sender', {})
-        sender_text = f"{sender.get('nickname', '未知用户')}(id:{sender.get('user_id', '未知')})"
+    async def process_quoted_message(cls, msg_data: Dict, messages: List[Dict] = None, client = None, group_id: int = None,
+                                     history = None, depth: int = 0, seen: Optional[Set[str]] = None) -> str:
+        """
+        处理引用消息及其引用链
 
-        # 处理每个消息段
-        message_segments = []
-        for seg in msg_data.get('message', []):
-            if seg['type'] == 'text':
-                message_segments.append(seg['data']['text'])
-            elif seg['type'] == 'image':
-                data = seg['data']
-                if 'summary' in data and data['summary']:
-                    message_segments.append(f"[QQ表情:{data['summary']}]")
-                else:
-                    message_segments.append("[图片]")
-            elif seg['type'] == 'face':
-                face_data = seg['data'].get('raw', {})
-                face_text = face_data.get('faceText', '表情')
-                message_segments.append(f"[QQ表情:{face_text}]")
-            elif seg['type'] == 'at':
-                qq = seg['data']['qq']
-                if qq == 'all':
-                    message_segments.append("[@全体成员]")
-                else:
-                    name = name_cache.get(qq) or f"用户(id:{qq})"
-                    message_segments.append(f"[@{name}]")
-        
-        return sender_text, ''.join(message_segments) or "非文本消息"
+        引用链最多展开MAX_QUOTE_DEPTH层，遇到循环引用时停止展开；
+        完整展开的渲染结果按消息ID缓存，同一条消息被多次引用时无需重新获取和渲染
+        """
+        return (await cls._render_quoted(msg_data, messages, client, group_id, history, depth, seen))[0]
+
+    @classmethod
+    def _get_cached(cls, message_id: str, depth: int) -> Optional[Rendered]:
+        """读取缓存的完整引用链，在当前深度展开会超出上限时视为未命中"""
+        cached = quote_cache.get(message_id)
+        if cached is None:
+            return None
+        text, levels = cached
+        if depth + levels >= cls.MAX_QUOTE_DEPTH:
+            return None
+        return text, True, levels
 
     @classmethod
-    async def process_quoted_message(cls, msg_data: Dict, messages: List[Dict] = None, client = None, group_id: int = None) -> str:
-        """递归处理引用消息"""
+    async def _render_quoted(cls, msg_data: Dict, messages: List[Dict] = None, client = None, group_id: int = None,
+                             history = None, depth: int = 0, seen: Optional[Set[str]] = None) -> Rendered:
+        """
+        渲染引用消息
+
+        格式与群消息历史中的记录一致: "发送者(id:xxx)的消息:内容"，内容中的引用渲染为[引用...]，
+        因此无论被引用的消息来自历史记录还是API，提示词中的文本都相同。
+        因达到深度上限或循环引用而未展开的结果取决于引用位置，不写入缓存
+        """
+        from .segment_processor import SegmentProcessor  # 避免循环导入
+
         if not msg_data:
-            return "未知消息"
+            return "未知消息", True, 0
 
-        # 直接处理当前消息的内容
-        segments = []
-        has_reply = False
-        reply_content = None
+        message_id = msg_data.get('message_id')
+        cache_key = str(message_id) if message_id else None
+        if cache_key:
+            cached = cls._get_cached(cache_key, depth)
+            if cached is not None:
+                return cached
 
-        # 先处理引用部分
+        parts = []
+        complete = True
+        levels = 0
         for seg in msg_data.get('message', []):
-            if seg['type'] == 'reply':
-                has_reply = True
-                reply_id = str(seg['data']['id'])
-                quoted_msg = None
-                logger.debug(f"递归处理引用消息, ID: {reply_id}")
-                
-                # 获取被引用的消息
-                quoted_msg = message_cache.get(reply_id)
-                
-                if not quoted_msg and messages:
-                    quoted_msg = cls.find_message_in_history(reply_id, messages)
-                    if quoted_msg:
-                        message_cache.put(reply_id, quoted_msg)
-                
-                if not quoted_msg and client:
-                    quoted_msg = await APIClient.get_message_by_id(client, reply_id)
-                    if quoted_msg:
-                        message_cache.put(reply_id, quoted_msg)
-                
-                if quoted_msg:
-                    reply_content = await cls.process_quoted_message(
-                        quoted_msg, messages, client, group_id
-                    )
-            else:
-                # 处理当前消息的其他部分
-                if seg['type'] == 'text':
-                    segments.append(seg['data']['text'])
-                elif seg['type'] == 'image':
-                    data = seg['data']
-                    if 'summary' in data and data['summary']:
-                        segments.append(f"[QQ表情:{data['summary']}]")
-                    else:
-                        segments.append("[图片]")
-                elif seg['type'] == 'face':
-                    face_data = seg['data'].get('raw', {})
-                    face_text = face_data.get('faceText', '表情')
-                    segments.append(f"[QQ表情:{face_text}]")
-
-        # 组装消息内容
-        current_content = ''.join(segments)
+            if seg['type'] != 'reply':
+                parts.append(await SegmentProcessor.process_message_segment(seg, messages, client, group_id, history))
+                continue
+            text, quote_complete, quote_levels = await cls._render_nested(
+                str(seg['data']['id']), cache_key, messages, client, group_id, history, depth, seen
+            )
+            parts.append(text)
+            complete = complete and quote_complete
+            levels = max(levels, quote_levels)
+
         sender = msg_data.get('sender', {})
         sender_text = f"{sender.get('nickname', '未知用户')}(id:{sender.get('user_id', '未知')})"
-        
-        # 如果有引用，拼接引用和当前消息
-        if has_reply and reply_content:
-            return f"{reply_content} -> {sender_text}的消息:{current_content}"
-        else:
-            # 如果是最底层消息，只返回当前内容
-            return f"{sender_text}的消息:{current_content}"
+        result = f"{sender_text}的消息:{''.join(parts)}"
+
+        if cache_key and complete:
+            quote_cache.put(cache_key, (result, levels))
+        return result, complete, levels
+
+    @classmethod
+    async def _render_record(cls, record: Dict, messages: List[Dict], client, group_id: int,
+                             history = None, depth: int = 0, seen: Optional[Set[str]] = None) -> Rendered:
+        """
+        渲染群消息历史中被引用的记录
+
+        记录的content已经格式化，其中的引用在入库时展开，'quotes'记录了每个引用在content中的位置。
+        引用部分按当前深度重新展开，使深度上限和循环检测同样适用于来自历史记录的引用，
+        引用链的长度不会随着连续回复而增长
+        """
+        message_id = record.get('message_id')
+        cache_key = str(message_id) if message_id is not None else None
+        content = record.get('content', '')
+        parts = []
+        position = 0
+        complete = True
+        levels = 0
+        for quote in record.get('quotes') or []:
+            parts.append(content[position:quote['start']])
+            text, quote_complete, quote_levels = await cls._render_nested(
+                str(quote['id']), cache_key, messages, client, group_id, history, depth, seen
+            )
+            parts.append(text)
+            complete = complete and quote_complete
+            levels = max(levels, quote_levels)
+            position = quote['end']
+        parts.append(content[position:])
+        result = f"{record.get('sender', '未知用户')}的消息:{''.join(parts)}"
+
+        if cache_key and complete:
+            quote_cache.put(cache_key, (result, levels))
+        return result, complete, levels
+
+    @classmethod
+    async def _render_nested(cls, reply_id: str, parent_id: Optional[str], messages: List[Dict], client,
+                             group_id: int, history = None, depth: int = 0,
+                             seen: Optional[Set[str]] = None) -> Rendered:
+        """渲染被引用消息中的下一层引用，返回[引用...]形式的文本"""
+        seen = set(seen or ())
+        if parent_id:
+            seen.add(parent_id)
+        if reply_id in seen:
+            logger.debug(f"检测到循环引用, ID: {reply_id}")
+            return "[引用...]", False, 1
+        if depth + 1 >= cls.MAX_QUOTE_DEPTH:
+            # 超出深度的更早引用不再展开
+            return "[引用...]", False, 1
+
+        logger.debug(f"递归处理引用消息, ID: {reply_id}")
+        content, complete, levels = await cls._render_reply(
+            reply_id, messages, client, group_id, history, depth + 1, seen
+        )
+        if content is None:
+            return f"[引用消息:未找到消息内容(id:{reply_id})]", complete, 1
+        return f"[引用{content}]", complete, levels + 1
+
+    @classmethod
+    async def _render_reply(cls, reply_id: str, messages: List[Dict], client, group_id: int,
+                            history = None, depth: int = 0, seen: Optional[Set[str]] = None) -> Rendered:
+        """
+        获取并渲染被引用的消息，文本为None表示未找到
+
+        多级查找: 引用渲染缓存 -> 群消息历史索引 -> 消息存储 -> 消息缓存 -> 本批次消息 -> API
+        """
+        cached = cls._get_cached(reply_id, depth)
+        if cached is not None:
+            return cached
+
+        record = history.get(reply_id) if history is not None else None
+        if record is None and history is not None and history.lookup is not None:
+            # 已移出内存的较早消息按ID从存储后端查找，避免调用get_msg接口
+            record = await history.lookup(reply_id)
+        if record:
+            return await cls._render_record(record, messages, client, group_id, history, depth, seen)
+
+        quoted_msg = message_cache.get(reply_id)
+
+        if not quoted_msg and messages:
+            quoted_msg = cls.find_message_in_history(reply_id, messages)
+            if quoted_msg:
+                message_cache.put(reply_id, quoted_msg)
+
+        # 最近查询失败过的消息不再重复请求
+        if not quoted_msg and client and not message_cache.is_negative(reply_id):
+            quoted_msg = await APIClient.get_message_by_id(client, reply_id)
+            if quoted_msg:
+                message_cache.put(reply_id, quoted_msg)
+
+        if not quoted_msg:
+            return None, True, 0
+        if not quoted_msg.get('message_id'):
+            quoted_msg = dict(quoted_msg, message_id=reply_id)
+        return await cls._render_quoted(quoted_msg, messages, client, group_id, history, depth, seen)
     
     @classmethod
     def find_message_in_history(cls, message_id: str, messages: List[Dict]) -> Dict:
@@ -127,30 +193,14 @@ class ReplyProcessor:
         return {}
     
     @classmethod
-    async def process_reply_segment(cls, segment: Dict, messages: List[Dict], client, group_id: int) -> str:
+    async def process_reply_segment(cls, segment: Dict, messages: List[Dict], client, group_id: int, history=None) -> str:
         """处理回复类型消息段"""
         reply_id = str(segment['data']['id'])
-        quoted_msg = None
         logger.debug(f"开始处理引用消息, ID: {reply_id}")
         
-        # 多级查找消息
-        # 1. 检查缓存
-        quoted_msg = message_cache.get(reply_id)
-        
-        # 2. 检查历史消息
-        if not quoted_msg and messages:
-            quoted_msg = cls.find_message_in_history(reply_id, messages)
-            if quoted_msg:
-                message_cache.put(reply_id, quoted_msg)
-            
-        # 3. 尝试API获取
-        if not quoted_msg and client:
-            quoted_msg = await APIClient.get_message_by_id(client, reply_id)
-            if quoted_msg:
-                message_cache.put(reply_id, quoted_msg)
-
-        if quoted_msg:
-            return f"[引用{await cls.process_quoted_message(quoted_msg, messages, client, group_id)}]"
+        content, _, _ = await cls._render_reply(reply_id, messages, client, group_id, history)
+        if content is not None:
+            return f"[引用{content}]"
         
         logger.warning(f"所有方法都未能获取到消息ID:{reply_id}的内容")
-        return f"[引用消息:未找到消息内容(id:{reply_id})]" 
\ No newline at end of file
+        return f"[引用消息:未找到消息内容(id:{reply_id})]"
@@ -1,83 +1,139 @@
-from typing import Dict, List
+from typing import Awaitable, Callable, Dict, List, Optional
 import asyncio
 import json
 from astrbot.api.all import logger
+from .text_processor import TextProcessor
+from .image_processor import ImageProcessor
+from .reply_processor import ReplyProcessor
+from .forward_processor import ForwardProcessor
+from .at_processor import AtProcessor
+
+# 同步处理函数: (消息段) -> 文本
+SyncHandler = Callable[[Dict], str]
+# 异步处理函数: (消息段, 消息列表, 客户端, 群号, 群消息历史) -> 文本
+AsyncHandler = Callable[[Dict, List[Dict], object, int, object], Awaitable[str]]
 
 class SegmentProcessor:
-    """处理消息段"""
-    
+    """
+    处理消息段
+
+    消息段类型到处理函数的注册表在导入时构建。不需要网络请求的消息段(文本、表情、图片、骰子、猜拳等)
+    同步渲染；只有可能访问网络的消息段(引用、@、只有转发ID的合并转发)才创建协程。
+    第三方可以通过register为新的消息段类型注册处理函数
+    """
+
+    _sync_handlers: Dict[str, SyncHandler] = {}
+    _async_handlers: Dict[str, AsyncHandler] = {}
+    # 异步处理函数的适用条件，不满足时使用同名类型的同步处理函数
+    _async_conditions: Dict[str, Callable[[Dict], bool]] = {}
+
     @classmethod
-    async def process_message_segment(cls, segment: Dict, messages: List[Dict] = None, client = None, group_id: int = None) -> str:
-        """处理单个消息段"""
-        from .text_processor import TextProcessor
-        from .image_processor import ImageProcessor
-        from .reply_processor import ReplyProcessor
-        from .forward_processor import ForwardProcessor
-        from .at_processor import AtProcessor
-        
+    def register(cls, seg_type: str, handler, is_async: bool = False,
+                 when: Optional[Callable[[Dict], bool]] = None) -> None:
+        """
+        注册消息段处理函数，已存在的同类型处理函数会被覆盖
+
+        Args:
+            seg_type: 消息段类型，如'record'、'file'、'markdown'、'poke'
+            handler: 同步处理函数handler(segment)，或异步处理函数handler(segment, messages, client, group_id, history)
+            is_async: 是否为异步处理函数
+            when: 异步处理函数的适用条件，为None时总是使用异步处理函数
+        """
+        if is_async:
+            cls._async_handlers[seg_type] = handler
+            if when is not None:
+                cls._async_conditions[seg_type] = when
+            else:
+                cls._async_conditions.pop(seg_type, None)
+        else:
+            cls._sync_handlers[seg_type] = handler
+
+    @classmethod
+    def _get_async_handler(cls, segment: Dict) -> Optional[AsyncHandler]:
+        """获取适用于该消息段的异步处理函数，不需要异步处理时返回None"""
         seg_type = segment['type']
-        
-        # 分派不同类型的消息处理
-        if seg_type == 'rps':
-            return TextProcessor.process_rps_data(segment['data']['result'])
-            
-        elif seg_type == 'dice':
-            return TextProcessor.process_dice_data(segment['data']['result'])
-            
-        elif seg_type == 'forward':
-            content = await ForwardProcessor.process_forward_message(segment['data'])
-            if content:
-                return await ForwardProcessor.format_forward_message(segment['data'])
-            return "[空的合并转发消息]"
-            
-        elif seg_type == 'json':
-            return await cls._process_json_segment(segment)
-            
-        elif seg_type == 'reply':
-            return await ReplyProcessor.process_reply_segment(segment, messages, client, group_id)
-            
-        elif seg_type == 'at':
-            return await AtProcessor.process_at_segment(segment, messages, client, group_id)
-            
-        elif seg_type == 'text':
-            return TextProcessor.process_text(segment['data'])
-            
-        elif seg_type == 'image':
-            return ImageProcessor.format_image_text(segment['data'])
-            
-        elif seg_type == 'face':
-            return TextProcessor.process_face(segment['data'])
-            
-        return f"[未知类型消息:{seg_type}]"
-        
+        handler = cls._async_handlers.get(seg_type)
+        if handler is None:
+            return None
+        condition = cls._async_conditions.get(seg_type)
+        if condition is not None and seg_type in cls._sync_handlers and not condition(segment):
+            return None
+        return handler
+
     @classmethod
-    async def _process_json_segment(cls, segment: Dict) -> str:
+    def render_sync(cls, segment: Dict) -> str:
+        """同步渲染不需要网络请求的消息段"""
+        handler = cls._sync_handlers.get(segment['type'])
+        if handler is None:
+            return f"[未知类型消息:{segment['type']}]"
+        return handler(segment)
+
+    @classmethod
+    async def process_message_segment(cls, segment: Dict, messages: List[Dict] = None, client = None, group_id: int = None,
+                                      history = None) -> str:
+        """处理单个消息段"""
+        handler = cls._get_async_handler(segment)
+        if handler is not None:
+            return await handler(segment, messages, client, group_id, history)
+        return cls.render_sync(segment)
+
+    @classmethod
+    async def process_segments(cls, segments: List[Dict], messages: List[Dict] = None, client = None,
+                               group_id: int = None, history = None, quotes: Optional[List[Dict]] = None) -> str:
+        """
+        处理一条消息的所有消息段并拼接为文本
+
+        同步的消息段直接渲染，只有需要异步处理的消息段并发执行。
+        quotes不为None时，为每个引用消息段追加{'id': 被引用的消息ID, 'start': 起始位置, 'end': 结束位置}，
+        即其渲染结果在文本中的位置
+        """
+        results = []
+        pending = []
+        for segment in segments:
+            handler = cls._get_async_handler(segment)
+            if handler is None:
+                results.append(cls.render_sync(segment))
+            else:
+                pending.append((len(results), handler(segment, messages, client, group_id, history)))
+                results.append('')
+
+        if pending:
+            rendered = await asyncio.gather(*(coro for _, coro in pending))
+            for (index, _), text in zip(pending, rendered):
+                results[index] = text
+
+        if quotes is not None:
+            position = 0
+            for segment, text in zip(segments, results):
+                if segment['type'] == 'reply':
+                    quotes.append({'id': str(segment['data']['id']), 'start': position, 'end': position + len(text)})
+                position += len(text)
+        return ''.join(results)
+
+    @classmethod
+    def _process_json_segment(cls, segment: Dict) -> str:
         """处理JSON类型的消息段，包括伪合并转发消息"""
-        from .forward_processor import ForwardProcessor
-        
         try:
             json_data = json.loads(segment['data']['data'])
-            
+
             # 处理伪合并转发消息
             if json_data.get('app') == 'com.tencent.multimsg':
                 logger.debug("处理伪合并转发消息")
-                return await cls._process_pseudo_forward(json_data)
-                
+                return cls._process_pseudo_forward(json_data)
+
             # 处理其他类型的JSON消息
             return f"[json消息: {json_data.get('desc', '未知内容')}]"
-            
+
         except Exception as e:
             logger.error(f"处理JSON段落时出错: {str(e)}", exc_info=True)
             return "[处理失败的JSON消息]"
-            
+
     @classmethod
-    async def _process_pseudo_forward(cls, json_data: Dict) -> str:
+    def _process_pseudo_forward(cls, json_data: Dict) -> str:
         """处理伪合并转发消息"""
-        from .forward_processor import ForwardProcessor
-        
         # 构建伪合并转发消息数据
         pseudo_forward_data = {'content': []}
-        
+
         # 提取消息内容
         news_items = json_data.get('meta', {}).get('detail', {}).get('news', [])
         for item in news_items:
@@ -88,17 +144,43 @@ class SegmentProcessor:
                     'message': [{'type': 'text', 'data': {'text': item['text']}}]
                 }
                 pseudo_forward_data['content'].append(pseudo_message)
-        
+
         # 使用转发处理器处理
-        content = await ForwardProcessor.process_forward_message(pseudo_forward_data)
-        
+        content, _ = ForwardProcessor.render_forward(pseudo_forward_data)
+
         # 格式化展示
         formatted_msgs = []
         for msg in content.get('forward_messages', []):
             sender = msg.get('sender', '')
             msg_content = msg.get('content', '')
             formatted_msgs.append(f"{sender}: {msg_content}")
-            
+
         if formatted_msgs:
             return "[伪合并转发消息]\n" + '\n'.join(formatted_msgs)
-        return "[空的伪合并转发消息]" 
\ No newline at end of file
+        return "[空的伪合并转发消息]"
+
+
+async def _process_forward_by_id(segment: Dict, messages, client, group_id, history) -> str:
+    """获取只有转发ID的合并转发内容后渲染"""
+    await ForwardProcessor.resolve_forward(segment['data'], client)
+    return ForwardProcessor.render_forward(segment['data'])[1]
+
+
+def _register_builtin_handlers() -> None:
+    """注册内置的消息段处理函数"""
+    register = SegmentProcessor.register
+    register('text', lambda seg: TextProcessor.process_text(seg['data']))
+    register('face', lambda seg: TextProcessor.process_face(seg['data']))
+    register('image', lambda seg: ImageProcessor.format_image_text(seg['data']))
+    register('dice', lambda seg: TextProcessor.process_dice_data(seg['data']['result']))
+    register('rps', lambda seg: TextProcessor.process_rps_data(seg['data']['result']))
+    register('json', SegmentProcessor._process_json_segment)
+    # 合并转发单次遍历同时得到结构化记录和文本，这里只需要文本；只有转发ID时先获取内容
+    register('forward', lambda seg: ForwardProcessor.render_forward(seg['data'])[1])
+    register('forward', _process_forward_by_id, is_async=True,
+             when=lambda seg: 'content' not in seg['data'] and bool(seg['data'].get('id')))
+    register('reply', ReplyProcessor.process_reply_segment, is_async=True)
+    register('at', AtProcessor.process_at_segment, is_async=True)
+
+
+_register_builtin_handlers()
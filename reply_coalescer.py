@@ -0,0 +1,61 @@
+from typing import Dict
+import asyncio
+import itertools
+from astrbot.api.all import logger
+
+
+class ReplyCoalescer:
+    """
+    回复触发合并器(后沿防抖)
+
+    大模型调用进行中或静默窗口内到达的多次触发，只保留最新的一次，
+    由它在当前调用结束后基于最新的聊天记录发起一次补充调用，而不是直接丢弃
+    """
+
+    def __init__(self, enabled: bool = False, quiet_window: float = 0.0):
+        """
+        Args:
+            enabled: 是否启用合并模式
+            quiet_window: 静默窗口(秒)，触发后等待这段时间内没有新的触发才发起调用
+        """
+        self.enabled = enabled
+        self.quiet_window = max(0.0, float(quiet_window or 0))
+        self._seq = itertools.count(1)
+        # 群号 -> 最新一次触发的序号
+        self._latest: Dict[str, int] = {}
+        # 被合并掉的触发次数
+        self.coalesced = 0
+
+    @classmethod
+    def from_config(cls, config: Dict) -> "ReplyCoalescer":
+        """从插件配置创建合并器"""
+        coalescing_config = config.get('reply_coalescing', {}) or {}
+        return cls(
+            enabled=coalescing_config.get('enable', False),
+            quiet_window=coalescing_config.get('quiet_window', 0),
+        )
+
+    def register(self, group_id) -> int:
+        """登记一次触发，返回触发序号"""
+        token = next(self._seq)
+        self._latest[str(group_id)] = token
+        return token
+
+    def is_latest(self, group_id, token: int) -> bool:
+        """触发是否仍是该群最新的一次，不是则计为被合并"""
+        if self._latest.get(str(group_id)) == token:
+            return True
+        self.coalesced += 1
+        logger.debug(f"群 {group_id} 有更新的触发，本次触发已合并")
+        return False
+
+    async def wait_quiet(self, group_id, token: int) -> bool:
+        """
+        等待静默窗口结束
+
+        Returns:
+            bool: 窗口结束时该触发是否仍是最新的
+        """
+        if self.quiet_window > 0:
+            await asyncio.sleep(self.quiet_window)
+        return self.is_latest(group_id, token)
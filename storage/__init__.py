@@ -0,0 +1,26 @@
+# 消息存储后端
+from astrbot.api.all import logger
+from .base import GroupLog, MessageStorage
+from .codec import get_codec
+from .jsonl import JsonlStorage
+from .sqlite import SqliteStorage
+
+# 配置值 -> 存储后端
+BACKENDS = {
+    'jsonl': JsonlStorage,
+    'sqlite': SqliteStorage,
+}
+
+
+def create_storage(config: dict, base_path: str) -> MessageStorage:
+    """
+    根据配置创建存储后端
+
+    storage_backend决定存储位置，未知的配置值使用默认的日志文件；storage_codec决定记录的编码格式；
+    后端的其他配置由各后端的from_config读取
+    """
+    backend = str(config.get('storage_backend', 'jsonl') or 'jsonl').lower()
+    if backend not in BACKENDS:
+        logger.warning(f"未知的存储后端 {backend}，使用默认的jsonl")
+        backend = 'jsonl'
+    return BACKENDS[backend].from_config(config, base_path, get_codec(config.get('storage_codec', 'json')))
@@ -0,0 +1,75 @@
+from typing import Dict, Hashable, List, Optional, Sequence
+
+
+class GroupLog:
+    """
+    单个群的消息存储接口
+
+    HistoryStore通过该接口读写消息，不关心消息实际保存在文件还是数据库中。
+    所有方法都不应阻塞事件循环
+    """
+
+    def __init__(self, group_id):
+        self.group_id = group_id
+        # 当前存储中的记录条数，用于判断是否需要压缩
+        self.line_count = 0
+        # 读取时是否有更早的记录未被读取
+        self.truncated = False
+
+    async def append(self, records: List[Dict]) -> bool:
+        """追加记录"""
+        raise NotImplementedError
+
+    def needs_compaction(self, max_history: int) -> bool:
+        """追加或读取后是否需要压缩存储"""
+        return False
+
+    async def compact(self, records: List[Dict], pending: Sequence[Dict] = ()) -> bool:
+        """
+        压缩该群的存储
+
+        Args:
+            records: 内存中最新的消息历史，已包含pending
+            pending: 其中尚未写入存储的记录，压缩时一并写入
+        """
+        raise NotImplementedError
+
+    async def update(self, records: List[Dict]) -> bool:
+        """用修改后的记录替换存储中的同一条记录，匹配方式见record_key"""
+        raise NotImplementedError
+
+    async def read_tail(self, count: int) -> List[Dict]:
+        """读取最新的count条记录，count不大于0时读取全部记录"""
+        raise NotImplementedError
+
+    async def get_message(self, message_id) -> Optional[Dict]:
+        """按消息ID查找记录"""
+        raise NotImplementedError
+
+    async def delete(self) -> bool:
+        """删除该群的全部记录，返回是否有记录被删除"""
+        raise NotImplementedError
+
+
+def record_key(record: Dict) -> Hashable:
+    """记录的标识: 有消息ID时使用消息ID，机器人发送的消息没有ID，使用时间、发送者和内容"""
+    message_id = record.get('message_id')
+    if message_id is not None:
+        return str(message_id)
+    return record.get('time', ''), record.get('sender', ''), record.get('content', '')
+
+
+class MessageStorage:
+    """消息存储后端，为每个群创建GroupLog"""
+
+    @classmethod
+    def from_config(cls, config: dict, base_path: str, codec) -> 'MessageStorage':
+        """从插件配置创建存储后端"""
+        return cls(base_path, codec)
+
+    def open(self, group_id) -> GroupLog:
+        """获取群的消息存储"""
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        """插件卸载时释放资源"""
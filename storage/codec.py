@@ -0,0 +1,163 @@
+from typing import Dict, Iterator, Optional, Tuple
+import json
+from astrbot.api.all import logger
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+# 日志文件格式版本，写在文件的第一行
+FORMAT_VERSION = 1
+# 版本头以#开头，不可能是合法的JSON记录，因此没有版本头的旧文件可以直接识别
+HEADER_PREFIX = b"#SPECTRECORE-LOG "
+
+
+class RecordCodec:
+    """消息记录的编码格式"""
+
+    # 写入版本头的编码名称
+    name = ''
+    # 日志文件的扩展名
+    extension = ''
+
+    def encode(self, record: Dict) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, data: bytes) -> Dict:
+        raise NotImplementedError
+
+    def encode_stream(self, records) -> bytes:
+        """将多条记录编码为日志文件的内容(不含版本头)"""
+        raise NotImplementedError
+
+    def decode_stream(self, data: bytes) -> Iterator[Dict]:
+        """从日志文件的内容(不含版本头)中逐条解码记录，跳过损坏的记录"""
+        raise NotImplementedError
+
+
+class JsonCodec(RecordCodec):
+    """
+    紧凑的JSON，每行一条记录
+
+    不缩进、不加空格；安装了orjson时使用orjson编解码，输出与标准库相同格式的UTF-8 JSON
+    """
+
+    name = 'json'
+    extension = 'jsonl'
+
+    def encode(self, record: Dict) -> bytes:
+        if ORJSON_AVAILABLE:
+            return orjson.dumps(record)
+        return json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, data: bytes) -> Dict:
+        if ORJSON_AVAILABLE:
+            return orjson.loads(data)
+        return json.loads(data)
+
+    def encode_stream(self, records) -> bytes:
+        return b''.join(self.encode(record) + b'\n' for record in records)
+
+    def decode_stream(self, data: bytes) -> Iterator[Dict]:
+        for line in data.split(b'\n'):
+            if not line.strip():
+                continue
+            try:
+                yield self.decode(line)
+            except ValueError:
+                # orjson.JSONDecodeError和json.JSONDecodeError都是ValueError的子类
+                logger.warning("跳过消息日志中损坏的行")
+
+
+class MsgpackCodec(RecordCodec):
+    """MessagePack二进制格式，记录依次连续存放，需要安装msgpack"""
+
+    name = 'msgpack'
+    extension = 'msgpack'
+
+    def encode(self, record: Dict) -> bytes:
+        return msgpack.packb(record, use_bin_type=True)
+
+    def decode(self, data: bytes) -> Dict:
+        return msgpack.unpackb(data, raw=False)
+
+    def encode_stream(self, records) -> bytes:
+        return b''.join(self.encode(record) for record in records)
+
+    def decode_stream(self, data: bytes) -> Iterator[Dict]:
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(data)
+        try:
+            for record in unpacker:
+                yield record
+        except Exception as e:
+            # 二进制流损坏后无法定位下一条记录的开头，丢弃之后的内容
+            logger.warning(f"消息日志在第 {unpacker.tell()} 字节处损坏，丢弃之后的记录: {str(e)}")
+
+
+CODECS = {
+    JsonCodec.name: JsonCodec,
+    MsgpackCodec.name: MsgpackCodec,
+}
+
+
+def get_codec(name: str = 'json') -> RecordCodec:
+    """根据名称获取编码格式，msgpack未安装或名称未知时使用JSON"""
+    name = str(name or 'json').lower()
+    if name == MsgpackCodec.name and not MSGPACK_AVAILABLE:
+        logger.warning("未安装msgpack，消息存储使用JSON格式")
+        name = JsonCodec.name
+    if name not in CODECS:
+        logger.warning(f"未知的消息存储格式 {name}，使用JSON格式")
+        name = JsonCodec.name
+    return CODECS[name]()
+
+
+def make_header(codec: RecordCodec) -> bytes:
+    """生成日志文件的版本头"""
+    return HEADER_PREFIX + f"{FORMAT_VERSION} {codec.name}\n".encode('ascii')
+
+
+def parse_header(data: bytes) -> Tuple[Optional[RecordCodec], int]:
+    """
+    解析日志文件开头的版本头
+
+    Returns:
+        (编码格式, 版本头的字节数)；没有版本头的旧文件按JSON Lines处理，返回(JsonCodec, 0)；
+        编码格式不可用时返回(None, 版本头的字节数)
+    """
+    if not data.startswith(HEADER_PREFIX):
+        return JsonCodec(), 0
+    end = data.find(b'\n')
+    if end < 0:
+        end = len(data)
+    fields = data[len(HEADER_PREFIX):end].decode('ascii', 'replace').split()
+    name = fields[1] if len(fields) > 1 else JsonCodec.name
+    if name == MsgpackCodec.name and not MSGPACK_AVAILABLE:
+        logger.error("消息日志为msgpack格式，但未安装msgpack")
+        return None, end + 1
+    codec_class = CODECS.get(name)
+    return (codec_class() if codec_class else None), end + 1
+
+
+def decode_record(data) -> Dict:
+    """
+    解码单条记录，自动识别格式
+
+    JSON记录总是以{开头；msgpack编码的字典以0x80-0x8f、0xde或0xdf开头，两者不会混淆
+    """
+    if isinstance(data, str):
+        return json.loads(data)
+    if data[:1] == b'{':
+        return JsonCodec().decode(data)
+    if not MSGPACK_AVAILABLE:
+        raise ValueError("记录为msgpack格式，但未安装msgpack")
+    return MsgpackCodec().decode(data)
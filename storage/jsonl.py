@@ -0,0 +1,219 @@
+from typing import Dict, List, Optional, Sequence
+import json
+import os
+import time
+import aiofiles
+from astrbot.api.all import logger
+from .base import GroupLog, MessageStorage, record_key
+from .codec import CODECS, JsonCodec, RecordCodec, get_codec, make_header, parse_header, HEADER_PREFIX
+
+
+class HistoryLog(GroupLog):
+    """
+    单个群的追加式消息日志
+
+    主要功能:
+    1. 新消息追加到文件末尾，写入开销与历史长度无关
+    2. JSON格式每行一条记录，从文件末尾向前读取最近N条记录，无需解析整个文件
+    3. 压缩时先写临时文件再原子替换，避免写入中断损坏日志
+    4. 文件第一行是记录格式和版本的版本头，没有版本头的旧JSON Lines日志和更早的整文件JSON可以直接读取，
+       其他格式的日志在首次读取时转换为当前格式
+    """
+
+    # 从文件末尾向前读取时每次读取的块大小
+    READ_BLOCK_SIZE = 64 * 1024
+    # 日志行数超过历史上限的倍数时压缩
+    COMPACT_FACTOR = 2
+
+    def __init__(self, base_path: str, group_id, codec: Optional[RecordCodec] = None):
+        super().__init__(group_id)
+        self.codec = codec or JsonCodec()
+        self.path = os.path.join(base_path, f"{group_id}.{self.codec.extension}")
+        # 其他格式的日志文件，切换格式后首次读取时转换
+        self.other_paths = [os.path.join(base_path, f"{group_id}.{other.extension}")
+                            for other in CODECS.values() if other.extension != self.codec.extension]
+        self.legacy_path = os.path.join(base_path, f"{group_id}.json")
+
+    def exists(self) -> bool:
+        """是否存在该群的任意格式的日志文件"""
+        return any(os.path.exists(path) for path in [self.path, *self.other_paths, self.legacy_path])
+
+    async def append(self, records: List[Dict]) -> bool:
+        """追加记录到日志末尾，新文件先写入版本头"""
+        if not records:
+            return True
+        try:
+            data = self.codec.encode_stream(records)
+            if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+                data = make_header(self.codec) + data
+            async with aiofiles.open(self.path, 'ab') as f:
+                await f.write(data)
+            self.line_count += len(records)
+            logger.debug(f"群 {self.group_id} 追加了 {len(records)} 条消息到日志")
+            return True
+        except Exception as e:
+            logger.error(f"追加消息日志时出错: {str(e)}", exc_info=True)
+            return False
+
+    def needs_compaction(self, max_history: int) -> bool:
+        """日志中有未读取的更早记录，或行数超过历史上限的COMPACT_FACTOR倍时压缩"""
+        return self.truncated or self.line_count > max_history * self.COMPACT_FACTOR
+
+    async def compact(self, records: List[Dict], pending: Sequence[Dict] = ()) -> bool:
+        """用给定的记录原子地重写日志，records已包含尚未写入的记录"""
+        tmp_path = f"{self.path}.tmp"
+        try:
+            async with aiofiles.open(tmp_path, 'wb') as f:
+                await f.write(make_header(self.codec) + self.codec.encode_stream(records))
+            os.replace(tmp_path, self.path)
+            self.line_count = len(records)
+            self.truncated = False
+            logger.debug(f"群 {self.group_id} 的消息日志已压缩为 {len(records)} 条")
+            return True
+        except Exception as e:
+            logger.error(f"压缩消息日志时出错: {str(e)}", exc_info=True)
+            return False
+
+    async def update(self, records: List[Dict]) -> bool:
+        """日志无法原地修改，读取全部记录，替换修改过的记录后重写日志"""
+        updated = {record_key(record): record for record in records}
+        stored = await self._read_all()
+        if not stored:
+            # 读取失败时不能用空列表覆盖日志
+            return False
+        return await self.compact([updated.get(record_key(record), record) for record in stored])
+
+    async def read_tail(self, count: int) -> List[Dict]:
+        """
+        读取日志中最新的count条记录
+
+        JSON格式从文件末尾按块向前读取，直到凑够所需的行数；二进制格式没有行分隔，读取整个文件
+        """
+        if not os.path.exists(self.path):
+            return await self._migrate(count)
+        if not isinstance(self.codec, JsonCodec):
+            records = await self._read_file(self.path)
+            self.line_count = len(records)
+            self.truncated = count > 0 and len(records) > count
+            return records[-count:] if count > 0 else records
+
+        try:
+            async with aiofiles.open(self.path, 'rb') as f:
+                await f.seek(0, os.SEEK_END)
+                position = await f.tell()
+                buffer = b''
+                # 多读一行，保证最前面的一行是完整的；count不大于0时读取整个文件
+                while position > 0 and (count <= 0 or buffer.count(b'\n') <= count):
+                    read_size = min(self.READ_BLOCK_SIZE, position)
+                    position -= read_size
+                    await f.seek(position)
+                    buffer = await f.read(read_size) + buffer
+        except Exception as e:
+            logger.error(f"读取消息日志时出错: {str(e)}")
+            return []
+
+        if position > 0:
+            # 第一行可能不完整，丢弃
+            buffer = buffer[buffer.find(b'\n') + 1:]
+        elif buffer.startswith(HEADER_PREFIX):
+            codec, offset = parse_header(buffer)
+            if not isinstance(codec, JsonCodec):
+                logger.error(f"消息日志的格式与文件扩展名不符: {self.path}")
+                return []
+            buffer = buffer[offset:]
+
+        records = list(self.codec.decode_stream(buffer))
+        self.line_count = len(records)
+        # 未读完整个文件说明日志中还有更早的记录，需要压缩
+        self.truncated = position > 0
+        return records[-count:] if count > 0 else records
+
+    async def _read_file(self, path: str) -> List[Dict]:
+        """读取并解码整个日志文件，格式由版本头决定"""
+        try:
+            async with aiofiles.open(path, 'rb') as f:
+                data = await f.read()
+        except Exception as e:
+            logger.error(f"读取消息日志时出错: {str(e)}")
+            return []
+        codec, offset = parse_header(data)
+        if codec is None:
+            return []
+        return list(codec.decode_stream(data[offset:]))
+
+    async def _read_all(self) -> List[Dict]:
+        """读取日志中的全部记录，日志文件只能解析整个文件"""
+        if not os.path.exists(self.path):
+            return await self._migrate(0)
+        return await self._read_file(self.path)
+
+    async def get_message(self, message_id) -> Optional[Dict]:
+        """按消息ID查找记录，需要解析整个日志"""
+        message_id = str(message_id)
+        for record in reversed(await self._read_all()):
+            if str(record.get('message_id')) == message_id:
+                return record
+        return None
+
+    async def _migrate(self, count: int) -> List[Dict]:
+        """将其他格式的日志或旧版的整文件JSON转换为当前格式"""
+        for path in self.other_paths:
+            if not os.path.exists(path):
+                continue
+            records = await self._read_file(path)
+            records = records[-count:] if count > 0 else records
+            if await self.compact(records):
+                os.remove(path)
+                logger.info(f"群 {self.group_id} 的消息日志已转换为{self.codec.name}格式")
+            return records
+        return await self._migrate_legacy(count)
+
+    async def _migrate_legacy(self, count: int) -> List[Dict]:
+        """将旧版的整文件JSON格式迁移为JSON Lines日志"""
+        if not os.path.exists(self.legacy_path):
+            return []
+
+        try:
+            async with aiofiles.open(self.legacy_path, 'r', encoding='utf-8') as f:
+                content = await f.read()
+            data = json.loads(content) if content.strip() else {}
+            records = data.get('messages', [])[-count:] if count > 0 else data.get('messages', [])
+        except json.JSONDecodeError:
+            logger.error(f"JSON解析错误，文件可能损坏: {self.legacy_path}")
+            # 备份损坏的文件
+            backup_path = f"{self.legacy_path}.backup.{int(time.time())}"
+            try:
+                os.rename(self.legacy_path, backup_path)
+                logger.info(f"已将损坏的文件备份为: {backup_path}")
+            except Exception as be:
+                logger.error(f"备份损坏文件失败: {str(be)}")
+            return []
+        except Exception as e:
+            logger.error(f"读取旧版消息文件时出错: {str(e)}")
+            return []
+
+        if await self.compact(records):
+            os.remove(self.legacy_path)
+            logger.info(f"群 {self.group_id} 的消息历史已迁移为{self.codec.name}格式的日志")
+        return records
+
+    async def delete(self) -> bool:
+        """删除日志文件(包括旧版文件)，返回是否有文件被删除"""
+        existed = False
+        for path in (self.path, *self.other_paths, self.legacy_path):
+            if os.path.exists(path):
+                os.remove(path)
+                existed = True
+        self.line_count = 0
+        return existed
+
+
+class JsonlStorage(MessageStorage):
+    """默认的存储后端，每个群一个日志文件(默认为JSON Lines格式)"""
+
+    def __init__(self, base_path: str, codec: Optional[RecordCodec] = None):
+        self.base_path = base_path
+        self.codec = codec or get_codec()
+
+    def open(self, group_id) -> HistoryLog:
+        return HistoryLog(self.base_path, group_id, self.codec)
@@ -0,0 +1,286 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence
+import asyncio
+import os
+import sqlite3
+from astrbot.api.all import logger
+from .base import GroupLog, MessageStorage, record_key
+from .codec import FORMAT_VERSION, RecordCodec, decode_record, get_codec
+from .jsonl import HistoryLog
+
+
+class SqliteStorage(MessageStorage):
+    """
+    SQLite存储后端，所有群的消息保存在同一个数据库中
+
+    主要功能:
+    1. WAL模式，读取不会被写入阻塞，每次追加只写入新增的行
+    2. (group_id, id)索引用于读取最新的记录，(group_id, message_id)索引用于按消息ID查找被引用的消息，都无需读取全部消息
+    3. 批量写入在同一个事务中用executemany完成
+    4. 所有数据库操作在单独的单线程执行器中进行，不阻塞事件循环，也无需跨线程共享连接
+    5. 记录按配置的格式编码，读取时按内容自动识别格式，数据库格式版本保存在user_version中
+    6. 默认保留全部历史，不随内存历史压缩；可以设置每个群保留的消息数，超出后删除最早的记录，
+       修改过的记录(如后台计算的图片哈希)原地更新
+    """
+
+    DB_NAME = "messages.db"
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id TEXT NOT NULL,
+            message_id TEXT,
+            time TEXT NOT NULL DEFAULT '',
+            data BLOB NOT NULL
+        )""",
+        # 按群读取最新的记录和清理最早的记录时按插入顺序扫描，无需排序
+        "CREATE INDEX IF NOT EXISTS idx_messages_group_id ON messages (group_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_group_message ON messages (group_id, message_id)",
+        # 早期版本按时间建立的索引没有查询使用，只增加写入开销
+        "DROP INDEX IF EXISTS idx_messages_group_time",
+    )
+
+    def __init__(self, base_path: str, codec: Optional[RecordCodec] = None, max_messages: int = 0):
+        """
+        Args:
+            base_path: 数据库所在目录，也是旧版日志文件所在的目录
+            codec: 记录的编码格式，默认为紧凑的JSON
+            max_messages: 每个群保留的消息数，0表示保留全部
+        """
+        self.base_path = base_path
+        self.codec = codec or get_codec()
+        self.max_messages = max(0, int(max_messages or 0))
+        self.path = os.path.join(base_path, self.DB_NAME)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="spectrecore-sqlite")
+        self._conn: Optional[sqlite3.Connection] = None
+
+    @classmethod
+    def from_config(cls, config: dict, base_path: str, codec: RecordCodec) -> 'SqliteStorage':
+        """从插件配置创建存储后端，sqlite_max_messages为每个群保留的消息数"""
+        return cls(base_path, codec, max_messages=config.get('sqlite_max_messages', 0))
+
+    def open(self, group_id) -> 'SqliteGroupLog':
+        return SqliteGroupLog(self, group_id)
+
+    def _connect(self) -> sqlite3.Connection:
+        """在执行器线程中打开连接并初始化表结构"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            if conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+                conn.execute(f"PRAGMA user_version = {FORMAT_VERSION}")
+            self._conn = conn
+        return self._conn
+
+    async def run(self, fn: Callable[[sqlite3.Connection], object]):
+        """在执行器线程中执行数据库操作"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: fn(self._connect()))
+
+    async def close(self) -> None:
+        """关闭连接并停止执行器"""
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._executor, _close)
+        except Exception as e:
+            logger.error(f"关闭消息数据库时出错: {str(e)}")
+        self._executor.shutdown(wait=False)
+
+
+class SqliteGroupLog(GroupLog):
+    """SQLite中单个群的消息"""
+
+    def __init__(self, storage: SqliteStorage, group_id):
+        super().__init__(group_id)
+        self.storage = storage
+        self.key = str(group_id)
+
+    def _rows(self, records: List[Dict]) -> List[tuple]:
+        return [
+            (self.key,
+             None if record.get('message_id') is None else str(record['message_id']),
+             record.get('time', ''),
+             self.storage.codec.encode(record))
+            for record in records
+        ]
+
+    def _decode_rows(self, rows) -> List[Dict]:
+        records = []
+        for (data,) in rows:
+            try:
+                records.append(decode_record(data))
+            except ValueError:
+                logger.warning(f"跳过消息数据库中群 {self.group_id} 损坏的记录")
+        return records
+
+    async def append(self, records: List[Dict]) -> bool:
+        """在一个事务中批量插入记录"""
+        if not records:
+            return True
+        rows = self._rows(records)
+
+        def _append(conn: sqlite3.Connection):
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany(
+                    "INSERT INTO messages (group_id, message_id, time, data) VALUES (?, ?, ?, ?)", rows
+                )
+
+        try:
+            await self.storage.run(_append)
+            self.line_count += len(records)
+            logger.debug(f"群 {self.group_id} 写入了 {len(records)} 条消息到数据库")
+            return True
+        except Exception as e:
+            logger.error(f"写入消息数据库时出错: {str(e)}", exc_info=True)
+            return False
+
+    def needs_compaction(self, max_history: int) -> bool:
+        """数据库保留内存历史之外的较早记录，只在超出保留的消息数时清理"""
+        max_messages = self.storage.max_messages
+        return bool(max_messages) and self.line_count > max_messages
+
+    async def compact(self, records: List[Dict], pending: Sequence[Dict] = ()) -> bool:
+        """在一个事务中写入尚未写入的记录，并删除超出保留数量的最早记录"""
+        rows = self._rows(list(pending))
+        max_messages = self.storage.max_messages
+
+        def _compact(conn: sqlite3.Connection):
+            with conn:
+                conn.execute("BEGIN")
+                if rows:
+                    conn.executemany(
+                        "INSERT INTO messages (group_id, message_id, time, data) VALUES (?, ?, ?, ?)", rows
+                    )
+                if max_messages:
+                    # 第max_messages+1新的记录及更早的记录
+                    boundary = conn.execute(
+                        "SELECT id FROM messages WHERE group_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                        (self.key, max_messages)
+                    ).fetchone()
+                    if boundary is not None:
+                        conn.execute("DELETE FROM messages WHERE group_id = ? AND id <= ?", (self.key, boundary[0]))
+                return conn.execute("SELECT COUNT(*) FROM messages WHERE group_id = ?", (self.key,)).fetchone()[0]
+
+        try:
+            self.line_count = await self.storage.run(_compact)
+            self.truncated = False
+            logger.debug(f"群 {self.group_id} 的消息数据库保留 {self.line_count} 条记录")
+            return True
+        except Exception as e:
+            logger.error(f"清理消息数据库时出错: {str(e)}", exc_info=True)
+            return False
+
+    async def update(self, records: List[Dict]) -> bool:
+        """在一个事务中原地更新修改过的记录"""
+        updates = [(self.storage.codec.encode(record), record_key(record)) for record in records]
+
+        def _update(conn: sqlite3.Connection):
+            with conn:
+                conn.execute("BEGIN")
+                for data, key in updates:
+                    if isinstance(key, str):
+                        conn.execute(
+                            "UPDATE messages SET data = ? WHERE group_id = ? AND message_id = ?", (data, self.key, key)
+                        )
+                        continue
+                    # 没有消息ID的记录按时间找到候选行，再比较发送者和内容
+                    for row_id, stored in conn.execute(
+                        "SELECT id, data FROM messages WHERE group_id = ? AND message_id IS NULL AND time = ?",
+                        (self.key, key[0])
+                    ).fetchall():
+                        try:
+                            record = decode_record(stored)
+                        except ValueError:
+                            continue
+                        if record_key(record) == key:
+                            conn.execute("UPDATE messages SET data = ? WHERE id = ?", (data, row_id))
+
+        try:
+            await self.storage.run(_update)
+            return True
+        except Exception as e:
+            logger.error(f"更新消息数据库记录时出错: {str(e)}", exc_info=True)
+            return False
+
+    async def read_tail(self, count: int) -> List[Dict]:
+        """读取最新的count条记录，数据库中没有该群的记录时从旧的日志文件迁移"""
+        def _read(conn: sqlite3.Connection):
+            total = conn.execute("SELECT COUNT(*) FROM messages WHERE group_id = ?", (self.key,)).fetchone()[0]
+            if count > 0:
+                rows = conn.execute(
+                    "SELECT data FROM messages WHERE group_id = ? ORDER BY id DESC LIMIT ?", (self.key, count)
+                ).fetchall()
+                rows.reverse()
+            else:
+                rows = conn.execute(
+                    "SELECT data FROM messages WHERE group_id = ? ORDER BY id", (self.key,)
+                ).fetchall()
+            return total, rows
+
+        try:
+            total, rows = await self.storage.run(_read)
+        except Exception as e:
+            logger.error(f"读取消息数据库时出错: {str(e)}")
+            return []
+
+        if not total:
+            return await self._migrate_log(count)
+        records = self._decode_rows(rows)
+        self.line_count = total
+        return records
+
+    async def _migrate_log(self, count: int) -> List[Dict]:
+        """将该群的日志文件(或更早的JSON文件)导入数据库，导入后日志文件重命名保留"""
+        log = HistoryLog(self.storage.base_path, self.group_id)
+        if not log.exists():
+            return []
+
+        # 数据库保留全部历史，导入整个日志
+        records = await log.read_tail(0)
+        if not records or not await self.append(records):
+            return records[-count:] if count > 0 else records
+        try:
+            os.replace(log.path, f"{log.path}.migrated")
+        except Exception as e:
+            logger.error(f"重命名已迁移的消息日志时出错: {str(e)}")
+        logger.info(f"群 {self.group_id} 的消息历史已迁移到SQLite数据库")
+        return records[-count:] if count > 0 else records
+
+    async def get_message(self, message_id) -> Optional[Dict]:
+        """通过(group_id, message_id)索引查找记录"""
+        def _get(conn: sqlite3.Connection):
+            return conn.execute(
+                "SELECT data FROM messages WHERE group_id = ? AND message_id = ? ORDER BY id DESC LIMIT 1",
+                (self.key, str(message_id))
+            ).fetchall()
+
+        try:
+            records = self._decode_rows(await self.storage.run(_get))
+        except Exception as e:
+            logger.error(f"查询消息数据库时出错: {str(e)}")
+            return None
+        return records[0] if records else None
+
+    async def delete(self) -> bool:
+        """删除该群的全部记录(包括未迁移的日志文件)"""
+        def _delete(conn: sqlite3.Connection):
+            with conn:
+                return conn.execute("DELETE FROM messages WHERE group_id = ?", (self.key,)).rowcount
+
+        existed = False
+        try:
+            existed = await self.storage.run(_delete) > 0
+        except Exception as e:
+            logger.error(f"删除消息数据库记录时出错: {str(e)}")
+        if await HistoryLog(self.storage.base_path, self.group_id).delete():
+            existed = True
+        self.line_count = 0
+        return existed
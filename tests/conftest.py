@@ -0,0 +1,11 @@
+"""
+SpectreCore 测试
+
+插件目录作为包导入，使插件内的相对导入可用；需要在安装了AstrBot的环境中运行:
+    python -m pytest -q tests
+"""
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT.parent))
@@ -0,0 +1,50 @@
+"""
+测试共用的工具函数
+"""
+from io import BytesIO
+from pathlib import Path
+import importlib
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def plugin_module(name: str):
+    """导入插件的子模块"""
+    return importlib.import_module(f"{ROOT.name}.{name}")
+
+
+def make_image(width: int = 1600, height: int = 1200, seed: int = 0) -> bytes:
+    """生成一张带渐变的JPEG图片，seed不同时内容不同"""
+    from PIL import Image
+    img = Image.new('RGB', (width, height))
+    img.putdata([((x * 255 // width + seed * 40) % 256, (y * 255 // height) % 256, (x + y + seed) % 256)
+                 for y in range(height) for x in range(width)])
+    output = BytesIO()
+    img.save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+class FakeClient:
+    """
+    OneBot客户端替身，调用方式与aiocqhttp客户端相同: client.api.call_action(action, **params)
+
+    handlers为接口名 -> 处理函数，处理函数返回的异常会被抛出，用于模拟接口调用失败
+    """
+
+    def __init__(self, handlers):
+        self.api = self
+        self.handlers = handlers
+        self.calls = []
+
+    async def call_action(self, action: str, **params):
+        self.calls.append((action, params))
+        handler = self.handlers.get(action)
+        if handler is None:
+            raise RuntimeError(f"不支持的接口: {action}")
+        result = handler(**params)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def count(self, action: str) -> int:
+        return sum(1 for called, _ in self.calls if called == action)
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+from helpers import FakeClient, plugin_module
+
+cache = plugin_module("cache")
+api_client = plugin_module("api_client")
+forward_processor = plugin_module("processors.forward_processor")
+ForwardProcessor = forward_processor.ForwardProcessor
+
+SENDER = {'nickname': '转发者', 'user_id': '10000'}
+
+
+def node(text: str, forward_id: str = None):
+    segments = [{'type': 'text', 'data': {'text': text}}]
+    if forward_id is not None:
+        segments.append({'type': 'forward', 'data': {'id': forward_id}})
+    return {'sender': {'nickname': '用户', 'user_id': '20000'}, 'time': 1700000000, 'message': segments}
+
+
+def forward_client(forwards):
+    """forwards: 转发ID -> 子消息列表，值为异常时模拟接口调用失败"""
+    def get_forward_msg(id):
+        result = forwards.get(id)
+        if isinstance(result, Exception):
+            return result
+        return {'messages': result or []}
+    return FakeClient({'get_forward_msg': get_forward_msg})
+
+
+@pytest.fixture(autouse=True)
+def clear_forward_cache():
+    cache.forward_cache.clear()
+    yield
+    cache.forward_cache.clear()
+
+
+def render(forward_data, client):
+    return asyncio.run(ForwardProcessor.process_forward_message(forward_data, SENDER, 1700000000, client))
+
+
+def test_nested_id_only_forwards_are_fetched():
+    client = forward_client({
+        'outer': [node("外层消息", 'inner')],
+        'inner': [node("内层消息1"), node("内层消息2")],
+    })
+    record = render({'id': 'outer'}, client)
+
+    outer = record['forward_messages']
+    assert [msg['content'] for msg in outer] == ["外层消息[合并转发消息]"]
+    assert [msg['content'] for msg in outer[0]['forward_messages']] == ["内层消息1", "内层消息2"]
+    assert client.count('get_forward_msg') == 2
+
+
+def test_fetch_stops_at_message_limit(monkeypatch):
+    monkeypatch.setattr(ForwardProcessor, 'MAX_MESSAGES', 5)
+    client = forward_client({
+        'outer': [node(f"消息{i}", f"nested{i}") for i in range(10)],
+        **{f"nested{i}": [node(f"嵌套{i}")] for i in range(10)},
+    })
+    record = render({'id': 'outer'}, client)
+
+    # 子消息数超出上限后不再获取下一层
+    assert client.count('get_forward_msg') == 1
+    contents = [msg['content'] for msg in record['forward_messages']]
+    assert len(contents) == 6
+    assert contents[-1] == '[合并转发消息过长，其余内容已省略]'
+
+
+def test_api_failure_renders_empty_forward():
+    client = forward_client({
+        'outer': [node("外层消息", 'broken'), node("另一条", 'inner')],
+        'broken': RuntimeError("接口超时"),
+        'inner': [node("内层消息")],
+    })
+    record = render({'id': 'outer'}, client)
+
+    first, second = record['forward_messages']
+    assert first['forward_messages'] == []
+    assert [msg['content'] for msg in second['forward_messages']] == ["内层消息"]
+    # 失败结果短时间内不再重复请求
+    assert cache.forward_cache.is_negative('broken')
+
+
+def test_missing_result_does_not_raise(monkeypatch):
+    async def no_result(client, forward_id):
+        return None
+
+    monkeypatch.setattr(api_client.APIClient, 'get_forward_message', no_result)
+    record = render({'id': 'outer'}, FakeClient({}))
+    assert record['forward_messages'] == []
@@ -0,0 +1,132 @@
+import asyncio
+import os
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from helpers import make_image, plugin_module
+
+pytest.importorskip("PIL")
+image_cache = plugin_module("image_cache")
+
+
+class ImageServer:
+    """本地图片服务器，所有路径返回同一张图片，记录每个路径的请求次数"""
+
+    def __init__(self, data: bytes, delay: float = 0.02):
+        self.data = data
+        self.delay = delay
+        self.requests = {}
+        app = web.Application()
+        app.router.add_get('/{name}', self.handle)
+        self.server = TestServer(app)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        name = request.match_info['name']
+        self.requests[name] = self.requests.get(name, 0) + 1
+        # 让并发请求在下载完成前重叠
+        await asyncio.sleep(self.delay)
+        return web.Response(body=self.data, content_type='image/jpeg')
+
+    def url(self, name: str) -> str:
+        return str(self.server.make_url(f'/{name}'))
+
+    async def __aenter__(self) -> 'ImageServer':
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.server.close()
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_same_url_downloads_once(tmp_path):
+    async def scenario():
+        cache = image_cache.ImageCache(str(tmp_path), enabled=True)
+        async with ImageServer(make_image()) as server:
+            paths = await cache.resolve([server.url('a')] * 3)
+            await cache.close()
+        return cache, server, paths
+
+    cache, server, paths = run(scenario())
+    assert server.requests == {'a': 1}
+    assert len(set(paths)) == 1 and os.path.isfile(paths[0])
+    assert cache.fetched == 1
+
+
+def test_same_content_urls_store_once(tmp_path):
+    async def scenario():
+        cache = image_cache.ImageCache(str(tmp_path), enabled=True)
+        async with ImageServer(make_image()) as server:
+            urls = [server.url(name) for name in ('a', 'b', 'c')]
+            paths = await cache.resolve(urls)
+            # 再次请求时直接命中URL映射
+            again = await cache.resolve(urls)
+            await cache.close()
+        return cache, urls, paths, again
+
+    cache, urls, paths, again = run(scenario())
+    assert cache.failures == 0
+    assert not set(paths) & set(urls)
+    assert len(set(paths)) == 1 and again == paths
+    # 只有一个缓存文件，没有残留的临时文件，大小只计算一次
+    assert os.listdir(tmp_path) == [os.path.basename(paths[0])]
+    assert cache.stats()['files'] == 1
+    assert cache.stats()['bytes'] == os.path.getsize(paths[0])
+    assert cache.hits == 3
+
+
+async def wait_fingerprints(cache) -> None:
+    while cache._hash_tasks:
+        await asyncio.gather(*cache._hash_tasks)
+
+
+def test_concurrent_duplicates_share_number(tmp_path):
+    history_store = plugin_module("history_store")
+
+    async def scenario():
+        cache = image_cache.ImageCache(str(tmp_path), enabled=True, dedup=True)
+        history = history_store.GroupHistory(1)
+        updated = []
+        async with ImageServer(make_image()) as server:
+            for message_id, name in enumerate(('a', 'b', 'c')):
+                message = {'message_id': message_id, 'sender': f"用户{name}(id:{message_id})",
+                           'content': '[图片]', 'resources': [{'type': 'image', 'url': server.url(name)}]}
+                history.add(message)
+                cache.schedule_fingerprints(message, lambda: updated.append(True))
+            await wait_fingerprints(cache)
+            await cache.close()
+        return history, updated
+
+    history, updated = run(scenario())
+    hashes = {message['resources'][0].get('phash') for message in history.snapshot()}
+    assert len(hashes) == 1 and None not in hashes
+    assert len(updated) == 3
+    selected = history.select_images(count=3, max_distance=0)
+    assert [image['number'] for image in selected] == [1, 1, 1]
+    assert [image['duplicate'] for image in selected] == [True, True, False]
+
+
+def test_fingerprint_falls_back_to_download(tmp_path):
+    async def scenario():
+        cache = image_cache.ImageCache(str(tmp_path), enabled=True, dedup=True)
+
+        async def broken_store(name, data):
+            raise OSError("磁盘已满")
+
+        cache._store = broken_store
+        async with ImageServer(make_image()) as server:
+            url = server.url('a')
+            # 缓存失败时使用原URL
+            resolved = await cache.get(url)
+            phash = await cache.fingerprint(url)
+            await cache.close()
+        return cache, url, resolved, phash
+
+    cache, url, resolved, phash = run(scenario())
+    assert resolved == url
+    assert phash
+    assert cache.hashed == 1
@@ -0,0 +1,87 @@
+import asyncio
+
+from helpers import FakeClient, plugin_module
+
+cache = plugin_module("cache")
+history_store = plugin_module("history_store")
+message_formatter = plugin_module("message_formatter")
+reply_processor = plugin_module("processors.reply_processor")
+
+GROUP_ID = 1000
+MAX_DEPTH = reply_processor.ReplyProcessor.MAX_QUOTE_DEPTH
+
+
+def reply_chain(length: int):
+    """第i条消息引用第i-1条消息"""
+    messages = []
+    for i in range(length):
+        segments = [{'type': 'text', 'data': {'text': f"第{i}条消息"}}]
+        if i > 0:
+            segments.insert(0, {'type': 'reply', 'data': {'id': str(i - 1)}})
+        messages.append({
+            'message_id': i,
+            'time': 1700000000 + i,
+            'sender': {'nickname': f"用户{i % 3}", 'user_id': str(10000 + i % 3)},
+            'message': segments,
+        })
+    return messages
+
+
+def reset_caches():
+    cache.quote_cache.clear()
+    cache.message_cache.clear()
+
+
+async def ingest(messages):
+    history = history_store.GroupHistory(GROUP_ID, max_history=100)
+    for message in messages:
+        record = await message_formatter.MessageFormatter.process_group_message(
+            message, [message], None, GROUP_ID, history=history
+        )
+        history.add(record)
+    return history
+
+
+def test_history_quotes_respect_depth_cap():
+    reset_caches()
+    messages = reply_chain(29)
+    history = asyncio.run(ingest(messages))
+
+    for record in history.snapshot():
+        # 最多展开MAX_DEPTH层，之后是一个未展开的[引用...]
+        assert record['content'].count('[引用') <= MAX_DEPTH + 1
+    latest = history.latest()
+    assert latest['quotes'] == [{'id': '27', 'start': 0, 'end': latest['content'].index('第28条消息')}]
+    # 引用链较长后，每条消息的长度不再增长
+    assert len(history.get('28')['content']) == len(history.get('20')['content'])
+
+
+def test_history_and_api_render_the_same_text():
+    reset_caches()
+    messages = reply_chain(12)
+    history = asyncio.run(ingest(messages))
+    from_history = history.latest()['content']
+
+    reset_caches()
+    raw = {str(message['message_id']): message for message in messages}
+    client = FakeClient({'get_msg': lambda message_id: raw[str(message_id)]})
+    segment = messages[-1]['message'][0]
+    from_api = asyncio.run(reply_processor.ReplyProcessor.process_reply_segment(segment, [], client, GROUP_ID))
+
+    assert from_history.startswith(from_api)
+    assert from_api.count('[引用') == MAX_DEPTH + 1
+    assert client.count('get_msg') == MAX_DEPTH
+
+
+def test_cached_chain_is_not_reused_beyond_cap():
+    reset_caches()
+    messages = reply_chain(4)
+    history = asyncio.run(ingest(messages))
+    render = reply_processor.ReplyProcessor._render_reply
+    text, complete, levels = asyncio.run(render('3', [], None, GROUP_ID, history))
+    assert complete and levels == 3
+    assert cache.quote_cache.get('3') == (text, levels)
+    # 缓存的完整引用链在更深的位置被引用时不能直接使用
+    text, complete, levels = asyncio.run(render('3', [], None, GROUP_ID, history, depth=MAX_DEPTH - 2))
+    assert not complete
+    assert text == "用户0(id:10000)的消息:[引用用户2(id:10002)的消息:[引用...]第2条消息]第3条消息"
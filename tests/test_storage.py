@@ -0,0 +1,138 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from helpers import plugin_module
+
+storage = plugin_module("storage")
+history_store = plugin_module("history_store")
+jsonl = plugin_module("storage.jsonl")
+
+GROUP_ID = 1000
+
+
+def record(i: int, message_id=True):
+    return {
+        'time': f"2024-01-01 00:{i // 60:02d}:{i % 60:02d}",
+        'sender': f"用户{i % 3}(id:{10000 + i % 3})",
+        'content': f"第{i}条消息",
+        'resources': [],
+        'message_id': i if message_id else None,
+    }
+
+
+def make_store(tmp_path, config, max_history=20):
+    return history_store.HistoryStore(str(tmp_path), max_history=max_history, flush_delay=3600,
+                                      storage=storage.create_storage(config, str(tmp_path)))
+
+
+async def fill(store, start: int, count: int, message_id=True):
+    history = await store.get(GROUP_ID)
+    for i in range(start, start + count):
+        store.add(history, record(i, message_id))
+        await store.flush(GROUP_ID)
+    # 等待后台压缩完成
+    await store.flush_all()
+    return history
+
+
+def db_count(tmp_path) -> int:
+    with sqlite3.connect(str(tmp_path / "messages.db")) as conn:
+        return conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+
+def test_sqlite_keeps_history_beyond_memory(tmp_path):
+    async def scenario():
+        store = make_store(tmp_path, {'storage_backend': 'sqlite'})
+        history = await fill(store, 0, 100)
+        found = await store.find_message(GROUP_ID, 3)
+        await store.close()
+        return history, found
+
+    history, found = asyncio.run(scenario())
+    assert len(history) == 20
+    assert found is not None and found['content'] == "第3条消息"
+    assert db_count(tmp_path) == 100
+
+
+def test_sqlite_retention_limit(tmp_path):
+    async def scenario():
+        store = make_store(tmp_path, {'storage_backend': 'sqlite', 'sqlite_max_messages': 50})
+        await fill(store, 0, 120)
+        oldest = await store.find_message(GROUP_ID, 69)
+        kept = await store.find_message(GROUP_ID, 70)
+        await store.close()
+        return oldest, kept
+
+    oldest, kept = asyncio.run(scenario())
+    assert oldest is None and kept is not None
+    assert db_count(tmp_path) == 50
+
+
+@pytest.mark.parametrize("backend", ["jsonl", "sqlite"])
+@pytest.mark.parametrize("message_id", [True, False])
+def test_modified_records_are_updated_in_place(tmp_path, backend, message_id):
+    async def scenario():
+        store = make_store(tmp_path, {'storage_backend': backend})
+        history = await fill(store, 0, 30, message_id)
+        # 模拟后台计算的图片哈希在记录写入后才完成
+        target = history.snapshot()[-5]
+        target['resources'] = [{'type': 'image', 'url': 'http://example.com/a.jpg', 'phash': 'ff00ff00ff00ff00'}]
+        store._record_updated(history, target)
+        await store.flush_all()
+        await store.close()
+
+        reopened = make_store(tmp_path, {'storage_backend': backend})
+        reloaded = (await reopened.get(GROUP_ID)).snapshot()
+        await reopened.close()
+        return target, reloaded
+
+    target, reloaded = asyncio.run(scenario())
+    matches = [r for r in reloaded if r['content'] == target['content']]
+    assert len(matches) == 1
+    assert matches[0]['resources'][0]['phash'] == 'ff00ff00ff00ff00'
+    if backend == 'sqlite':
+        assert db_count(tmp_path) == 30
+
+
+def test_sqlite_imports_whole_log(tmp_path):
+    async def scenario():
+        log = jsonl.HistoryLog(str(tmp_path), GROUP_ID)
+        log.READ_BLOCK_SIZE = 256
+        await log.append([record(i) for i in range(200)])
+        store = make_store(tmp_path, {'storage_backend': 'sqlite'})
+        history = await store.get(GROUP_ID)
+        found = await store.find_message(GROUP_ID, 0)
+        await store.close()
+        return history, found
+
+    history, found = asyncio.run(scenario())
+    assert [r['message_id'] for r in history.snapshot()] == list(range(180, 200))
+    assert found is not None
+    assert db_count(tmp_path) == 200
+    assert (tmp_path / f"{GROUP_ID}.jsonl.migrated").exists()
+
+
+def test_jsonl_read_tail_zero_reads_whole_file(tmp_path):
+    async def scenario():
+        log = jsonl.HistoryLog(str(tmp_path), GROUP_ID)
+        log.READ_BLOCK_SIZE = 256
+        await log.append([record(i) for i in range(200)])
+        return await log.read_tail(0), log
+
+    records, log = asyncio.run(scenario())
+    assert len(records) == 200
+    assert not log.truncated
+
+
+def test_jsonl_compacts_beyond_factor(tmp_path):
+    async def scenario():
+        store = make_store(tmp_path, {'storage_backend': 'jsonl'})
+        await fill(store, 0, 100)
+        await store.close()
+        return await jsonl.HistoryLog(str(tmp_path), GROUP_ID).read_tail(0)
+
+    records = asyncio.run(scenario())
+    assert len(records) <= 20 * jsonl.HistoryLog.COMPACT_FACTOR
+    assert records[-1]['message_id'] == 99
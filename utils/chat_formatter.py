@@ -1,172 +1,273 @@
-import os
-import json
-import re
+from typing import Dict, List, Tuple
 from astrbot.api.all import logger
+from .token_counter import estimate_record_tokens, truncate_to_tokens
+from .image_hash import pick_images
 
-async def format_chat_history(group_id, base_path, config):
-    """格式化聊天记录为大模型输入格式
-    
-    Args:
-        group_id: 群组ID
-        base_path: 消息存储的基础路径
-        config: 插件配置
-        
-    Returns:
-        str: 格式化后的聊天记录
+# 格式化后各条消息之间的分隔符
+MESSAGE_SEPARATOR = "\n---\n"
+
+
+class ChatHistoryRenderer:
     """
-    try:
-        file_path = os.path.join(base_path, f"{group_id}.json")
-        if not os.path.exists(file_path):
-            logger.warning(f"群 {group_id} 的消息历史文件不存在")
-            return ""
-            
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            
-        if not data or 'messages' not in data:
-            return ""
-            
+    增量聊天记录渲染器
+
+    按消息ID缓存每条消息渲染后的文本，新触发时只渲染新到达的消息；
+    输入给大模型的图片是最新的若干张，按从早到晚编号，只需在缓存的文本前拼接图片标记
+    """
+
+    def __init__(self):
+        # message_id -> (普通渲染结果, 行前缀, 去除[图片]后的内容, 图片数量, 是否按转发消息渲染)
+        self._cache: Dict = {}
+        # 缓存对应的单条消息token上限，上限变化时缓存失效
+        self._max_message_tokens = 0
+
+    @staticmethod
+    def select_window(messages: List[Dict], token_budget: int, max_message_tokens: int = 0) -> List[Dict]:
+        """从最新的消息开始向前选择，直到填满token预算
+
+        Args:
+            messages: 群消息历史列表(从早到晚)
+            token_budget: token预算，小于等于0表示不限制
+            max_message_tokens: 单条消息的token上限，超出部分会被截断，不计入预算
+
+        Returns:
+            List[Dict]: 预算内的最新消息(从早到晚)
+        """
+        if token_budget <= 0:
+            return messages
+        used = 0
+        start = len(messages)
+        for msg in reversed(messages):
+            tokens = msg.get('tokens')
+            if tokens is None:
+                tokens = estimate_record_tokens(msg)
+            if max_message_tokens > 0:
+                tokens = min(tokens, max_message_tokens)
+            if used + tokens > token_budget and start < len(messages):
+                break
+            used += tokens
+            start -= 1
+        return messages[start:]
+
+    @staticmethod
+    def scan_images(messages: List[Dict], count: int = 0, max_distance=None) -> List[Dict]:
+        """
+        没有图片索引时，从消息列表中倒序查找最新的图片
+
+        Args:
+            messages: 消息列表(从早到晚)
+            count: 最多选择的不同图片数量，小于等于0表示全部
+            max_distance: 感知哈希判定为重复的最大汉明距离，None表示不去重
+
+        Returns:
+            List[Dict]: 选中的图片(从早到晚)，格式与GroupHistory.select_images一致
+        """
+        def candidates():
+            for index in range(len(messages) - 1, -1, -1):
+                resources = messages[index].get('resources') or []
+                for res_idx in range(len(resources) - 1, -1, -1):
+                    resource = resources[res_idx]
+                    if resource.get('type') == 'image' and resource.get('url'):
+                        yield {'index': index, 'res_idx': res_idx, 'url': resource['url'],
+                               'kind': resource['type'], 'phash': resource.get('phash')}
+
+        return pick_images(candidates(), count if count > 0 else None, max_distance)
+
+    def render(self, messages: List[Dict], config: Dict, group_id=None, history=None) -> Tuple[str, List[str]]:
+        """
+        渲染聊天记录，并返回与图片编号一一对应的图片URL
+
+        Args:
+            messages: 群消息历史列表(从早到晚)
+            config: 插件配置
+            group_id: 群组ID
+            history: 群消息历史(GroupHistory)，提供时messages必须是它的快照，图片从其索引中选择
+
+        Returns:
+            Tuple[str, List[str]]: 格式化后的聊天记录，以及[图片1]、[图片2]...对应的URL
+        """
         formatted_messages = []
-        messages = data['messages']
-        
+
         logger.debug(f"开始格式化群 {group_id} 的聊天记录，共 {len(messages)} 条消息")
-        
-        # 全局图片计数器和可用图片上限
+
+        # 可用图片上限
         img_count = config.get('image_count', 0)
-        
+
+        # 按token预算选择聊天记录窗口，并截断过长的单条消息
+        max_message_tokens = int(config.get('max_message_tokens', 0) or 0)
+        token_budget = int(config.get('prompt_token_budget', 0) or 0)
+        window = self.select_window(messages, token_budget, max_message_tokens)
+        start = len(messages) - len(window)
+        messages = window
+
+        # 选择窗口内最新的图片，提示词中的编号和实际发送的图片来自同一份选择结果
+        limit = img_count if img_count > 0 else None
+        dedup_config = config.get('image_dedup', {}) or {}
+        max_distance = int(dedup_config.get('max_distance', 5)) if dedup_config.get('enable', False) else None
+        if history is not None:
+            images = history.select_images(limit, start, max_distance)
+            for image in images:
+                image['index'] -= start
+        else:
+            images = self.scan_images(messages, img_count, max_distance)
+        # 消息在窗口中的位置 -> 该消息中图片的编号
+        image_numbers: Dict[int, List[int]] = {}
+        for image in images:
+            image_numbers.setdefault(image['index'], []).append(image['number'])
+
+        if max_message_tokens != self._max_message_tokens:
+            self._cache = {}
+            self._max_message_tokens = max_message_tokens
+
         # 添加图片指引提示
         if img_count > 0:
             image_guide = f"【注意：当前最多输入{img_count}张图片(如果有)，标记为[图片1]到[图片{img_count}]，按照消息发送时间从早到晚排序,标记为[图片]的为超出限制的图片】"
             formatted_messages.append(image_guide)
-        
-        # 收集所有图片资源
-        all_images = []
-        for msg in messages:
-            resources = msg.get('resources', [])
-            # 过滤出图片类型的资源
-            img_resources = [r for r in resources if r.get('type') == 'image']
-            
-            if img_resources:
-                # 为每条消息的每张图片创建一个记录，包含消息索引和资源索引
-                for res_idx, _ in enumerate(img_resources):
-                    all_images.append({
-                        'msg_idx': messages.index(msg),
-                        'res_idx': res_idx,
-                        'msg': msg
-                    })
-                
-        # 按照消息从早到晚排序（如果消息时间相同，则按照资源索引排序）
-        all_images.sort(key=lambda x: (x['msg_idx'], x['res_idx']))
-        
-        # 如果图片数量超过限制，只保留前img_count张
-        if 0 < img_count < len(all_images):
-            all_images = all_images[:img_count]
-            
-        logger.debug(f"群 {group_id} 的聊天记录中共有 {len(all_images)} 张图片被处理")
-        
-        # 为每张图片分配全局编号（从1开始）
-        for i, img_data in enumerate(all_images):
-            img_idx = i + 1  # 从1开始编号
-            msg_idx = img_data['msg_idx']
-            res_idx = img_data['res_idx']
-            
-            # 如果消息还没有_img_map字段，初始化一个空字典
-            if '_img_map' not in messages[msg_idx]:
-                messages[msg_idx]['_img_map'] = {}
-            
-            # 记录这张图片的全局编号
-            messages[msg_idx]['_img_map'][res_idx] = img_idx
-            
+
         # 添加读空气相关提示词
         if config.get('read_air', False):
             formatted_messages.append("【如果你觉得现在不适合发消息，请直接输出<NO_RESPONSE>】")
-            
-        # 从前向后正常处理消息
-        for i, msg in enumerate(messages):
-            sender = msg.get('sender', '未知用户')
-            msg_time = msg.get('time', '未知时间')
-            content = msg.get('content', '')
-            img_map = msg.get('_img_map', {})
-            
-            # 检查是否是合并转发消息
-            if "转发消息" in content:
-                # 如果有forward_messages字段，用新格式处理合并转发消息
-                if 'forward_messages' in msg and msg['forward_messages']:
-                    # 格式化合并转发消息的开始部分
-                    formatted_content = f"[{sender}/{msg_time}]:[发送了一条合并转发消息 内容如下\n{{"
-                    formatted_messages.append(formatted_content)
-                    
-                    # 格式化内部的子消息
-                    forward_contents = []
-                    for forward_msg in msg['forward_messages']:
-                        f_sender = forward_msg.get('sender', '未知用户')
-                        f_time = forward_msg.get('time', '未知时间')
-                        f_content = forward_msg.get('content', '')
-                        
-                        # 检查是否是嵌套的合并转发消息
-                        if "转发消息" in f_content and 'forward_messages' in forward_msg:
-                            # 处理嵌套的合并转发消息
-                            nested_contents = []
-                            for nested_msg in forward_msg.get('forward_messages', []):
-                                n_sender = nested_msg.get('sender', '未知用户')
-                                n_time = nested_msg.get('time', '未知时间')
-                                n_content = nested_msg.get('content', '')
-                                nested_contents.append(f"[{n_sender}/{n_time}]:{n_content}")
-                            
-                            # 格式化嵌套的合并转发消息
-                            nested_formatted = f"[{f_sender}/{f_time}]:[发送了一条合并转发消息 内容如下\n{{\n"
-                            nested_formatted += "\n---\n".join(nested_contents)
-                            nested_formatted += "\n}}]"
-                            forward_contents.append(nested_formatted)
-                        else:
-                            # 普通消息
-                            forward_contents.append(f"[{f_sender}/{f_time}]:{f_content}")
-                    
-                    # 将子消息添加到格式化消息中
-                    formatted_messages.append("\n---\n".join(forward_contents))
-                    
-                    # 添加合并转发消息的结束部分
-                    formatted_messages.append("}]")
-                    
-                    logger.debug(f"处理第 {i+1}/{len(messages)} 条消息: 合并转发消息，包含 {len(msg['forward_messages'])} 条子消息")
-                else:
-                    # 如果没有子消息，简单显示合并转发消息
-                    formatted_content = f"[{sender}/{msg_time}]:{content}"
-                    formatted_messages.append(formatted_content)
-                    logger.debug(f"处理第 {i+1}/{len(messages)} 条消息: 空的合并转发消息")
+
+        # 只保留当前窗口内消息的缓存，窗口外的自然淘汰
+        old_cache = self._cache
+        new_cache = {}
+        rendered_count = 0
+
+        # 被选中的图片按消息从早到晚依次编号(从1开始)，未被选中的图片不编号
+        for index, msg in enumerate(messages):
+            message_id = msg.get('message_id')
+            entry = old_cache.get(message_id) if message_id is not None else None
+            if entry is None:
+                entry = self._render_message(msg, max_message_tokens)
+                rendered_count += 1
+            if message_id is not None:
+                new_cache[message_id] = entry
+
+            line, prefix, clean_content, msg_img_count, is_forward = entry
+            numbers = image_numbers.get(index)
+
+            if numbers and not is_forward:
+                # 生成图片标记，确保按照资源索引顺序添加
+                img_markers = ''.join(f"[图片{number}]" for number in numbers)
+                formatted_messages.append(f"{prefix}{img_markers}{clean_content}")
             else:
-                # 处理普通消息和图片消息
-                if img_map:
-                    # 从消息内容中删除所有[图片]标记
-                    clean_content = re.sub(r'\[图片\]', '', content).strip()
-                    
-                    # 生成图片标记，确保按照资源索引顺序添加
-                    img_markers = ""
-                    for res_idx in sorted(img_map.keys()):
-                        img_id = img_map[res_idx]
-                        img_markers += f"[图片{img_id}]"
-                    
-                    # 合并图片标记和清理后的内容
-                    if clean_content:
-                        formatted_content = f"[{sender}/{msg_time}]:{img_markers}{clean_content}"
-                    else:
-                        formatted_content = f"[{sender}/{msg_time}]:{img_markers}"
-                        
-                    formatted_messages.append(formatted_content)
-                    logger.debug(f"处理第 {i+1}/{len(messages)} 条消息: 图片消息，包含 {len(img_map)} 张图片")
-                else:
-                    # 处理普通文本消息
-                    formatted_content = f"[{sender}/{msg_time}]:{content}"
-                    formatted_messages.append(formatted_content)
-                    logger.debug(f"处理第 {i+1}/{len(messages)} 条消息: 普通消息")
-        
+                formatted_messages.append(line)
+
+        self._cache = new_cache
+        logger.debug(f"群 {group_id} 的聊天记录中共有 {len(images)} 张图片被处理，新渲染 {rendered_count} 条消息")
+
         # 消息已经按从早到晚排序，最后一条是最新消息
-        result = "\n---\n".join(formatted_messages)
+        result = MESSAGE_SEPARATOR.join(formatted_messages)
         logger.debug(f"格式化完成，共处理 {len(formatted_messages)} 条格式化消息")
-        return result
-        
+        # 未设置图片上限时只编号，不发送图片；重复的图片只发送一次
+        image_urls = [image['url'] for image in images if not image['duplicate']] if img_count > 0 else []
+        return result, image_urls
+
+    @classmethod
+    def _render_message(cls, msg: Dict, max_tokens: int = 0) -> Tuple[str, str, str, int, bool]:
+        """渲染单条消息，返回可缓存的渲染结果，超过token上限的内容会被截断"""
+        sender = msg.get('sender', '未知用户')
+        msg_time = msg.get('time', '未知时间')
+        content = msg.get('content', '')
+        prefix = f"[{sender}/{msg_time}]:"
+        img_count = sum(1 for r in msg.get('resources', []) if r.get('type') == 'image')
+
+        # 检查是否是合并转发消息
+        if "转发消息" in content:
+            # 如果有forward_messages字段，用新格式处理合并转发消息
+            if 'forward_messages' in msg and msg['forward_messages']:
+                return truncate_to_tokens(cls._render_forward(msg, prefix), max_tokens), prefix, '', img_count, True
+            # 如果没有子消息，简单显示合并转发消息
+            return truncate_to_tokens(f"{prefix}{content}", max_tokens), prefix, '', img_count, True
+
+        # 普通消息和图片消息，图片消息在编号后会删除内容中所有的[图片]标记
+        clean_content = truncate_to_tokens(content.replace('[图片]', '').strip(), max_tokens) if img_count else ''
+        return truncate_to_tokens(f"{prefix}{content}", max_tokens), prefix, clean_content, img_count, False
+
+    @classmethod
+    def _render_forward(cls, msg: Dict, prefix: str) -> str:
+        """渲染合并转发消息及其子消息"""
+        forward_contents = []
+        for forward_msg in msg['forward_messages']:
+            f_sender = forward_msg.get('sender', '未知用户')
+            f_time = forward_msg.get('time', '未知时间')
+            f_content = forward_msg.get('content', '')
+
+            # 检查是否是嵌套的合并转发消息
+            if "转发消息" in f_content and 'forward_messages' in forward_msg:
+                nested_contents = []
+                for nested_msg in forward_msg.get('forward_messages', []):
+                    n_sender = nested_msg.get('sender', '未知用户')
+                    n_time = nested_msg.get('time', '未知时间')
+                    n_content = nested_msg.get('content', '')
+                    nested_contents.append(f"[{n_sender}/{n_time}]:{n_content}")
+
+                # 格式化嵌套的合并转发消息
+                nested_formatted = f"[{f_sender}/{f_time}]:[发送了一条合并转发消息 内容如下\n{{\n"
+                nested_formatted += MESSAGE_SEPARATOR.join(nested_contents)
+                nested_formatted += "\n}}]"
+                forward_contents.append(nested_formatted)
+            else:
+                # 普通消息
+                forward_contents.append(f"[{f_sender}/{f_time}]:{f_content}")
+
+        # 开始部分、子消息和结束部分之间同样使用消息分隔符
+        return MESSAGE_SEPARATOR.join([
+            f"{prefix}[发送了一条合并转发消息 内容如下\n{{",
+            MESSAGE_SEPARATOR.join(forward_contents),
+            "}]",
+        ])
+
+
+# 每个群一个渲染器，保存该群已渲染消息的缓存
+_renderers: Dict[str, ChatHistoryRenderer] = {}
+
+
+def get_renderer(group_id) -> ChatHistoryRenderer:
+    """获取群的聊天记录渲染器"""
+    key = str(group_id)
+    renderer = _renderers.get(key)
+    if renderer is None:
+        renderer = _renderers[key] = ChatHistoryRenderer()
+    return renderer
+
+
+async def format_chat_history(messages, config, group_id=None):
+    """格式化聊天记录为大模型输入格式
+
+    Args:
+        messages: 群消息历史列表(从早到晚)
+        config: 插件配置
+        group_id: 群组ID，用于区分各群的渲染缓存
+
+    Returns:
+        str: 格式化后的聊天记录
+    """
+    try:
+        if not messages:
+            return ""
+        return get_renderer(group_id).render(messages, config, group_id)[0]
+    except Exception as e:
+        logger.error(f"格式化聊天记录出错: {str(e)}", exc_info=True)
+        return ""
+
+
+async def format_group_history(history, config, group_id=None) -> Tuple[str, List[str]]:
+    """格式化群消息历史，并返回与图片编号对应的图片URL
+
+    Args:
+        history: 群消息历史(GroupHistory)
+        config: 插件配置
+        group_id: 群组ID
+
+    Returns:
+        Tuple[str, List[str]]: 格式化后的聊天记录和图片URL列表
+    """
+    try:
+        messages = history.snapshot()
+        if not messages:
+            return "", []
+        return get_renderer(group_id).render(messages, config, group_id, history)
     except Exception as e:
         logger.error(f"格式化聊天记录出错: {str(e)}", exc_info=True)
-        import traceback
-        logger.error(traceback.format_exc())
-        return "" 
\ No newline at end of file
+        return "", []
@@ -0,0 +1,101 @@
+"""
+图片感知哈希工具，用于识别聊天记录中重复发送的图片
+"""
+from io import BytesIO
+from typing import Dict, Iterable, List, Optional
+import hashlib
+
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+# 差异哈希的边长，得到 8x8=64 位的哈希
+HASH_SIZE = 8
+
+
+def dhash(data: bytes) -> str:
+    """
+    计算图片的差异哈希(dHash)
+
+    缩小为9x8的灰度图后比较相邻像素的亮度，压缩、缩放和轻微调色后的同一张图片哈希值相近。
+    未安装Pillow时退化为内容哈希，只能识别完全相同的图片
+
+    Args:
+        data: 图片原始数据
+
+    Returns:
+        str: 16位十六进制的感知哈希，或64位十六进制的内容哈希
+    """
+    if not PIL_AVAILABLE:
+        return hashlib.sha256(data).hexdigest()
+    with Image.open(BytesIO(data)) as img:
+        img.seek(0)
+        small = img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+        # 灰度图每个像素一个字节
+        pixels = small.tobytes()
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{value:016x}"
+
+
+def is_similar(a: Optional[str], b: Optional[str], max_distance: int) -> bool:
+    """判断两个哈希是否属于同一张图片，感知哈希按汉明距离比较，内容哈希要求完全相同"""
+    if not a or not b:
+        return False
+    if a == b:
+        return True
+    if len(a) != HASH_SIZE * HASH_SIZE // 4 or len(a) != len(b):
+        return False
+    return bin(int(a, 16) ^ int(b, 16)).count('1') <= max_distance
+
+
+def pick_images(candidates: Iterable[Dict], count: Optional[int] = None,
+                max_distance: Optional[int] = None) -> List[Dict]:
+    """
+    从最新到最旧的候选图片中选择输入给大模型的图片，并分配编号
+
+    重复的图片与已选中的图片共用同一个编号，不占用图片名额。不去重时选满即停止，
+    只访问被选中的候选图片
+
+    Args:
+        candidates: 候选图片(从新到旧)，包含'url'，可选包含'phash'
+        count: 最多选择的不同图片数量，None表示全部
+        max_distance: 判定为重复的最大汉明距离，None表示不去重
+
+    Returns:
+        List[Dict]: 选中的图片(从早到晚)，'number'为图片编号，重复的图片'duplicate'为True
+    """
+    selected = []
+    distinct = []
+    for candidate in candidates:
+        original = None
+        if max_distance is not None and candidate.get('phash'):
+            for image in distinct:
+                if is_similar(candidate['phash'], image.get('phash'), max_distance):
+                    original = image
+                    break
+        if original is None:
+            if count is not None and len(distinct) >= count:
+                # 名额已满后，去重模式下继续向前查找已选图片的更早副本，使它们共用编号
+                if max_distance is None:
+                    break
+                continue
+            image = dict(candidate, duplicate=False)
+            distinct.append(image)
+        else:
+            image = dict(candidate, duplicate=True, original=original)
+        selected.append(image)
+
+    # 不同的图片按时间从早到晚编号，重复的图片使用最新一次出现的编号
+    for number, image in enumerate(reversed(distinct), 1):
+        image['number'] = number
+    for image in selected:
+        if image['duplicate']:
+            image['number'] = image.pop('original')['number']
+    selected.reverse()
+    return selected
@@ -1,3 +1,4 @@
+import time
 from astrbot.api.all import logger
 
 async def get_persona_info(persona_name, context):
@@ -37,4 +38,75 @@ async def get_persona_info(persona_name, context):
         
     except Exception as e:
         logger.error(f"获取人格信息时出错: {str(e)}", exc_info=True)
-        return None 
\ No newline at end of file
+        return None 
+
+class PersonaPromptCache:
+    """人格提示词缓存
+
+    人格解析结果、系统提示词的固定部分和预设对话上下文只在人格列表或人格配置变化时重新编译，
+    每次调用只需拼接当前时间
+    """
+
+    def __init__(self):
+        self._signature = None
+        self._persona = None
+        self._persona_prompt = None
+        self._static_prompt = ""
+        self._contexts = ()
+
+    @staticmethod
+    def _get_signature(persona_name, context):
+        personas = context.provider_manager.personas
+        return persona_name, id(personas), len(personas) if personas else 0
+
+    def _is_stale(self, signature):
+        if signature != self._signature:
+            return True
+        # 人格列表未替换时，仍检查选中人格的提示词是否被原地修改
+        return self._persona is not None and self._persona.get('prompt') is not self._persona_prompt
+
+    async def get(self, persona_name, context):
+        """获取系统提示词和上下文
+
+        Args:
+            persona_name: 人格名称
+            context: AstrBot上下文
+
+        Returns:
+            tuple: (系统提示词, 上下文列表)
+        """
+        signature = self._get_signature(persona_name, context)
+        if self._is_stale(signature):
+            persona_info = await get_persona_info(persona_name, context)
+            self._compile(persona_info)
+            self._signature = signature
+            logger.debug(f"人格 '{persona_name}' 的系统提示词已重新编译")
+
+        system_prompt = f"当前时间:{time.strftime('%Y-%m-%d %H:%M:%S')}{self._static_prompt}"
+        # 返回副本，避免调用方修改缓存的上下文
+        return system_prompt, list(self._contexts)
+
+    def _compile(self, persona_info):
+        """编译系统提示词的固定部分和上下文"""
+        static_prompt = ""
+        contexts = []
+
+        if persona_info:
+            # 添加人格提示词
+            if persona_info.get('prompt'):
+                static_prompt += f"\n\n{persona_info.get('prompt')}"
+
+            # 添加对话风格模仿提示
+            mood_imitation = persona_info.get('_mood_imitation_dialogs_processed')
+            if mood_imitation:
+                static_prompt += f"\n\n请模仿以下对话风格进行回复：\n{mood_imitation}"
+
+            # 添加预设对话上下文
+            begin_dialogs = persona_info.get('_begin_dialogs_processed', [])
+            if begin_dialogs:
+                contexts.extend(begin_dialogs)
+
+        self._persona = persona_info
+        self._persona_prompt = persona_info.get('prompt') if persona_info else None
+        self._static_prompt = static_prompt
+        self._contexts = tuple(contexts)
@@ -1,71 +1,168 @@
 import random
+from collections import deque
+from typing import Dict, List, Optional, Tuple
 from astrbot.api.all import logger
 
+
+class KeywordAutomaton:
+    """Aho-Corasick多关键词匹配自动机
+
+    一次扫描文本即可判断是否包含任意关键词，耗时与关键词数量无关
+    """
+
+    def __init__(self, keywords: List[str]):
+        # 每个状态的转移表、失配指针和命中的关键词
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[Optional[str]] = [None]
+
+        for keyword in keywords:
+            self._add(keyword)
+        self._build()
+
+    def _add(self, keyword: str) -> None:
+        state = 0
+        for ch in keyword:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][ch] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(None)
+            state = next_state
+        # 同一关键词重复配置时保留第一个
+        if self._output[state] is None:
+            self._output[state] = keyword
+
+    def _build(self) -> None:
+        """广度优先构建失配指针，并把后缀状态的命中结果合并到当前状态"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(ch, 0)
+                if self._output[next_state] is None:
+                    self._output[next_state] = self._output[self._fail[next_state]]
+
+    def search(self, text: str) -> Optional[str]:
+        """返回文本中最先出现的关键词，没有则返回None"""
+        if self._output[0] is not None:
+            # 配置了空关键词，任何文本都命中
+            return self._output[0]
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state] is not None:
+                return output[state]
+        return None
+
+    def __bool__(self) -> bool:
+        return len(self._goto) > 1 or self._output[0] is not None
+
+
+class ReplyDecisionEngine:
+    """回复决策引擎
+
+    根据配置预先编译命令关键词和触发关键词自动机、启用群集合以及回复概率，
+    每条消息只需一次扫描即可得出是否回复及原因
+    """
+
+    # 命令关键词，包含这些内容的消息不回复(不区分大小写)
+    COMMAND_KEYWORDS = ("reset", "help", "spectrecore", "sc ")
+
+    def __init__(self, config):
+        self.enabled_groups = frozenset(str(g) for g in config.get('enabled_groups', []))
+        self.command_matcher = KeywordAutomaton([k.lower() for k in self.COMMAND_KEYWORDS])
+
+        freq_config = config.get('model_frequency', {})
+        self.keyword_matcher = KeywordAutomaton(freq_config.get('keywords', []) or [])
+
+        self.use_probability = freq_config.get('method', '') == "概率回复"
+        self.probability = self._parse_probability(freq_config.get('probability', {}).get('probability', 0))
+
+    @staticmethod
+    def _parse_probability(probability) -> float:
+        """校验回复概率，限制在0-1之间"""
+        try:
+            probability = float(probability)
+        except (ValueError, TypeError):
+            logger.warning(f"概率值 '{probability}' 不是有效的数值，使用默认值0")
+            return 0.0
+        return min(max(probability, 0.0), 1.0)
+
+    def decide(self, content: str, group_id=None) -> Tuple[bool, str]:
+        """决定是否应该回复消息
+
+        Args:
+            content: 消息内容
+            group_id: 群聊ID，如果为None则不检查群聊是否启用
+
+        Returns:
+            tuple: (是否回复, 原因)，原因用于日志和统计
+        """
+        # 首先检查是否包含命令关键词，避免回复命令
+        command = self.command_matcher.search(content.lower())
+        if command is not None:
+            logger.debug(f"消息包含命令关键词 '{command}'，不回复")
+            return False, f"command:{command}"
+
+        # 如果启用列表为空或当前群聊不在列表中，则不回复
+        if group_id is not None and str(group_id) not in self.enabled_groups:
+            logger.debug(f"群聊 {group_id} 未启用回复功能")
+            return False, "group_disabled"
+
+        # 检查关键词触发
+        keyword = self.keyword_matcher.search(content) if self.keyword_matcher else None
+        if keyword is not None:
+            logger.debug(f"关键词 '{keyword}' 触发了回复")
+            return True, f"keyword:{keyword}"
+
+        # 概率触发
+        if self.use_probability:
+            random_value = random.random()  # 生成0-1之间的随机小数
+            if random_value <= self.probability:
+                logger.debug(f"概率触发回复: {random_value:.4f} <= {self.probability:.4f}")
+                return True, "probability"
+
+        return False, "none"
+
+
+# 按配置对象缓存编译好的决策引擎
+_engine_cache: Dict[int, ReplyDecisionEngine] = {}
+
+
+def get_reply_engine(config) -> ReplyDecisionEngine:
+    """获取配置对应的决策引擎，同一配置只编译一次"""
+    engine = _engine_cache.get(id(config))
+    if engine is None:
+        _engine_cache.clear()
+        engine = _engine_cache[id(config)] = ReplyDecisionEngine(config)
+    return engine
+
+
 def should_reply(content, config, group_id=None):
     """决定是否应该回复消息
-    
+
     Args:
         content: 消息内容
         config: 插件配置
         group_id: 群聊ID，如果为None则不检查群聊是否启用
-        
+
     Returns:
         bool: 是否应该回复
     """
     try:
-        # 首先检查是否包含命令关键词，避免回复命令
-        command_keywords = ["reset", "help",  "spectrecore", "sc "]
-        for keyword in command_keywords:
-            if keyword in content.lower():
-                logger.debug(f"消息包含命令关键词 '{keyword}'，不回复")
-                return False
-                
-        # 检查群聊是否在启用列表中
-        if group_id is not None:
-            enabled_groups = config.get('enabled_groups', [])
-            # 如果启用列表为空或当前群聊不在列表中，则不回复
-            if not enabled_groups or str(group_id) not in [str(g) for g in enabled_groups]:
-                logger.debug(f"群聊 {group_id} 未启用回复功能")
-                return False
-        
-        # 检查模型频率设置
-        freq_config = config.get('model_frequency', {})
-        
-        # 检查关键词触发
-        keywords = freq_config.get('keywords', [])
-        if keywords:
-            for keyword in keywords:
-                if keyword in content:
-                    logger.debug(f"关键词 '{keyword}' 触发了回复")
-                    return True
-        
-        # 概率触发
-        method = freq_config.get('method', '')
-        if method == "概率回复":
-            # 直接使用配置中的概率值（0-1之间的小数）
-            prob_config = freq_config.get('probability', {})
-            probability = prob_config.get('probability', 0)
-            
-            # 确保概率值是浮点数类型
-            try:
-                probability = float(probability)
-            except (ValueError, TypeError):
-                logger.warning(f"概率值 '{probability}' 不是有效的数值，使用默认值0")
-                probability = 0.0
-            
-            # 确保概率值在有效范围内
-            if probability < 0:
-                probability = 0
-            elif probability > 1:
-                probability = 1
-                
-            random_value = random.random()  # 生成0-1之间的随机小数
-            if random_value <= probability:
-                logger.debug(f"概率触发回复: {random_value:.4f} <= {probability:.4f}")
-                return True
-        
-        return False
-        
+        return get_reply_engine(config).decide(content, group_id)[0]
     except Exception as e:
         logger.error(f"检查是否回复时出错: {str(e)}", exc_info=True)
-        return False 
\ No newline at end of file
+        return False
@@ -0,0 +1,78 @@
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的token数量
+
+    中文等非ASCII字符按每字约1个token计算，ASCII字符按每4个字符约1个token计算。
+    通过UTF-8编码长度推算非ASCII字符数量，避免逐字符遍历
+
+    Args:
+        text: 输入文本
+
+    Returns:
+        int: 估算的token数量
+    """
+    if not text:
+        return 0
+    char_count = len(text)
+    # 常见的中日韩字符UTF-8编码为3字节，比ASCII多2字节
+    non_ascii = min(char_count, (len(text.encode('utf-8')) - char_count) // 2)
+    ascii_count = char_count - non_ascii
+    return non_ascii + (ascii_count + 3) // 4
+
+
+def estimate_record_tokens(record: dict) -> int:
+    """估算一条已存储消息的token数量，包括合并转发中的子消息
+
+    Args:
+        record: 格式化后存储的消息
+
+    Returns:
+        int: 估算的token数量
+    """
+    total = 0
+    stack = [record]
+    while stack:
+        msg = stack.pop()
+        # 发送者和时间前缀按固定开销计算
+        total += 16 + estimate_tokens(msg.get('content', ''))
+        stack.extend(msg.get('forward_messages') or [])
+    return total
+
+
+def truncate_to_tokens(text: str, max_tokens: int, marker: str = "…[内容过长，已截断]") -> str:
+    """将文本截断到估算token数不超过max_tokens，并追加截断标记
+
+    Args:
+        text: 输入文本
+        max_tokens: token上限，小于等于0表示不截断
+        marker: 截断标记
+
+    Returns:
+        str: 截断后的文本
+    """
+    if max_tokens <= 0 or estimate_tokens(text) <= max_tokens:
+        return text
+    budget = max(0, max_tokens - estimate_tokens(marker))
+    # 二分查找不超过预算的最长前缀
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + marker
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """粗略估算一张图片输入给大模型时消耗的token数量(约每750像素1个token)
+
+    Args:
+        width: 图片宽度
+        height: 图片高度
+
+    Returns:
+        int: 估算的token数量
+    """
+    if width <= 0 or height <= 0:
+        return 0
+    return (width * height + 749) // 750